@@ -6,15 +6,28 @@ import threading
 from flask import Flask, render_template, jsonify, request, Response
 import webview
 import uuid
+import time
+from datetime import datetime
 
 import sys, os
 sys.path.append(os.path.dirname(__file__))
 
 from esxi_connect import *
+from esxi_hosts import *
 from vm_operations import *
+from vm_power import *
+from vm_retry import *
+from vm_cancel import *
 from vm_snapshot import *
 from vm_customize import *
+from vm_hardware import *
 from vm_list import *
+from vm_clone_cache import *
+from vm_batch import *
+from vm_retention import *
+from vm_plan import *
+from vm_journal import *
+from vm_reconcile import *
 from logger_ws import *
 from system_tray import *
 from utils import *
@@ -77,12 +90,31 @@ if not os.path.exists(csv_file):
     print(f"ВНИМАНИЕ: CSV файл {csv_file} не найден!")
     print("Создайте файл vm.csv рядом с исполняемым файлом")
 
+# Реестр хостов ESXi / vCenter (кроме хоста по умолчанию из .env)
+esxi_hosts_file = find_file_near_exe(os.getenv('ESXI_HOSTS', 'esxi-hosts.json'))
+init_endpoints(esxi_hosts_file)
+
+# Индекс кэша образов дисков для клонирования
+clone_cache_file = find_file_near_exe(os.getenv('CLONE_CACHE_INDEX', 'clone-cache.json'))
+init_clone_cache(clone_cache_file)
+
+# Правила хранения снапшотов по группам
+retention_file = find_file_near_exe(os.getenv('SNAPSHOT_RETENTION_RULES', 'snapshot-retention.json'))
+init_retention_policies(retention_file)
+
+# История длительности выключений ВМ (для таймаутов graceful shutdown)
+shutdown_history_file = find_file_near_exe(os.getenv('SHUTDOWN_HISTORY', 'shutdown-history.json'))
+init_shutdown_history(shutdown_history_file)
+
+# Журнал пакетов операций (продолжение после падения приложения)
+batch_journal_file = find_file_near_exe(os.getenv('BATCH_JOURNAL', 'batch-journal.jsonl'))
+init_batch_journal(batch_journal_file)
+
 active_sessions = {}
 
 app = Flask(__name__,
             template_folder = os.path.join(getattr(sys, '_MEIPASS', BASE_DIR), 'templates'),
             static_folder = os.path.join(getattr(sys, '_MEIPASS', BASE_DIR), 'static'))
-operation_interrupted = threading.Event()
 sock = init_log_socket(app)
 
 # Глобальный перехватчик лога
@@ -113,34 +145,81 @@ def get_vms():
     return jsonify(vm_configs)
 
 
+def _create_session(vm_operations, session_id=None, connections=None):
+    """
+    Подключается к хостам ВМ пакета (если подключения не переданы) и создаёт сессию.
+    connections — {имя хоста: si}, после вызова принадлежат сессии.
+    """
+    vm_configs, _ = parse_vm_csv(csv_file)
+    vm_config_map = {vm['TARGET_VM_NAME']: vm for vm in vm_configs}
+
+    # Подключаемся к каждому хосту пакета один раз для всех операций
+    endpoints = group_by_endpoint([vm['vm'] for vm in vm_operations], vm_config_map) or [DEFAULT_ENDPOINT]
+    connections = connections or connect_endpoints(endpoints)
+
+    try:
+        # Клоны одного шаблона используют общую подготовку исходной ВМ
+        print_clone_groups(plan_clone_groups(vm_operations, vm_config_map))
+    except Exception:
+        release_endpoints(connections)
+        raise
+
+    session_id = session_id or str(uuid.uuid4())
+    # Отмена сессии прерывает ожидания во всех её рабочих потоках
+    cancel_token = CancelToken()
+    # У каждого хоста своё подключение, кэш подготовки шаблонов и исполнители
+    hosts = {
+        name: {
+            'si': si,
+            'template_cache': TemplatePreparationCache(si),
+            'customize_executor': CustomizationExecutor(si, cancel_token=cancel_token),
+            'deletion_queue': DeletionQueue(si, cancel_token=cancel_token)
+        }
+        for name, si in connections.items()
+    }
+    active_sessions[session_id] = {
+        'hosts': hosts,
+        'vm_config_map': vm_config_map,
+        'vm_operations': vm_operations,
+        'cancel': cancel_token,
+        'revert_stats': {'performed': 0, 'skipped': 0},
+        'lock': threading.Lock(),
+        'plan': None,
+        'batch_id': None,
+        'connection_lost': False,
+        'success_count': 0,
+        'errors': [],
+        'operation_results': {},
+        'vm_errors': {}
+    }
+    return session_id
+
+
+def _session_host(session, vm_name):
+    """Подключение и исполнители хоста, на котором находится ВМ"""
+    name = endpoint_name(session['vm_config_map'].get(vm_name))
+    host = session['hosts'].get(name)
+    if host is None:
+        raise Exception(f"Хост '{name}' ВМ {vm_name} не подключён в этой сессии")
+    return host
+
+
+def _close_session_hosts(session, wait=True):
+    """Останавливает исполнители всех хостов сессии и возвращает подключения в пулы хостов"""
+    for host in session['hosts'].values():
+        host['deletion_queue'].close(wait=wait)
+        host['customize_executor'].close(wait=wait)
+    release_endpoints({name: host['si'] for name, host in session['hosts'].items() if host['si']})
+
+
 @app.route('/api/start-operations', methods=['POST'])
 def start_operations():
-    global operation_interrupted
-    operation_interrupted.clear()
-
     data = request.json
     vm_operations = data.get('vmOperations', [])
 
     try:
-        vm_configs, _ = parse_vm_csv(csv_file)
-        vm_config_map = {vm['TARGET_VM_NAME']: vm for vm in vm_configs}
-
-        # Подключаемся к ESXi один раз для всех операций
-        si = connect_to_host()
-        if si is None:
-            raise Exception("Не удалось подключиться к ESXi")
-
         # Возвращаем идентификатор сессии
-        session_id = str(uuid.uuid4())
-        active_sessions[session_id] = {
-            'si': si,
-            'vm_config_map': vm_config_map,
-            'vm_operations': vm_operations,
-            'success_count': 0,
-            'errors': [],
-            'operation_results': {},
-            'vm_errors': {}
-        }
+        session_id = _create_session(vm_operations)
 
         return jsonify({
             "status": "success",
@@ -149,8 +228,6 @@ def start_operations():
         })
 
     except Exception as e:
-        if 'si' in locals() and si:
-            disconnect_from_host(si)
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -159,8 +236,6 @@ def start_operations():
 
 @app.route('/api/execute-operation', methods=['POST'])
 def execute_operation():
-    global operation_interrupted
-
     data = request.json
     session_id = data.get('session_id')
     vm_name = data.get('vm_name')
@@ -179,40 +254,43 @@ def execute_operation():
         session['operation_results'][operation_key] = 'active'
         # print(json.dumps({"operation": operation_key, "status": "active"}))
 
-        # Проверяем подключение к хосту
-        if not session['si']:
-            raise Exception("Нет подключения к ESXi")
+        # Проверяем подключение к хосту ВМ
+        host = _session_host(session, vm_name)
+        if not host['si']:
+            raise ConnectionFault("Нет подключения к ESXi")
 
         try:
-            if operation == 'clone':
-                vm_clone(session['si'], session['vm_config_map'].get(vm_name, {}))
+            if operation == 'delete':
+                vm = _get_session_vm(session, vm_name)
+                # Удаление идёт в фоне, клиент узнаёт о завершении через /api/operation-status
+                host['deletion_queue'].submit(
+                    vm, on_done=lambda name, error: _finish_background_operation(session, name, 'delete', error)
+                )
+                return jsonify({
+                    "status": "pending",
+                    "operation": operation_key,
+                    "vm_name": vm_name
+                })
+            elif operation == 'customize':
+                vm = _get_session_vm(session, vm_name)
+                # Настройка гостевой ОС идёт в фоне параллельно с другими ВМ,
+                # клиент узнаёт о завершении через /api/operation-status
+                host['customize_executor'].submit(
+                    vm, session['vm_config_map'].get(vm_name, {}),
+                    on_done=lambda name, error: _finish_background_operation(session, name, 'customize', error)
+                )
+                return jsonify({
+                    "status": "pending",
+                    "operation": operation_key,
+                    "vm_name": vm_name
+                })
             else:
-                vm = get_vm_by_name(session['si'], vm_name)
-                if not vm:
-                    raise Exception(f"ВМ {vm_name} не найдена")
-
-                if operation == 'delete':
-                    vm_delete(vm)
-                elif operation == 'customize':
-                    customize_vm_os(session['si'], vm, session['vm_config_map'].get(vm_name, {}))
-                elif operation == 'hardware':
-                    customize_vm_hardware(vm, session['vm_config_map'].get(vm_name, {}))
-                elif operation == 'snapshot':
-                    config = session['vm_config_map'].get(vm_name, {}).copy()
-                    if snapshot_name:
-                        config['snapshot_name'] = snapshot_name
-                    create_snapshot(vm, config)
-                elif operation == 'revert':
-                    if not revert_name:
-                        raise Exception("Не указано имя снапшота для отката")
-                    revert_to_snapshot(vm, revert_name)
-                elif operation == 'poweroff':
-                    vm_power_off(vm)
-                elif operation == 'poweron':
-                    vm_power_on(vm)
+                with cancel_scope(session['cancel']):
+                    _run_operation(session, vm_name, operation, snapshot_name, revert_name)
 
-            session['success_count'] += 1
-            session['operation_results'][operation_key] = 'success'
+            with session['lock']:
+                session['success_count'] += 1
+                session['operation_results'][operation_key] = 'success'
 
             return jsonify({
                 "status": "success",
@@ -222,6 +300,9 @@ def execute_operation():
 
 
         except Exception as op_error:
+            # Потеря подключения к ESXi — критическая ошибка всего пакета
+            if is_connection_fault(op_error):
+                raise
             # Ошибка в конкретной операции
             error_msg = f"Ошибка операции '{operation}' для {vm_name}: {str(op_error)}"
             session['errors'].append(error_msg)
@@ -236,7 +317,7 @@ def execute_operation():
 
     except Exception as e:
         # Критическая ошибка (только при подключении) - прерываем все
-        if "подключ" in str(e).lower() or "connect" in str(e).lower():
+        if is_connection_fault(e):
             error_msg = f"Критическая ошибка подключения: {str(e)}"
             session['errors'].append(error_msg)
             session['operation_results'][operation_key] = 'error'
@@ -259,10 +340,289 @@ def execute_operation():
             })
 
 
+def _get_session_vm(session, vm_name):
+    vm = get_vm_by_name(_session_host(session, vm_name)['si'], vm_name)
+    if not vm:
+        raise Exception(f"ВМ {vm_name} не найдена")
+    return vm
+
+
+def _run_operation(session, vm_name, operation, snapshot_name=None, revert_name=None):
+    """Синхронно выполняет одну операцию над ВМ в рамках сессии"""
+    vm_config = session['vm_config_map'].get(vm_name, {})
+    host = _session_host(session, vm_name)
+
+    if operation == 'clone':
+        # Клон под именем удаляемой ВМ создаётся только после фактического удаления
+        host['deletion_queue'].wait_for(vm_name)
+        vm_clone(host['si'], vm_config, host['template_cache'])
+        return
+
+    vm = _get_session_vm(session, vm_name)
+    if operation == 'delete':
+        host['deletion_queue'].submit(vm).result()
+    elif operation == 'customize':
+        host['customize_executor'].submit(vm, vm_config).result()
+    elif operation == 'hardware':
+        customize_vm_hardware(vm, vm_config)
+    elif operation == 'snapshot':
+        config = vm_config.copy()
+        if snapshot_name:
+            config['snapshot_name'] = snapshot_name
+        create_snapshot(vm, config)
+    elif operation == 'revert':
+        if not revert_name:
+            raise Exception("Не указано имя снапшота для отката")
+        revert_to_snapshot(vm, revert_name, session['revert_stats'])
+    elif operation == 'poweroff':
+        vm_power_off(vm)
+    elif operation == 'poweron':
+        vm_power_on(vm)
+
+
+def _finish_background_operation(session, vm_name, operation, error):
+    """Фиксирует результат фоновой операции в сессии"""
+    operation_key = f"{vm_name}_{operation}"
+    with session['lock']:
+        if error is None:
+            session['success_count'] += 1
+            session['operation_results'][operation_key] = 'success'
+        else:
+            error_msg = f"Ошибка операции '{operation}' для {vm_name}: {str(error)}"
+            session['errors'].append(error_msg)
+            session['vm_errors'].setdefault(vm_name, []).append(error_msg)
+            session['operation_results'][operation_key] = 'error'
+
+
+def _run_plan_step(session, step):
+    with cancel_scope(session['cancel']):
+        if step['operation'] == PREPARE:
+            host = session['hosts'][step['endpoint']]
+            host['template_cache'].get(step['vm'], step['options'].get('snapshot_name'))
+            return
+        options = step['options']
+        _run_operation(session, step['vm'], step['operation'],
+                       options.get('snapshot_name'), options.get('revert_name'))
+
+
+def _plan_step_update(session, step, status, error):
+    """Переносит статус шага плана в результаты сессии и журнал пакетов"""
+    if status == 'active':
+        journal_step_started(session['batch_id'], step['key'])
+    else:
+        journal_step_finished(session['batch_id'], step['key'], status, error)
+
+    if error is not None and is_connection_fault(error) and not session['connection_lost']:
+        # Подключение к ESXi потеряно: новые шаги не запускаем, пакет остаётся
+        # в журнале незавершённым, чтобы его можно было продолжить
+        with session['lock']:
+            session['connection_lost'] = True
+            session['errors'].append(f"Критическая ошибка подключения: {error}")
+        session['plan'].cancel()
+
+    if step['hidden']:
+        if error:
+            with session['lock']:
+                session['errors'].append(f"Подготовка исходной ВМ {step['vm']}: {error}")
+        return
+    if status == 'active':
+        with session['lock']:
+            session['operation_results'][step['key']] = 'active'
+        return
+    _finish_background_operation(session, step['vm'], step['operation'], error)
+
+
+def _start_plan(session, session_id, steps, completed=(), **extra):
+    session['batch_id'] = session_id
+    executor = PlanExecutor(
+        steps,
+        run_step=lambda step: _run_plan_step(session, step),
+        on_update=lambda step, status, error: _plan_step_update(session, step, status, error),
+        completed=completed
+    )
+    session['plan'] = executor
+    executor.start()
+    return jsonify({
+        "status": "success",
+        "message": "План операций запущен",
+        "session_id": session_id,
+        "vmOperations": session['vm_operations'],
+        "steps": [{"key": step['key'], "deps": sorted(step['deps']), "merged_into": step['merged_into'],
+                   "completed": step['key'] in completed}
+                  for step in steps.values() if not step['hidden']],
+        **extra
+    })
+
+
+@app.route('/api/execute-plan', methods=['POST'])
+def execute_plan():
+    """
+    Выполняет все операции сессии по плану: порядок и параллельность выбирает сервер
+    (vm_plan.build_plan), клиент следит за ходом через /api/operation-status.
+    Ход выполнения пишется в журнал пакетов, чтобы пакет можно было продолжить.
+    """
+    data = request.json
+    session_id = data.get('session_id')
+
+    if not session_id or session_id not in active_sessions:
+        return jsonify({"status": "error", "message": "Недействительная сессия"}), 400
+
+    session = active_sessions[session_id]
+    if session.get('plan'):
+        return jsonify({"status": "error", "message": "План уже выполняется"}), 400
+
+    steps = build_plan(session['vm_operations'], session['vm_config_map'])
+    print_plan(steps)
+    journal_batch_started(session_id, session['vm_operations'])
+    return _start_plan(session, session_id, steps)
+
+
+@app.route('/api/reconcile', methods=['POST'])
+def reconcile():
+    """
+    Приводит ВМ к описанию в CSV: {group | vms (без них — все строки CSV), dry_run}.
+    Вычисляет минимальный набор операций и выполняет его по плану, как /api/execute-plan.
+    Если всё уже соответствует CSV, изменяющих вызовов не делается.
+    """
+    data = request.json or {}
+    vm_configs, _ = parse_vm_csv(csv_file)
+    # Все строки CSV — только если выбор не задан; пустой выбор (опечатка в группе) — ошибка
+    if 'group' in data or 'vms' in data:
+        vm_names = _selected_vm_names(data, vm_configs)
+        vm_configs = [vm for vm in vm_configs if vm['TARGET_VM_NAME'] in vm_names]
+        if not vm_configs:
+            return jsonify({"status": "error", "message": "Выбранные ВМ не найдены в CSV"}), 400
+
+    connections = {}
+    try:
+        vm_config_map = {vm['TARGET_VM_NAME']: vm for vm in vm_configs}
+        groups = group_by_endpoint(vm_config_map, vm_config_map)
+        connections = connect_endpoints(groups or [DEFAULT_ENDPOINT])
+
+        # Инвентарь всех хостов запрашивается параллельно
+        vms = {}
+        for name, (host_vms, error) in for_each_endpoint(
+                connections, lambda name: get_vms_by_names(connections[name], groups.get(name, []))).items():
+            if error is not None:
+                raise error
+            vms.update(host_vms)
+        vm_operations, report = plan_reconcile(vms, vm_configs)
+
+        if data.get('dry_run') or not vm_operations:
+            return jsonify({
+                "status": "success",
+                "message": (f"Требуют изменений ВМ: {len(vm_operations)}" if vm_operations
+                            else "Все ВМ соответствуют CSV"),
+                "session_id": None,
+                "vmOperations": vm_operations,
+                "report": report
+            })
+
+        session_id = _create_session(vm_operations, connections=connections)
+        connections = {}  # подключения теперь принадлежат сессии
+        session = active_sessions[session_id]
+        steps = build_plan(vm_operations, session['vm_config_map'])
+        print_plan(steps)
+        journal_batch_started(session_id, vm_operations)
+        return _start_plan(session, session_id, steps, report=report)
+    except Exception as e:
+        print(f"[X] Ошибка приведения ВМ к CSV: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+    finally:
+        release_endpoints(connections)
+
+
+@app.route('/api/journal', methods=['GET'])
+def get_batch_journal():
+    """
+    Незавершённые пакеты операций из журнала (приложение упало или прервалась связь).
+    Пакеты, которые ещё выполняются (страницу перезагрузили), не показываются.
+    """
+    return jsonify([
+        {
+            "batch": batch['batch'],
+            "started": batch['started'],
+            "vm_count": len(batch['vm_operations']),
+            "operations": sum(len(vm['operations']) for vm in batch['vm_operations']),
+            "done": sum(1 for status in batch['steps'].values() if status == 'success')
+        }
+        for batch in incomplete_batches() if batch['batch'] not in active_sessions
+    ])
+
+
+@app.route('/api/journal/discard', methods=['POST'])
+def discard_batch():
+    batch_id = (request.json or {}).get('batch_id')
+    if batch_id in active_sessions:
+        return jsonify({"status": "error", "message": "Пакет ещё выполняется"}), 400
+    journal_batch_finished(batch_id, 'discarded')
+    return jsonify({"status": "success", "message": "Пакет операций удалён из журнала"})
+
+
+@app.route('/api/resume-batch', methods=['POST'])
+def resume_batch():
+    """
+    Продолжает незавершённый пакет из журнала: сверяет шаги с журналом и текущим
+    inventory и запускает план с первого невыполненного шага. Уже выполненные
+    шаги (ВМ создана, снапшот существует) пропускаются.
+    """
+    batch_id = (request.json or {}).get('batch_id')
+    batch = next((batch for batch in incomplete_batches() if batch['batch'] == batch_id), None)
+    if batch is None:
+        return jsonify({"status": "error", "message": "Пакет не найден в журнале"}), 404
+    if batch_id in active_sessions:
+        return jsonify({"status": "error", "message": "Пакет уже выполняется"}), 400
+
+    try:
+        _create_session(batch['vm_operations'], batch_id)
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+    session = active_sessions[batch_id]
+
+    try:
+        steps = build_plan(session['vm_operations'], session['vm_config_map'])
+        vms = {}
+
+        def vm_lookup(vm_name):
+            if vm_name not in vms:
+                vms[vm_name] = get_vm_by_name(_session_host(session, vm_name)['si'], vm_name)
+            return vms[vm_name]
+
+        completed = completed_steps(steps, batch['steps'], vm_lookup, session['vm_config_map'])
+        print(f"[*] Продолжение пакета от {batch['started']}: выполнено ранее "
+              f"{len([key for key in completed if not steps[key]['hidden']])} из "
+              f"{len([step for step in steps.values() if not step['hidden']])} шагов")
+        print_plan({key: step for key, step in steps.items() if key not in completed})
+        return _start_plan(session, batch_id, steps, completed)
+    except Exception as e:
+        active_sessions.pop(batch_id, None)
+        _close_session_hosts(session, wait=False)
+        print(f"[X] Не удалось продолжить пакет операций: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/operation-status', methods=['POST'])
+def operation_status():
+    data = request.json
+    session_id = data.get('session_id')
+
+    if not session_id or session_id not in active_sessions:
+        return jsonify({"status": "error", "message": "Недействительная сессия"}), 400
+
+    session = active_sessions[session_id]
+    with session['lock']:
+        results = dict(session['operation_results'])
+    plan = session.get('plan')
+    return jsonify({
+        "status": "success",
+        "operationResults": results,
+        "vm_errors": session['vm_errors'],
+        "finished": plan.done() if plan else None
+    })
+
+
 @app.route('/api/finish-operations', methods=['POST'])
 def finish_operations():
-    global operation_interrupted
-
     data = request.json
     session_id = data.get('session_id')
 
@@ -270,9 +630,18 @@ def finish_operations():
         return jsonify({"status": "error", "message": "Недействительная сессия"}), 400
 
     session = active_sessions.pop(session_id)
-    si = session['si']
 
     try:
+        # Дожидаемся плана, фоновых удалений и настройки гостевых ОС
+        if session.get('plan'):
+            session['plan'].wait()
+            if not session['connection_lost']:
+                journal_batch_finished(session['batch_id'])
+        for host in session['hosts'].values():
+            host['deletion_queue'].wait()
+            host['customize_executor'].wait()
+            host['customize_executor'].print_timings()
+
         # Формируем итоговый отчет
         total_operations = sum(len(vm['operations']) for vm in session['vm_operations'])
         success_count = session['success_count']
@@ -290,6 +659,10 @@ def finish_operations():
         print(f"Всего операций: {total_operations}")
         print(f"Успешно выполнено: {success_count}")
         print(f"Ошибок: {len(errors)}")
+        revert_stats = session['revert_stats']
+        if revert_stats['performed'] or revert_stats['skipped']:
+            print(f"Откатов к снапшотам: {revert_stats['performed']}, "
+                  f"пропущено (ВМ уже в снапшоте): {revert_stats['skipped']}")
         print("-" * 70)
 
         # Выводим статистику по ВМ
@@ -338,23 +711,37 @@ def finish_operations():
         })
 
     finally:
-        if si:
-            disconnect_from_host(si)
-        operation_interrupted.clear()
+        _close_session_hosts(session)
+
+
+def _release_cancelled_session(session):
+    """
+    Дожидается, пока рабочие потоки отменённой сессии прервут ожидания,
+    и только после этого отключается от ESXi
+    """
+    start_time = time.time()
+    if session.get('plan'):
+        session['plan'].wait()
+    _close_session_hosts(session)
+    print(f"[+] Операции прерваны, ресурсы сессии освобождены за {time.time() - start_time:.1f} сек")
+    print("=" * 70)
 
 
 @app.route('/api/cancel-operations', methods=['POST'])
 def cancel_operations():
-    global operation_interrupted
-    operation_interrupted.set()
-
     data = request.json
     session_id = data.get('session_id')
 
     if session_id in active_sessions:
         session = active_sessions.pop(session_id)
-        if session['si']:
-            disconnect_from_host(session['si'])
+        # Новые шаги не запускаются, выполняющиеся задачи vSphere отменяются,
+        # vmkfstools на хосте завершается, ожидания прерываются
+        session['cancel'].cancel()
+        if session.get('plan'):
+            session['plan'].cancel()
+            journal_batch_finished(session['batch_id'], 'cancelled')
+        threading.Thread(target=_release_cancelled_session, args=(session,),
+                         name="Отмена операций", daemon=True).start()
 
     return jsonify({
         "status": "success",
@@ -391,36 +778,283 @@ def open_csv():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
-@app.route('/api/esxi-status', methods=['GET'])
-def esxi_status():
+def _selected_vm_names(data, vm_configs):
+    """Имена ВМ из запроса групповой операции: список vms и/или все ВМ группы group"""
+    vm_names = list(data.get('vms') or [])
+    if data.get('group'):
+        vm_names += [vm['TARGET_VM_NAME'] for vm in vm_configs
+                     if vm['GROUP_NAME'] == data['group'] and vm['TARGET_VM_NAME'] not in vm_names]
+    return vm_names
+
+
+def _not_found_result(message):
+    return {'status': 'error', 'message': message, 'seconds': 0}
+
+
+def _run_on_fleet(vm_names, vm_configs, run, error_result=_not_found_result):
+    """
+    Групповая операция на всех хостах параллельно: ВМ делятся по столбцу esxiHost,
+    для каждого хоста — своё подключение и run(si, {имя: vm}) -> {имя: результат}.
+    ВМ, не найденные на хосте или на недоступном хосте, получают error_result(сообщение).
+    Если недоступны все хосты, ошибка подключения выбрасывается.
+    """
+    groups = group_by_endpoint(vm_names, {vm['TARGET_VM_NAME']: vm for vm in vm_configs})
+
+    def run_on_host(name):
+        connections = connect_endpoints([name])
+        si = connections[name]
+        try:
+            vms = get_vms_by_names(si, groups[name])
+            results = {vm_name: error_result('ВМ не найдена') for vm_name in groups[name] if vm_name not in vms}
+            results.update(run(si, vms))
+            return results
+        finally:
+            release_endpoints(connections)
+
+    outcomes = for_each_endpoint(groups, run_on_host)
+    errors = [error for _, error in outcomes.values() if error is not None]
+    if errors and len(errors) == len(outcomes):
+        raise errors[0]
+
+    results = {}
+    for name, (host_results, error) in outcomes.items():
+        if error is not None:
+            print(f"[X] Хост {name}: {error}")
+            host_results = {vm_name: error_result(f"Хост {name}: {error}") for vm_name in groups[name]}
+        results.update(host_results)
+    return results
+
+
+@app.route('/api/bulk-snapshot', methods=['POST'])
+def bulk_snapshot():
+    """
+    Снапшоты сразу для группы или списка ВМ:
+    {action: create|revert|remove, group | vms, snapshot_name, description, memory, quiesce, remove_children}
+    """
+    data = request.json or {}
+    action = data.get('action')
+    snapshot_name = (data.get('snapshot_name') or '').strip()
+
+    if action not in ('create', 'revert', 'remove'):
+        return jsonify({"status": "error", "message": "Действие должно быть create, revert или remove"}), 400
+    if not snapshot_name and action != 'create':
+        return jsonify({"status": "error", "message": "Не указано имя снапшота"}), 400
+    if not snapshot_name:
+        snapshot_name = f"snapshot_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+
+    vm_configs, _ = parse_vm_csv(csv_file)
+    vm_names = _selected_vm_names(data, vm_configs)
+    if not vm_names:
+        return jsonify({"status": "error", "message": "Не выбрано ни одной ВМ"}), 400
+
     try:
-        si = connect_to_host(silent=True)
-        if not si:
-            return jsonify({
-                "status": "offline",
-                "host": ESXI_HOST,
-                "type": "Неизвестный сервер",
-                "message": "Хост недоступен"
-            }), 503
+        results = _run_on_fleet(vm_names, vm_configs, lambda si, vms: run_bulk_snapshots(
+            list(vms.values()), action, snapshot_name,
+            description=data.get('description', ''),
+            memory=bool(data.get('memory')),
+            quiesce=bool(data.get('quiesce')),
+            remove_children=bool(data.get('remove_children'))
+        ))
+
+        failed = [name for name, result in results.items() if result['status'] == 'error']
+        return jsonify({
+            "status": "error" if failed else "success",
+            "message": f"Снапшот '{snapshot_name}': успешно {len(results) - len(failed)} из {len(results)}",
+            "snapshot_name": snapshot_name,
+            "results": results
+        })
+    except Exception as e:
+        print(f"[X] Ошибка групповой операции со снапшотами: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        from vm_operations import is_vcenter
-        host_type = "vCenter" if is_vcenter(si) else "ESXi"
-        disconnect_from_host(si, silent=True)
 
+@app.route('/api/bulk-power', methods=['POST'])
+def bulk_power():
+    """
+    Питание сразу для группы или списка ВМ:
+    {action: poweron | shutdown, group | vms, stagger, wave_size, shutdown_timeout}
+    При запуске ВМ стартуют волнами в порядке столбца bootOrder CSV.
+    """
+    data = request.json or {}
+    action = data.get('action')
+    if action not in ('poweron', 'shutdown'):
+        return jsonify({"status": "error", "message": "Действие должно быть poweron или shutdown"}), 400
+
+    vm_configs, _ = parse_vm_csv(csv_file)
+    vm_names = _selected_vm_names(data, vm_configs)
+    if not vm_names:
+        return jsonify({"status": "error", "message": "Не выбрано ни одной ВМ"}), 400
+
+    try:
+        # Волны запуска по bootOrder идут на каждом хосте независимо
+        if action == 'poweron':
+            boot_order = {vm['TARGET_VM_NAME']: vm['BOOT_ORDER'] for vm in vm_configs}
+            results = _run_on_fleet(vm_names, vm_configs, lambda si, vms: vm_power_on_many(
+                si, list(vms.values()), boot_order,
+                stagger=float(data.get('stagger') or 0),
+                wave_size=int(data.get('wave_size') or 0)))
+        else:
+            timeout = data.get('shutdown_timeout')
+            results = _run_on_fleet(vm_names, vm_configs, lambda si, vms: vm_power_off_many(
+                si, list(vms.values()), float(timeout) if timeout else None))
+
+        failed = [name for name, result in results.items() if result['status'] == 'error']
         return jsonify({
-            "status": "online",
-            "host": ESXI_HOST,
-            "type": host_type,
-            "message": f"{host_type} доступен"
+            "status": "error" if failed else "success",
+            "message": f"{'Запущено' if action == 'poweron' else 'Выключено'} ВМ: "
+                       f"{len(results) - len(failed)} из {len(results)}",
+            "results": results
         })
+    except Exception as e:
+        print(f"[X] Ошибка групповой операции питания ВМ: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 
+@app.route('/api/bulk-delete', methods=['POST'])
+def bulk_delete():
+    """Удаление сразу группы или списка ВМ: {group | vms}. Ответ — после фактического удаления."""
+    data = request.json or {}
+    vm_configs, _ = parse_vm_csv(csv_file)
+    vm_names = _selected_vm_names(data, vm_configs)
+    if not vm_names:
+        return jsonify({"status": "error", "message": "Не выбрано ни одной ВМ"}), 400
+
+    def delete_on_host(si, vms):
+        queue = DeletionQueue(si)
+        try:
+            for vm in vms.values():
+                queue.submit(vm)
+            return queue.wait()
+        finally:
+            queue.close()
+
+    try:
+        results = _run_on_fleet(vm_names, vm_configs, delete_on_host)
+
+        failed = [name for name, result in results.items() if result['status'] == 'error']
+        return jsonify({
+            "status": "error" if failed else "success",
+            "message": f"Удалено ВМ: {len(results) - len(failed)} из {len(results)}",
+            "results": results
+        })
+    except Exception as e:
+        print(f"[X] Ошибка группового удаления ВМ: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/snapshot-retention', methods=['POST'])
+def snapshot_retention():
+    """
+    Удаление лишних снапшотов по правилам хранения:
+    {group | vms, dry_run, keep_last, max_age_days, keep_named}
+    Параметры в запросе переопределяют правила из файла для этого запуска.
+    """
+    data = request.json or {}
+    overrides = {key: data[key] for key in ('keep_last', 'max_age_days', 'keep_named') if key in data}
+    dry_run = bool(data.get('dry_run'))
+
+    vm_configs, _ = parse_vm_csv(csv_file)
+    groups = {vm['TARGET_VM_NAME']: vm['GROUP_NAME'] for vm in vm_configs}
+    # Снапшоты-источники клонирования не удаляются
+    protected = {}
+    for vm in vm_configs:
+        if vm.get('SOURCE_VM_NAME') and vm.get('SOURCE_SNAPSHOT_NAME'):
+            protected.setdefault(vm['SOURCE_VM_NAME'], set()).add(vm['SOURCE_SNAPSHOT_NAME'])
+
+    vm_names = _selected_vm_names(data, vm_configs)
+    if not vm_names:
+        return jsonify({"status": "error", "message": "Не выбрано ни одной ВМ"}), 400
+
+    def retention_on_host(si, vms):
+        entries = [(vm, policy_for_group(groups.get(name, data.get('group')), overrides), protected.get(name, ()))
+                   for name, vm in vms.items()]
+        return run_retention(entries, dry_run=dry_run)
+
+    try:
+        results = _run_on_fleet(vm_names, vm_configs, retention_on_host,
+                                error_result=lambda message: {'errors': [message], 'planned': [], 'removed': []})
+
+        failed = [name for name, report in results.items() if report['errors']]
+        total = sum(len(report['planned'] if dry_run else report['removed']) for report in results.values())
+        return jsonify({
+            "status": "error" if failed else "success",
+            "message": f"{'К удалению' if dry_run else 'Удалено'} снапшотов: {total}, ВМ с ошибками: {len(failed)}",
+            "results": results
+        })
     except Exception as e:
+        print(f"[X] Ошибка применения политики хранения снапшотов: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/clone-cache', methods=['GET'])
+def get_clone_cache():
+    return jsonify(clone_cache_state())
+
+
+@app.route('/api/clone-cache/evict', methods=['POST'])
+def evict_clone_cache():
+    data = request.json or {}
+    key = data.get('key')
+
+    # Образы удаляются через SSH того хоста, на datastore которого они лежат
+    endpoints = {entry_endpoint(entry) for entry in clone_cache_state()['entries']
+                 if key is None or entry['key'] == key}
+
+    def evict_on_host(name):
+        with get_endpoint(name).ssh_pool.session() as ssh:
+            return evict_cached_disks(ssh, key, endpoint=name)
+
+    try:
+        outcomes = for_each_endpoint(endpoints, evict_on_host)
+        for name, (_, error) in outcomes.items():
+            if error is not None:
+                raise Exception(f"Хост {name}: {error}")
+        removed = sum(count for count, _ in outcomes.values())
         return jsonify({
-            "status": "offline",
-            "host": ESXI_HOST,
-            "type": "error",
-            "message": f"Ошибка: {str(e)}"
-        }), 503
+            "status": "success",
+            "message": f"Удалено образов из кэша: {removed}",
+            "removed": removed
+        })
+    except Exception as e:
+        print(f"[X] Ошибка очистки кэша образов: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+def _endpoint_status(endpoint):
+    try:
+        si = endpoint.connect(silent=True)
+        if not si:
+            return {"name": endpoint.name, "status": "offline", "host": endpoint.host,
+                    "type": "Неизвестный сервер", "message": "Хост недоступен"}
+
+        from vm_operations import is_vcenter
+        host_type = "vCenter" if is_vcenter(si) else "ESXi"
+        disconnect_from_host(si, silent=True)
+        return {"name": endpoint.name, "status": "online", "host": endpoint.host,
+                "type": host_type, "message": f"{host_type} доступен"}
+
+    except Exception as e:
+        return {"name": endpoint.name, "status": "offline", "host": endpoint.host,
+                "type": "error", "message": f"Ошибка: {str(e)}"}
+
+
+@app.route('/api/esxi-status', methods=['GET'])
+def esxi_status():
+    """Состояние всех хостов реестра (проверяются параллельно); верхний уровень — сводка"""
+    endpoints = {endpoint.name: endpoint for endpoint in all_endpoints()}
+    hosts = [result for result, _ in for_each_endpoint(
+        endpoints, lambda name: _endpoint_status(endpoints[name])).values()]
+    if len(hosts) == 1:
+        summary = {key: value for key, value in hosts[0].items() if key != 'name'}
+    else:
+        online = [host for host in hosts if host['status'] == 'online']
+        summary = {
+            "status": "online" if len(online) == len(hosts) else "offline",
+            "host": ", ".join(host['host'] for host in hosts),
+            "type": ", ".join(sorted({host['type'] for host in online})) or "Неизвестный сервер",
+            "message": f"Доступно хостов: {len(online)} из {len(hosts)}"
+        }
+    return jsonify({**summary, "hosts": hosts}), 200 if summary['status'] == 'online' else 503
 
 def start_flask():
     app.run(host='0.0.0.0', debug=False, port=5000)
@@ -6,7 +6,10 @@ import sys
 import traceback
 from datetime import datetime
 import socket
+import paramiko
 from pyVmomi import vim
+from vm_retry import with_retry
+from vm_cancel import current_token
 
 
 # Загружаем переменные из .env
@@ -59,10 +62,13 @@ def connect_to_host(
         if not silent:
             print(f"Попытка подключения к {host}:{port}...")
 
-        # Проверка доступности хоста...
-        try:
+        # Проверка доступности хоста (фоновую проверку не повторяем)...
+        def probe():
             sock = socket.create_connection((host, port), timeout=3)
             sock.close()
+
+        try:
+            with_retry(probe, f"Проверка доступности {host}:{port}", attempts=1 if silent else None)
         except socket.timeout:
             if not silent:
                 print(f"[X] Не удалось подключиться к {host}:{port}")
@@ -81,14 +87,14 @@ def connect_to_host(
                 print("[!] Используется строгая проверка SSL сертификата")
             context = ssl.create_default_context()
 
-        # Подключение
-        si = SmartConnect(
+        # Подключение: обрыв TLS-рукопожатия или таймаут при перезапуске hostd повторяем
+        si = with_retry(lambda: SmartConnect(
             host=host,
             user=user,
             pwd=password,
             port=port,
             sslContext=context
-        )
+        ), f"Подключение к {host}", attempts=1 if silent else None)
 
         if not silent:
             print(f"Успешное подключение к {host}")
@@ -115,6 +121,16 @@ def connect_to_host(
     return None
 
 
+# Кэши, привязанные к подключению (объекты vSphere с его сессией),
+# регистрируют здесь обработчик и сбрасываются при отключении
+_disconnect_handlers = []
+
+
+def on_disconnect(handler):
+    """handler(service_instance) вызывается перед каждым отключением от хоста"""
+    _disconnect_handlers.append(handler)
+
+
 def disconnect_from_host(service_instance, silent=False):
     """
     Безопасное отключение от ESXi.
@@ -125,6 +141,12 @@ def disconnect_from_host(service_instance, silent=False):
             print("[!] Попытка отключения при отсутствующем подключении")
         return
 
+    for handler in _disconnect_handlers:
+        try:
+            handler(service_instance)
+        except Exception as e:
+            print(f"[!] Ошибка сброса данных подключения: {e}")
+
     try:
         if not silent:
             print("Попытка отключения от ESXi...")
@@ -138,4 +160,66 @@ def disconnect_from_host(service_instance, silent=False):
             print(f"[X] Ошибка при отключении: {str(e)}")
     finally:
         if not silent:
-            print("=" * 70)
\ No newline at end of file
+            print("=" * 70)
+
+
+def connect_ssh(
+        host=SSH_HOST,
+        user=SSH_USER,
+        password=SSH_PASSWORD,
+        port=SSH_PORT
+):
+    """
+    SSH-подключение к ESXi (vmkfstools, vim-cmd).
+    Возвращает paramiko.SSHClient, при ошибке выбрасывает исключение.
+    """
+    print(f"[*] Подключение по SSH к {host}...")
+
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    # Улучшенные параметры подключения для ESXi; таймаут баннера и отказ
+    # в соединении (sshd перегружен параллельными сессиями) повторяем
+    with_retry(lambda: ssh.connect(
+        hostname=host,
+        username=user,
+        password=password,
+        port=port,
+        timeout=20,
+        banner_timeout=10,
+        auth_timeout=10,
+        allow_agent=False,
+        look_for_keys=False
+    ), f"SSH подключение к {host}")
+    print("[+] SSH подключение успешно")
+    return ssh
+
+
+def ssh_exec(ssh, cmd, check=False, kill_on_cancel=False):
+    """
+    Выполняет команду по SSH и дожидается её завершения.
+    Возвращает (exit_code, stdout, stderr).
+    check=True — выбрасывает исключение при ненулевом коде возврата.
+    kill_on_cancel=True — для долгих команд (vmkfstools): команда запускается
+    в псевдотерминале, и при отмене пакета закрытие канала завершает её на хосте
+    (stderr в этом режиме приходит вместе с stdout).
+    """
+    if not kill_on_cancel:
+        _, stdout, stderr = ssh.exec_command(cmd)
+        output = stdout.read().decode().strip()
+        error_out = stderr.read().decode().strip()
+        exit_code = stdout.channel.recv_exit_status()
+    else:
+        token = current_token()
+        token.check(cmd.split()[0])
+        _, stdout, stderr = ssh.exec_command(cmd, get_pty=True)
+        with token.on_cancel(stdout.channel.close):
+            output = stdout.read().decode(errors='replace').strip()
+            error_out = stderr.read().decode(errors='replace').strip()
+            exit_code = stdout.channel.recv_exit_status()
+        token.check(cmd.split()[0])
+
+    if check and exit_code != 0:
+        raise Exception(f"Команда завершилась с кодом {exit_code}: {error_out or output}")
+
+    return exit_code, output, error_out
@@ -0,0 +1,248 @@
+import os
+import json
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from esxi_connect import (connect_to_host, disconnect_from_host, connect_ssh,
+                          ESXI_HOST, ESXI_USER, ESXI_PASSWORD, ESXI_PORT, IGNORE_SSL,
+                          SSH_HOST, SSH_USER, SSH_PASSWORD, SSH_PORT)
+from vm_retry import ConnectionFault
+
+# Реестр хостов: один экземпляр приложения управляет несколькими ESXi / vCenter.
+# Хост по умолчанию ('default') задаётся переменными ESXI_* / SSH_* из .env,
+# остальные — в json-файле рядом с exe:
+# [{"name": "esx2", "host": "10.0.0.12", "user": ..., "password": ..., "port": 443,
+#   "ssh_host": ..., "ssh_user": ..., "ssh_password": ..., "ssh_port": 22,
+#   "max_parallel": 8, "ssh_pool_size": 4, "vsphere_pool_size": 2}, ...]
+# Незаданные поля берутся из .env. Строка CSV выбирает хост столбцом esxiHost.
+
+DEFAULT_ENDPOINT = 'default'
+ENDPOINT_MAX_PARALLEL = int(os.getenv("ENDPOINT_MAX_PARALLEL", "16"))
+SSH_POOL_SIZE = int(os.getenv("SSH_POOL_SIZE", "4"))
+VSPHERE_POOL_SIZE = int(os.getenv("VSPHERE_POOL_SIZE", "2"))
+
+
+class ServiceInstancePool:
+    """
+    Подключения vSphere одного хоста. После пакета или групповой операции
+    подключение не закрывается, а возвращается в пул (не больше size свободных)
+    и достаётся следующей операции без повторного логина. Перед выдачей
+    проверяется, что сессия на хосте жива: её мог закрыть таймаут простоя.
+    """
+
+    def __init__(self, endpoint, size=VSPHERE_POOL_SIZE):
+        self.endpoint = endpoint
+        self.size = max(0, size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    @staticmethod
+    def _alive(si):
+        try:
+            return si.content.sessionManager.currentSession is not None
+        except Exception:
+            return False
+
+    def acquire(self):
+        """Свободное подключение из пула или новое; None, если подключиться не удалось"""
+        while True:
+            with self.lock:
+                si = self.idle.pop() if self.idle else None
+            if si is None:
+                return self.endpoint.connect()
+            if self._alive(si):
+                return si
+            disconnect_from_host(si, silent=True)
+
+    def release(self, si):
+        if si is None:
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(si)
+                return
+        disconnect_from_host(si)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for si in idle:
+            disconnect_from_host(si, silent=True)
+
+
+class SshPool:
+    """
+    SSH-сессии одного хоста: не более size одновременно, после использования
+    сессия остаётся открытой и переиспользуется следующим клонированием.
+    """
+
+    def __init__(self, endpoint, size=SSH_POOL_SIZE):
+        self.endpoint = endpoint
+        self.slots = threading.BoundedSemaphore(max(1, size))
+        self.lock = threading.Lock()
+        self.idle = []
+
+    @staticmethod
+    def _alive(ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    @contextlib.contextmanager
+    def session(self):
+        self.slots.acquire()
+        ssh = None
+        try:
+            with self.lock:
+                while self.idle and ssh is None:
+                    candidate = self.idle.pop()
+                    if self._alive(candidate):
+                        ssh = candidate
+                    else:
+                        candidate.close()
+            if ssh is None:
+                ssh = self.endpoint.connect_ssh()
+            yield ssh
+        finally:
+            if ssh is not None:
+                if self._alive(ssh):
+                    with self.lock:
+                        self.idle.append(ssh)
+                else:
+                    ssh.close()
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for ssh in idle:
+            try:
+                ssh.close()
+            except Exception:
+                pass
+
+
+class Endpoint:
+    """Хост ESXi / vCenter: параметры подключения, пулы vSphere и SSH, лимит параллельных шагов"""
+
+    def __init__(self, name, host, user=ESXI_USER, password=ESXI_PASSWORD, port=ESXI_PORT,
+                 ignore_ssl=IGNORE_SSL, ssh_host=None, ssh_user=SSH_USER, ssh_password=SSH_PASSWORD,
+                 ssh_port=SSH_PORT, max_parallel=ENDPOINT_MAX_PARALLEL, ssh_pool_size=SSH_POOL_SIZE,
+                 vsphere_pool_size=VSPHERE_POOL_SIZE):
+        self.name = name
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = int(port)
+        self.ignore_ssl = ignore_ssl
+        self.ssh_host = ssh_host or host
+        self.ssh_user = ssh_user
+        self.ssh_password = ssh_password
+        self.ssh_port = int(ssh_port)
+        self.max_parallel = max(1, int(max_parallel))
+        self.ssh_pool = SshPool(self, ssh_pool_size)
+        self.connections = ServiceInstancePool(self, vsphere_pool_size)
+
+    def connect(self, silent=False):
+        """Новое подключение к хосту или None (как connect_to_host); пул — self.connections"""
+        return connect_to_host(self.host, self.user, self.password, self.port, self.ignore_ssl, silent=silent)
+
+    def connect_ssh(self):
+        return connect_ssh(self.ssh_host, self.ssh_user, self.ssh_password, self.ssh_port)
+
+
+_endpoints = {DEFAULT_ENDPOINT: Endpoint(DEFAULT_ENDPOINT, ESXI_HOST, ssh_host=SSH_HOST)}
+_endpoints_path = None
+
+
+def init_endpoints(path):
+    """Загружает дополнительные хосты из json-файла (если он есть)"""
+    global _endpoints_path
+    _endpoints_path = path
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, mode='r', encoding='utf-8') as file:
+            data = json.load(file)
+        for params in data:
+            params = dict(params)
+            name = params.pop('name')
+            _endpoints[name] = Endpoint(name, **params)
+        print(f"[+] Загружен реестр хостов: {', '.join(f'{e.name} ({e.host})' for e in _endpoints.values())}")
+    except Exception as e:
+        print(f"[!] Не удалось загрузить реестр хостов {path}: {e}")
+
+
+def get_endpoint(name=None):
+    endpoint = _endpoints.get(name or DEFAULT_ENDPOINT)
+    if endpoint is None:
+        raise Exception(f"Хост '{name}' не описан в реестре хостов {_endpoints_path or ''}".rstrip())
+    return endpoint
+
+
+def all_endpoints():
+    return list(_endpoints.values())
+
+
+def endpoint_name(vm_config):
+    """Имя хоста строки CSV (столбец esxiHost), по умолчанию — хост из .env"""
+    return (vm_config or {}).get('ESXI_HOST_NAME') or DEFAULT_ENDPOINT
+
+
+def endpoint_for(vm_config):
+    return get_endpoint(endpoint_name(vm_config))
+
+
+def group_by_endpoint(vm_names, vm_config_map):
+    """{имя хоста: [имена ВМ]} — ВМ, отсутствующие в CSV, относятся к хосту по умолчанию"""
+    groups = {}
+    for vm_name in vm_names:
+        groups.setdefault(endpoint_name(vm_config_map.get(vm_name)), []).append(vm_name)
+    return groups
+
+
+def for_each_endpoint(names, func):
+    """
+    Выполняет func(имя хоста) для всех хостов параллельно.
+    Возвращает {имя хоста: (результат, ошибка)}.
+    """
+    names = list(names)
+    results = {}
+    if not names:
+        return results
+
+    def run(name):
+        try:
+            return name, (func(name), None)
+        except Exception as e:
+            return name, (None, e)
+
+    with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="endpoint") as pool:
+        results.update(pool.map(run, names))
+    return results
+
+
+def connect_endpoints(names):
+    """
+    Берёт подключения к хостам из их пулов (параллельно) и возвращает {имя хоста: si}.
+    Если к какому-то хосту подключиться не удалось, остальные подключения
+    возвращаются в пулы и выбрасывается ConnectionFault.
+    """
+    def connect(name):
+        si = get_endpoint(name).connections.acquire()
+        if si is None:
+            raise ConnectionFault(f"Не удалось подключиться к хосту {get_endpoint(name).host}")
+        return si
+
+    results = for_each_endpoint(names, connect)
+    connections = {name: si for name, (si, error) in results.items() if si is not None}
+    errors = [error for si, error in results.values() if error is not None]
+    if errors:
+        release_endpoints(connections)
+        raise errors[0]
+    return connections
+
+
+def release_endpoints(connections):
+    """Возвращает подключения {имя хоста: si} в пулы их хостов"""
+    for name, si in connections.items():
+        get_endpoint(name).connections.release(si)
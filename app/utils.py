@@ -22,7 +22,10 @@ def parse_vm_csv(csv_file):
                 'OS_USER_NAME': row.get('osUserName', ''),
                 'OS_USER_PASSWORD': row.get('osUserPassword', ''),
                 'TARGET_SNAPSHOT_NAME': row.get('targetSnapshotName', ''),
-                'TARGET_SNAPSHOT_DESCRIPTION': row.get('targetSnapshotDescription', '')
+                'TARGET_SNAPSHOT_DESCRIPTION': row.get('targetSnapshotDescription', ''),
+                'CUSTOMIZE_MODE': row.get('customizeMode', ''),
+                'BOOT_ORDER': row.get('bootOrder', ''),
+                'ESXI_HOST_NAME': row.get('esxiHost', '')
             }
             if config["TARGET_VM_NAME"]:
                 if not config["GROUP_NAME"]:
@@ -38,4 +41,12 @@ def parse_vm_csv(csv_file):
         if group_name not in groups:
             groups.append(group_name)
 
-    return vm_configs, groups
\ No newline at end of file
+    return vm_configs, groups
+
+
+def prefix_length(netmask):
+    """Длина префикса CIDR из маски в любом виде: 24 или 255.255.255.0"""
+    netmask = str(netmask)
+    if '.' in netmask:
+        return sum(bin(int(x)).count('1') for x in netmask.split('.'))
+    return int(netmask)
@@ -0,0 +1,346 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from vm_operations import prepare_clone_source, vm_delete
+from vm_power import power_state_watcher
+from vm_customize import customize_vm_os
+from vm_guest_ops import GuestAuthCache
+from vm_watch import GuestReadinessWatcher, TaskWatcher
+from vm_cancel import NEVER_CANCELLED, cancel_scope
+from vm_snapshot import create_snapshot, revert_to_snapshot, remove_snapshot
+
+CUSTOMIZE_MAX_PARALLEL = int(os.getenv("CUSTOMIZE_MAX_PARALLEL", "8"))
+SNAPSHOT_MAX_PARALLEL = int(os.getenv("SNAPSHOT_MAX_PARALLEL", "16"))
+SNAPSHOT_PER_DATASTORE = int(os.getenv("SNAPSHOT_PER_DATASTORE", "4"))
+DELETE_MAX_PARALLEL = int(os.getenv("DELETE_MAX_PARALLEL", "8"))
+
+
+def plan_clone_groups(vm_operations, vm_config_map):
+    """
+    Группирует клонируемые ВМ пакета по исходной ВМ и снапшоту.
+    Возвращает {(source_vm, snapshot): [target_vm, ...]} в порядке появления.
+    """
+    groups = {}
+    for vm_data in vm_operations:
+        if 'clone' not in vm_data.get('operations', []):
+            continue
+        config = vm_config_map.get(vm_data['vm'], {})
+        if not config.get('SOURCE_VM_NAME'):
+            continue
+        key = (config['SOURCE_VM_NAME'], config.get('SOURCE_SNAPSHOT_NAME') or '')
+        groups.setdefault(key, []).append(vm_data['vm'])
+    return groups
+
+
+def print_clone_groups(groups):
+    if not groups:
+        return
+    print(f"[*] Клонирование сгруппировано по исходным ВМ ({len(groups)} групп):")
+    for (source_vm_name, snapshot_name), targets in groups.items():
+        print(f"  • {source_vm_name}" + (f" @ {snapshot_name}" if snapshot_name else "") +
+              f" → {len(targets)} ВМ: {', '.join(targets)}")
+    print("=" * 70)
+
+
+class TemplatePreparationCache:
+    """
+    Подготовка исходных ВМ на время пакета операций: выполняется один раз
+    на пару (исходная ВМ, снапшот) и переиспользуется всеми клонами группы.
+    Результат сбрасывается, если конфигурация исходной ВМ изменилась.
+    """
+
+    def __init__(self, si):
+        self.si = si
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.prepared = {}
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def get(self, source_vm_name, snapshot_name=None):
+        key = (source_vm_name, snapshot_name or '')
+
+        with self._key_lock(key):
+            source = self.prepared.get(key)
+            if source and not self._is_stale(source):
+                print(f"[=] Исходная ВМ '{source_vm_name}' уже подготовлена в этом пакете")
+                return source
+
+            source = prepare_clone_source(self.si, source_vm_name, snapshot_name)
+            self.prepared[key] = source
+            return source
+
+    def _is_stale(self, source):
+        try:
+            if source['vm'].config.changeVersion != source['change_version']:
+                print(f"[!] Конфигурация исходной ВМ '{source['vm'].name}' изменилась, готовим заново")
+                return True
+            return False
+        except Exception:
+            # ВМ удалена или недоступна
+            return True
+
+    def invalidate(self, source_vm_name=None):
+        with self.lock:
+            if source_vm_name is None:
+                self.prepared.clear()
+            else:
+                for key in [k for k in self.prepared if k[0] == source_vm_name]:
+                    del self.prepared[key]
+
+
+class CustomizationExecutor:
+    """
+    Параллельная настройка гостевых ОС в пакете операций: не более max_workers ВМ
+    одновременно, один наблюдатель готовности и один кэш аутентификации на всех.
+    По каждой ВМ запоминаются длительности этапов (запуск, Tools, IP, настройка).
+    cancel_token — токен отмены сессии (vm_cancel), прерывающий ожидания настройки.
+    """
+
+    def __init__(self, si, max_workers=CUSTOMIZE_MAX_PARALLEL, cancel_token=None):
+        self.si = si
+        self.cancel_token = cancel_token or NEVER_CANCELLED
+        self.max_workers = max(1, max_workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="customize")
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.auth_cache = GuestAuthCache(si)
+        self.futures = {}
+        self.timings = {}
+
+    def _get_watcher(self):
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = GuestReadinessWatcher(self.si)
+            return self.watcher
+
+    def submit(self, vm, vm_config, on_done=None):
+        """
+        Ставит настройку ВМ в очередь и сразу возвращает Future.
+        on_done(vm_name, error) вызывается из рабочего потока по завершении.
+        """
+        vm_name = vm.name
+        timings = {}
+        with self.lock:
+            self.timings[vm_name] = timings
+
+        def run():
+            start_time = time.time()
+            error = None
+            try:
+                with cancel_scope(self.cancel_token):
+                    customize_vm_os(self.si, vm, vm_config, watcher=self._get_watcher(),
+                                    auth_cache=self.auth_cache, timings=timings)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                timings['total'] = time.time() - start_time
+                if on_done:
+                    on_done(vm_name, error)
+
+        future = self.pool.submit(run)
+        with self.lock:
+            self.futures[vm_name] = future
+        return future
+
+    def pending(self):
+        with self.lock:
+            return [name for name, future in self.futures.items() if not future.done()]
+
+    def wait(self):
+        """Дожидается завершения всех поставленных в очередь настроек"""
+        with self.lock:
+            futures = list(self.futures.values())
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def print_timings(self):
+        with self.lock:
+            timings = dict(self.timings)
+        if not timings:
+            return
+
+        def fmt(value):
+            return f"{value:6.0f}" if value is not None else "     —"
+
+        print(f"[*] Настройка гостевых ОС: {len(timings)} ВМ, до {self.max_workers} одновременно")
+        print(f"  {'ВМ'.ljust(24)} {'запуск':>6} {'Tools':>6} {'IP':>6} {'сеть':>6} {'скрипт':>6} {'всего':>6}  (сек)")
+        for vm_name, stages in timings.items():
+            print(f"  {vm_name[:24].ljust(24)} {fmt(stages.get('boot'))} {fmt(stages.get('tools'))} "
+                  f"{fmt(stages.get('ip'))} {fmt(stages.get('ready'))} {fmt(stages.get('customize'))} "
+                  f"{fmt(stages.get('total'))}")
+        print("=" * 70)
+
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+        with self.lock:
+            watcher, self.watcher = self.watcher, None
+        if watcher:
+            watcher.close()
+        self.auth_cache.release_all()
+
+
+class DeletionQueue:
+    """
+    Очередь удаления ВМ пакета: удаления идут в фоне (не более max_workers
+    одновременно), завершение Destroy_Task отслеживается одним TaskWatcher.
+    Зависимые операции (повторное клонирование под тем же именем) ждут
+    фактического удаления через wait_for().
+    cancel_token — токен отмены сессии (vm_cancel).
+    """
+
+    def __init__(self, si, max_workers=DELETE_MAX_PARALLEL, cancel_token=None):
+        self.si = si
+        self.cancel_token = cancel_token or NEVER_CANCELLED
+        self.pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="delete")
+        self.lock = threading.Lock()
+        self.task_watcher = None
+        self.power_watcher = None
+        self.futures = {}
+        self.results = {}
+
+    def _get_watchers(self):
+        with self.lock:
+            if self.task_watcher is None:
+                self.task_watcher = TaskWatcher(self.si)
+                self.power_watcher = power_state_watcher(self.si)
+            return self.task_watcher, self.power_watcher
+
+    def submit(self, vm, on_done=None):
+        """
+        Ставит удаление ВМ в очередь и сразу возвращает Future.
+        on_done(vm_name, error) вызывается из рабочего потока по завершении.
+        """
+        vm_name = vm.name
+
+        def run():
+            start_time = time.time()
+            error = None
+            try:
+                task_watcher, power_watcher = self._get_watchers()
+                with cancel_scope(self.cancel_token):
+                    vm_delete(vm, task_watcher, power_watcher)
+            except Exception as e:
+                print(f"[X] Ошибка при удалении ВМ '{vm_name}': {e}")
+                error = e
+                raise
+            finally:
+                with self.lock:
+                    self.results[vm_name] = {
+                        'status': 'error' if error else 'success',
+                        'message': str(error) if error else 'ВМ удалена',
+                        'seconds': round(time.time() - start_time, 1)
+                    }
+                if on_done:
+                    on_done(vm_name, error)
+
+        future = self.pool.submit(run)
+        with self.lock:
+            self.futures[vm_name] = future
+        return future
+
+    def wait_for(self, vm_name, timeout=None):
+        """
+        Если ВМ с таким именем удаляется, дожидается завершения удаления.
+        Неудачное удаление выбрасывается исключением: создавать ВМ с тем же
+        именем поверх неудалённой нельзя.
+        """
+        with self.lock:
+            future = self.futures.get(vm_name)
+        if future is None:
+            return
+        if not future.done():
+            print(f"[*] Ожидаем завершения удаления ВМ '{vm_name}'...")
+        try:
+            future.result(timeout)
+        except Exception as e:
+            raise Exception(f"Удаление ВМ '{vm_name}' не завершилось: {e}")
+
+    def pending(self):
+        with self.lock:
+            return [name for name, future in self.futures.items() if not future.done()]
+
+    def wait(self):
+        """Дожидается завершения всех удалений и возвращает {имя ВМ: результат}"""
+        with self.lock:
+            futures = list(self.futures.values())
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        with self.lock:
+            return dict(self.results)
+
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+        with self.lock:
+            watchers, self.task_watcher, self.power_watcher = (self.task_watcher, self.power_watcher), None, None
+        for watcher in watchers:
+            if watcher:
+                watcher.close()
+
+
+def _vm_datastore_name(vm):
+    """Datastore, на котором лежит .vmx ВМ (там же создаются дельта-диски снапшотов)"""
+    path = vm.config.files.vmPathName or ''
+    return path[1:path.index(']')] if path.startswith('[') and ']' in path else ''
+
+
+def run_bulk_snapshots(vms, action, snapshot_name, description="", memory=False, quiesce=False,
+                       remove_children=False, max_workers=SNAPSHOT_MAX_PARALLEL,
+                       per_datastore=SNAPSHOT_PER_DATASTORE):
+    """
+    Создание/откат/удаление снапшота сразу на многих ВМ.
+    Всего выполняется не более max_workers операций одновременно
+    и не более per_datastore на один datastore.
+    Возвращает {имя ВМ: {'status': 'success'|'error', 'message', 'seconds'}}.
+    """
+    if action not in ('create', 'revert', 'remove'):
+        raise ValueError(f"Неизвестное действие со снапшотами: {action}")
+
+    datastore_locks = {}
+    datastore_locks_lock = threading.Lock()
+    revert_stats = {'performed': 0, 'skipped': 0}
+    results = {}
+
+    def datastore_semaphore(name):
+        with datastore_locks_lock:
+            return datastore_locks.setdefault(name, threading.BoundedSemaphore(max(1, per_datastore)))
+
+    def run(vm):
+        vm_name = vm.name
+        start_time = time.time()
+        try:
+            with datastore_semaphore(_vm_datastore_name(vm)):
+                if action == 'create':
+                    create_snapshot(vm, {'snapshot_name': snapshot_name},
+                                    memory=memory, quiesce=quiesce, description=description)
+                elif action == 'revert':
+                    revert_to_snapshot(vm, snapshot_name, revert_stats)
+                else:
+                    remove_snapshot(vm, snapshot_name, remove_children=remove_children)
+            results[vm_name] = {'status': 'success', 'message': '', 'seconds': round(time.time() - start_time, 1)}
+        except Exception as e:
+            print(f"[X] {vm_name}: {e}")
+            results[vm_name] = {'status': 'error', 'message': str(e), 'seconds': round(time.time() - start_time, 1)}
+
+    print(f"[*] Снапшоты ({action} '{snapshot_name}'): {len(vms)} ВМ, до {max_workers} одновременно, "
+          f"до {per_datastore} на datastore")
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="snapshot") as pool:
+        list(pool.map(run, vms))
+
+    failed = sum(1 for result in results.values() if result['status'] == 'error')
+    print(f"[+] Снапшоты ({action}): успешно {len(results) - failed}, ошибок {failed}, "
+          f"{time.time() - start_time:.0f} сек" +
+          (f", откатов пропущено: {revert_stats['skipped']}" if action == 'revert' else ""))
+    print("=" * 70)
+    return results
@@ -0,0 +1,99 @@
+import threading
+import contextlib
+from pyVmomi import vim
+
+# Кооперативная отмена пакета операций. У каждой сессии свой CancelToken;
+# рабочие потоки сессии выполняют шаги внутри cancel_scope(token), а все
+# длительные ожидания (задачи vSphere, PropertyCollector, повторы, SSH,
+# guest operations) берут токен через current_token() и при отмене
+# прерываются исключением OperationCancelled. Отмена также отменяет
+# выполняющиеся задачи vSphere (CancelTask) и закрывает SSH-каналы.
+
+
+class OperationCancelled(Exception):
+    """Операция прервана пользователем"""
+
+
+class CancelToken:
+    """Признак отмены и обработчики, вызываемые в момент отмены"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_id = 0
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"[!] Ошибка при отмене операции: {e}")
+
+    def check(self, description="Операция"):
+        if self._event.is_set():
+            raise OperationCancelled(f"{description}: прервано пользователем")
+
+    def sleep(self, seconds, description="Операция"):
+        """time.sleep, прерываемый отменой"""
+        if self._event.wait(max(seconds, 0)):
+            raise OperationCancelled(f"{description}: прервано пользователем")
+
+    @contextlib.contextmanager
+    def on_cancel(self, callback):
+        """На время блока регистрирует callback; если отмена уже была — вызывает его сразу"""
+        with self._lock:
+            handle = self._next_id
+            self._next_id += 1
+            if not self._event.is_set():
+                self._callbacks[handle] = callback
+                callback = None
+        if callback is not None:
+            callback()
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._callbacks.pop(handle, None)
+
+
+# Токен вне сессии (массовые операции, одиночные вызовы) — никогда не отменяется
+NEVER_CANCELLED = CancelToken()
+
+_local = threading.local()
+
+
+def current_token():
+    """Токен отмены, действующий в текущем потоке"""
+    return getattr(_local, 'token', None) or NEVER_CANCELLED
+
+
+@contextlib.contextmanager
+def cancel_scope(token):
+    """Делает token текущим для ожиданий в этом потоке"""
+    previous = getattr(_local, 'token', None)
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def cancel_vsphere_task(task):
+    """Отменяет задачу vSphere, если она ещё выполняется и допускает отмену"""
+    try:
+        info = task.info
+        if info.cancelable and info.state in (vim.TaskInfo.State.queued, vim.TaskInfo.State.running):
+            print(f"[*] Отменяем задачу vSphere: {info.descriptionId or info.key}")
+            task.CancelTask()
+    except Exception as e:
+        print(f"[!] Не удалось отменить задачу vSphere: {e}")
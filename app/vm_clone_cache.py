@@ -0,0 +1,250 @@
+import os
+import json
+import hashlib
+import threading
+import contextlib
+from datetime import datetime
+from esxi_connect import ssh_exec
+from vm_cancel import OperationCancelled
+from esxi_hosts import DEFAULT_ENDPOINT
+
+# Кэш подготовленных базовых дисков ("золотых образов") на datastore.
+# Ключ — (исходная ВМ, снапшот, datastore, диск): содержимое диска снапшота
+# неизменно, пока снапшот существует, поэтому копию можно переиспользовать.
+# Записи помечены хостом (esxi_hosts): бюджет и вытеснение считаются по каждому
+# хосту отдельно и выполняются через SSH этого хоста.
+# Образ, из которого сейчас копируется диск клона, помечен как используемый
+# и не вытесняется, пока копирование не закончится.
+# Кэш выигрывает, только когда исходный диск лежит на другом (медленном или
+# удалённом) datastore: каждый клон всё равно полная копия, а первый клон
+# снапшота копирует диск дважды. Поэтому по умолчанию кэш выключен, а для
+# дисков, уже лежащих на целевом datastore, не используется вовсе.
+
+CLONE_CACHE_ENABLED = os.getenv("CLONE_CACHE_ENABLED", "false").lower() == "true"
+CLONE_CACHE_DIR_NAME = os.getenv("CLONE_CACHE_DIR", ".vm-manager-cache")
+CLONE_CACHE_MAX_GB = float(os.getenv("CLONE_CACHE_MAX_GB", "200"))
+
+_cache_lock = threading.Lock()
+_key_locks = {}
+_entries = {}
+_in_use = {}  # ключ → число клонирований, копирующих из образа прямо сейчас
+_index_path = None
+
+
+def init_clone_cache(index_path):
+    """Загружает индекс кэша из json-файла (рядом с exe)"""
+    global _index_path, _entries
+    _index_path = index_path
+
+    if not os.path.exists(index_path):
+        return
+
+    try:
+        with open(index_path, mode='r', encoding='utf-8') as file:
+            _entries = json.load(file)
+        print(f"[+] Загружен индекс кэша образов: {len(_entries)} записей")
+    except Exception as e:
+        print(f"[!] Не удалось загрузить индекс кэша образов {index_path}: {e}")
+        _entries = {}
+
+
+def _save_index():
+    if not _index_path:
+        return
+    try:
+        with open(_index_path, mode='w', encoding='utf-8') as file:
+            json.dump(_entries, file, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"[!] Не удалось сохранить индекс кэша образов: {e}")
+
+
+def cache_key(source_uuid, snapshot_id, datastore_name, disk_key):
+    raw = f"{source_uuid}|{snapshot_id}|{datastore_name}|{disk_key}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def _cache_dir(datastore_name, key):
+    return f"/vmfs/volumes/{datastore_name}/{CLONE_CACHE_DIR_NAME}/{key}"
+
+
+def _key_lock(key):
+    with _cache_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+@contextlib.contextmanager
+def get_cached_disk(ssh, source_vm, snapshot_tree, datastore_name, disk_key, source_vmdk,
+                    endpoint=DEFAULT_ENDPOINT):
+    """
+    Выдаёт на время блока with путь к закэшированной копии диска снапшота
+    на целевом datastore; пока блок выполняется, образ не вытесняется.
+    При первом обращении копия создаётся через vmkfstools (thin).
+    Если кэш отключён или исходный диск уже на целевом datastore — выдаёт исходный путь.
+    """
+    if not CLONE_CACHE_ENABLED or source_vmdk.startswith(f"/vmfs/volumes/{datastore_name}/"):
+        yield source_vmdk
+        return
+
+    key, cached_vmdk = _acquire_cached_disk(ssh, source_vm, snapshot_tree, datastore_name, disk_key,
+                                            source_vmdk, endpoint)
+    try:
+        yield cached_vmdk
+    finally:
+        with _cache_lock:
+            _in_use[key] -= 1
+            if not _in_use[key]:
+                del _in_use[key]
+
+
+def _mark_in_use(key):
+    with _cache_lock:
+        _in_use[key] = _in_use.get(key, 0) + 1
+
+
+def _acquire_cached_disk(ssh, source_vm, snapshot_tree, datastore_name, disk_key, source_vmdk, endpoint):
+    """Находит или создаёт образ и помечает его используемым. Возвращает (ключ, путь)"""
+
+    key = cache_key(source_vm.config.instanceUuid, snapshot_tree.snapshot._moId, datastore_name, disk_key)
+    cached_vmdk = f"{_cache_dir(datastore_name, key)}/base.vmdk"
+
+    with _key_lock(key):
+        with _cache_lock:
+            entry = _entries.get(key)
+
+        if entry:
+            exit_code, _, _ = ssh_exec(ssh, f'test -f "{cached_vmdk}"')
+            if exit_code == 0:
+                with _cache_lock:
+                    entry['last_used'] = datetime.now().isoformat(timespec='seconds')
+                    entry['hits'] = entry.get('hits', 0) + 1
+                    _save_index()
+                print(f"[+] Используем закэшированный образ диска: {cached_vmdk}")
+                _mark_in_use(key)
+                return key, cached_vmdk
+
+            print(f"[!] Закэшированный образ {cached_vmdk} отсутствует на datastore, создаём заново")
+            with _cache_lock:
+                _entries.pop(key, None)
+
+        print(f"[*] Создаём закэшированный образ диска на datastore '{datastore_name}'...")
+        ssh_exec(ssh, f'mkdir -p "{_cache_dir(datastore_name, key)}"', check=True)
+        try:
+            exit_code, output, error_out = ssh_exec(ssh, f'vmkfstools -i "{source_vmdk}" "{cached_vmdk}" -d thin',
+                                                    kill_on_cancel=True)
+        except OperationCancelled:
+            # Недокопированный образ в кэше не оставляем
+            ssh_exec(ssh, f'rm -rf "{_cache_dir(datastore_name, key)}"')
+            raise
+        if exit_code != 0:
+            ssh_exec(ssh, f'rm -rf "{_cache_dir(datastore_name, key)}"')
+            raise Exception(f"Не удалось создать образ диска в кэше: {error_out or output}")
+
+        now = datetime.now().isoformat(timespec='seconds')
+        with _cache_lock:
+            _entries[key] = {
+                'key': key,
+                'endpoint': endpoint,
+                'source_vm': source_vm.name,
+                'source_uuid': source_vm.config.instanceUuid,
+                'snapshot_id': snapshot_tree.snapshot._moId,
+                'snapshot_name': snapshot_tree.name,
+                'datastore': datastore_name,
+                'disk_key': disk_key,
+                'path': cached_vmdk,
+                'size_bytes': _disk_usage(ssh, datastore_name, key),
+                'created': now,
+                'last_used': now,
+                'hits': 0
+            }
+            _save_index()
+
+        print(f"[+] Образ диска добавлен в кэш: {cached_vmdk}")
+        _mark_in_use(key)
+
+    try:
+        _evict_over_budget(ssh, endpoint, keep_key=key)
+    except Exception as e:
+        print(f"[!] Не удалось вытеснить старые образы из кэша: {e}")
+    return key, cached_vmdk
+
+
+def _disk_usage(ssh, datastore_name, key):
+    exit_code, output, _ = ssh_exec(ssh, f'du -k "{_cache_dir(datastore_name, key)}" | tail -n1')
+    try:
+        return int(output.split()[0]) * 1024 if exit_code == 0 else 0
+    except (ValueError, IndexError):
+        return 0
+
+
+def _remove_entry(ssh, entry):
+    cache_dir = _cache_dir(entry['datastore'], entry['key'])
+    ssh_exec(ssh, f'vmkfstools -U "{entry["path"]}"')
+    ssh_exec(ssh, f'rm -rf "{cache_dir}"')
+    print(f"[-] Удалён образ из кэша: {entry['source_vm']} / {entry['snapshot_name']} ({entry['datastore']})")
+
+
+def entry_endpoint(entry):
+    return entry.get('endpoint') or DEFAULT_ENDPOINT
+
+
+def _evict_over_budget(ssh, endpoint=DEFAULT_ENDPOINT, keep_key=None):
+    """Вытесняет давно не использованные образы хоста (LRU), пока кэш не уложится в бюджет"""
+    budget = int(CLONE_CACHE_MAX_GB * 1024 ** 3)
+
+    with _cache_lock:
+        lru = sorted((e for e in _entries.values() if entry_endpoint(e) == endpoint), key=lambda e: e['last_used'])
+        total = sum(e.get('size_bytes', 0) for e in lru)
+        victims = []
+        for entry in lru:
+            if total <= budget:
+                break
+            if entry['key'] == keep_key or entry['key'] in _in_use:
+                continue
+            victims.append(entry)
+            total -= entry.get('size_bytes', 0)
+
+    for entry in victims:
+        _remove_if_unused(ssh, entry)
+
+
+def _remove_if_unused(ssh, entry):
+    """Удаляет образ, если его не начали использовать, пока ждали блокировку ключа"""
+    with _key_lock(entry['key']):
+        with _cache_lock:
+            if entry['key'] in _in_use:
+                return False
+        _remove_entry(ssh, entry)
+        with _cache_lock:
+            _entries.pop(entry['key'], None)
+            _save_index()
+    return True
+
+
+def evict_cached_disks(ssh, key=None, endpoint=DEFAULT_ENDPOINT):
+    """
+    Удаляет из кэша хоста один образ (по ключу) или все образы. Возвращает число удалённых.
+    Образы, из которых сейчас копируются диски клонов, пропускаются.
+    """
+    with _cache_lock:
+        victims = [e for e in _entries.values()
+                   if entry_endpoint(e) == endpoint and (key is None or e['key'] == key)]
+
+    removed = 0
+    for entry in victims:
+        if _remove_if_unused(ssh, entry):
+            removed += 1
+        else:
+            print(f"[!] Образ {entry['source_vm']} / {entry['snapshot_name']} используется клонированием, пропущен")
+    return removed
+
+
+def clone_cache_state():
+    """Состояние кэша для API"""
+    with _cache_lock:
+        entries = sorted(_entries.values(), key=lambda e: e['last_used'], reverse=True)
+        return {
+            'enabled': CLONE_CACHE_ENABLED,
+            'max_bytes': int(CLONE_CACHE_MAX_GB * 1024 ** 3),
+            'total_bytes': sum(e.get('size_bytes', 0) for e in entries),
+            'entries': [dict(e) for e in entries]
+        }
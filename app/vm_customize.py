@@ -2,14 +2,25 @@ from pyVmomi import vim
 import time
 import platform
 import subprocess
-from vm_operations import vm_power_on, vm_power_off, vm_detect_os_type, wait_for_task
-
-
-def customize_vm_os(service_instance, vm, vm_config):
+import socket
+import threading
+import shlex
+from vm_guest_ops import GuestAuthCache, run_guest_script
+from vm_guestinfo import uses_guestinfo, customize_vm_guestinfo
+from utils import prefix_length
+from vm_operations import vm_power_on, vm_detect_os_type
+from vm_watch import GuestReadinessWatcher, guest_ip_address
+from vm_cancel import current_token, OperationCancelled
+
+
+def customize_vm_os(service_instance, vm, vm_config, watcher=None, auth_cache=None, timings=None):
     """
     Настраивает существующую ВМ после запуска
     :param service_instance: подключение к ESXi
     :param vm: объект виртуальной машины (vim.VirtualMachine)
+    :param watcher: общий GuestReadinessWatcher (при параллельной настройке многих ВМ)
+    :param auth_cache: общий GuestAuthCache для guest operations
+    :param timings: словарь, в который записываются длительности этапов (сек)
     :param static_ip: статический IP
     :param netmask: маска сети
     :param gateway: шлюз
@@ -32,128 +43,154 @@ def customize_vm_os(service_instance, vm, vm_config):
     if not vm:
         raise ValueError("Не удается произвести настройку ВМ. Не передан объект виртуальной машины")
 
-    os_type = vm_detect_os_type(vm)
-    print(f"[*] Обнаружена ОС: {os_type}")
 
+    if timings is None:
+        timings = {}
+
+    # Режим cloud-init: ОС настраивает себя сама по guestinfo, ждать Tools не нужно
+    if uses_guestinfo(vm_config):
+        customize_vm_guestinfo(vm, vm_config, timings)
+        return
 
     # Запускаем ВМ если она выключена
+    stage_start = time.time()
     if vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
-        print("[*] Запускаем ВМ для настройки...")
+        print(f"[*] Запускаем ВМ {vm.name} для настройки...")
         vm_power_on(vm)
+    timings['boot'] = time.time() - stage_start
 
     # Ожидаем полной инициализации гостевой ОС
-    wait_for_guest_ready(vm, service_instance, timeout=300)
-
-    # Если указаны сетевые настройки
-    if os_type == 'windows':
-        customize_windows(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname)
-    elif os_type in ['ubuntu', 'debian']:
-        customize_ubuntu_debian(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname)
-    elif os_type in ['centos', 'redhat']:
-        customize_centos(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname)
-    elif os_type == 'linux':
-        customize_generic_linux(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname)
-    else:
-        print(f"[!] Настройка для ОС {os_type} не реализована")
+    wait_for_guest_ready(vm, service_instance, timeout=300, watcher=watcher, timings=timings)
+
+    # ОС определяем после загрузки: VMware Tools уточняют дистрибутив
+    os_type = vm_detect_os_type(vm)
+    print(f"[*] {vm.name}: обнаружена ОС: {os_type}")
+
+    customizer = OS_CUSTOMIZERS.get(os_type)
+    if not customizer:
+        raise Exception(f"Настройка для ОС {os_type} не реализована")
+
+    stage_start = time.time()
+    customizer(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname, auth_cache)
+    timings['customize'] = time.time() - stage_start
 
-    print("[*] Пауза 10 секунд...")
-    time.sleep(10)
     print("=" * 70)
 
 
-def wait_for_guest_ready(vm, service_instance, timeout=300):
+def wait_for_guest_ready(vm, service_instance, timeout=300, watcher=None, timings=None):
     """
-    Улучшенное ожидание готовности гостевой ОС с пересозданием объекта ВМ.
+    Ожидание готовности гостевой ОС по уведомлениям PropertyCollector:
+    VMware Tools запущены, guest operations доступны, получен IP и хост отвечает по сети.
+    watcher — общий GuestReadinessWatcher (для ожидания многих ВМ одним наблюдателем).
+    timings — словарь для времени (сек) до событий 'tools', 'guest_ops', 'ip', 'ready'.
+    Возвращает IP-адрес гостевой ОС.
     """
-    def refresh_vm(vm, service_instance):
-        content = service_instance.RetrieveContent()
-        vm_name = vm.name
-        vm_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
-        try:
-            for new_vm in vm_view.view:
-                if new_vm.name == vm_name:
-                    return new_vm
-        finally:
-            vm_view.Destroy()
-        raise Exception(f"Не удалось обновить объект VM: {vm.name}")
-
-    print("[*] Расширенная проверка готовности гостевой ОС...")
+    own_watcher = watcher is None
+    if own_watcher:
+        watcher = GuestReadinessWatcher(service_instance)
+
+    print(f"[*] Ожидаем готовности гостевой ОС ВМ '{vm.name}'...")
     start_time = time.time()
-    last_report_time = start_time
-    tools_ready = False
-    ip_detected = False
-    ping_success = False
+    reported = set()
+    if timings is None:
+        timings = {}
+
+    def report(values):
+        if GuestReadinessWatcher.tools_running(values) and 'tools' not in reported:
+            reported.add('tools')
+            timings['tools'] = time.time() - start_time
+            print(f"[+] {vm.name}: VMware Tools работают ({time.time() - start_time:.0f} сек)")
+        if GuestReadinessWatcher.guest_ops_ready(values) and 'ops' not in reported:
+            reported.add('ops')
+            timings['guest_ops'] = time.time() - start_time
+            print(f"[+] {vm.name}: guest operations доступны ({time.time() - start_time:.0f} сек)")
+        ip = guest_ip_address(values)
+        if ip and 'ip' not in reported:
+            reported.add('ip')
+            timings['ip'] = time.time() - start_time
+            print(f"[+] {vm.name}: обнаружен IP {ip} ({time.time() - start_time:.0f} сек)")
+        return ip
+
+    def guest_ready(values):
+        ip = report(values)
+        return GuestReadinessWatcher.tools_running(values) and GuestReadinessWatcher.guest_ops_ready(values) and ip
 
-    while time.time() - start_time < timeout:
-        try:
-            vm = refresh_vm(vm, service_instance)
-            current_time = time.time()
-
-            # Проверка 1: VMware Tools
-            tools_status = getattr(vm.guest, 'toolsRunningStatus', 'guestToolsNotRunning')
-            if tools_status == 'guestToolsRunning':
-                if not tools_ready:
-                    print("[+] VMware Tools работают")
-                tools_ready = True
-
-            # Проверка 2: Получен IP-адрес
-            ip_address = None
-            if tools_ready and vm.guest and vm.guest.net:
-                for nic in vm.guest.net:
-                    if hasattr(nic, 'ipConfig') and nic.ipConfig:
-                        for ip in nic.ipConfig.ipAddress:
-                            if ip.state == 'preferred':
-                                ip_address = ip.ipAddress
-                                break
-                    elif nic.ipAddress:
-                        # fallback для старых версий ESXi
-                        ip_address = nic.ipAddress[0]
-                    if ip_address:
-                        break
-                if ip_address:
-                    if not ip_detected:
-                        print(f"[+] Обнаружен IP: {ip_address}")
-                    ip_detected = True
-
-            # Проверка 3: ping
-            if ip_address and not ping_success:
-                if _ping_host(ip_address):
-                    print(f"[+] Успешный ping: {ip_address}")
-                    ping_success = True
-
-            # Все проверки пройдены
-            if tools_ready and ip_detected and ping_success:
-                print("[+++] Гостевая ОС полностью готова")
-                return True
-
-            # Периодический отчёт
-            if current_time - last_report_time > 30:
-                status = {
-                    "Tools": "Ready" if tools_ready else "Waiting",
-                    "IP": ip_address or "Waiting",
-                    "Ping": "Success" if ping_success else "Waiting"
-                }
-                print(f"[*] Текущий статус: {status}")
-                last_report_time = current_time
-
-            time.sleep(5)
-
-        except Exception as e:
-            print(f"[!] Ошибка проверки состояния: {str(e)}")
-            time.sleep(10)
+    try:
+        ip_address = None
+        while True:
+            remaining = timeout - (time.time() - start_time)
+            if remaining <= 0:
+                break
+
+            # Ждём событий Tools/IP, просыпаясь не реже раза в 30 сек для отчёта
+            if not ip_address:
+                if watcher.wait_until(vm, guest_ready, min(remaining, 30)):
+                    ip_address = guest_ip_address(watcher.get(vm))
+                else:
+                    print(f"[*] {vm.name}: текущий статус: "
+                          f"Tools={'Ready' if 'tools' in reported else 'Waiting'}, "
+                          f"GuestOps={'Ready' if 'ops' in reported else 'Waiting'}, "
+                          f"IP={'Ready' if 'ip' in reported else 'Waiting'}")
+                    continue
+
+            # IP известен — проверяем доступность по сети
+            if _probe_host(ip_address):
+                timings['ready'] = time.time() - start_time
+                print(f"[+++] {vm.name}: гостевая ОС полностью готова ({time.time() - start_time:.0f} сек)")
+                return ip_address
+            current_token().sleep(1, f"Ожидание готовности ВМ '{vm.name}'")
+
+            # IP мог смениться (DHCP → статический)
+            ip_address = guest_ip_address(watcher.get(vm)) or ip_address
+
+    finally:
+        if own_watcher:
+            watcher.close()
 
     # Подробный отчёт о таймауте
     problems = []
-    if not tools_ready:
+    if 'tools' not in reported:
         problems.append("VMware Tools не работают")
-    if not ip_detected:
+    if 'ops' not in reported:
+        problems.append("guest operations недоступны")
+    if 'ip' not in reported:
         problems.append("IP не получен")
-    if not ping_success:
-        problems.append("ping не проходит")
+    elif ip_address:
+        problems.append("хост не отвечает по сети")
 
     raise Exception(f"Таймаут ожидания готовности гостевой ОС: {', '.join(problems)}")
 
 
+# Порты, открытого или закрытого ответа на которых достаточно, чтобы считать хост живым
+_PROBE_PORTS = (22, 3389, 5985, 445, 135)
+
+
+def _probe_host(ip_address, timeout=1):
+    """
+    Проверяет доступность хоста: параллельные TCP-подключения к типовым портам,
+    при отсутствии ответа — ICMP ping.
+    """
+    alive = threading.Event()
+
+    def try_port(port):
+        try:
+            with socket.create_connection((ip_address, port), timeout=timeout):
+                alive.set()
+        except ConnectionRefusedError:
+            # RST пришёл — хост в сети, просто порт закрыт
+            alive.set()
+        except OSError:
+            pass
+
+    threads = [threading.Thread(target=try_port, args=(port,), daemon=True) for port in _PROBE_PORTS]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout + 0.5)
+
+    return alive.is_set() or _ping_host(ip_address, timeout)
+
+
 def _ping_host(ip_address, timeout=2):
     """Проверяет доступность хоста через ping"""
     try:
@@ -162,91 +199,184 @@ def _ping_host(ip_address, timeout=2):
         else:
             command = f"ping -c 1 -W {timeout} {ip_address}"
 
-        return subprocess.call(command,
+        return subprocess.call(command.split(),
                                stdout=subprocess.DEVNULL,
                                stderr=subprocess.DEVNULL) == 0
     except:
         return False
 
 
+# Скрипт настройки загружается в гостевую ОС одним файлом и выполняется одним процессом
+_LINUX_SCRIPT_PATH = '/tmp/esxi-vm-manager-customize.sh'
+_WINDOWS_SCRIPT_PATH = 'C:\\Windows\\Temp\\esxi-vm-manager-customize.ps1'
+_CMD_PATH = 'C:\\Windows\\System32\\cmd.exe'
+_POWERSHELL_PATH = 'C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe'
 
-def customize_windows(vm, static_ip, netmask, gateway, dns, username, password, si, hostname):
-    """Настройка Windows ВМ"""
-    print("[*] Начинаем настройку Windows ВМ")
-
-    ps_script = f"""
-    # Настройка сети
-    $adapter = Get-NetAdapter | Where-Object {{ $_.Status -eq 'Up' }}
-    Write-host $adapter.ifIndex
-        
-    if ($adapter) {{
-        Set-NetIPInterface -InterfaceIndex $adapter.ifIndex -Dhcp Disabled
-        
-        # Очистка старых IP
-        Get-NetIPAddress -InterfaceIndex $adapter.ifIndex -ErrorAction SilentlyContinue | Remove-NetIPAddress -Confirm:$false -ErrorAction SilentlyContinue
-        
-        # Очистка шлюза
-        Remove-NetRoute -InterfaceIndex $adapter.ifIndex -DestinationPrefix "0.0.0.0/0" -Confirm:$false -ErrorAction SilentlyContinue
-        
-        # Сброс всех DNS-серверов
-        Set-DnsClientServerAddress -InterfaceIndex $adapter.ifIndex -ResetServerAddresses
-        
-        # Установка нового IP и шлюза
-        New-NetIPAddress -InterfaceIndex $adapter.ifIndex -IPAddress {static_ip} -PrefixLength {netmask} -DefaultGateway {gateway}
-        
-        # Настройка DNS
-        Set-DnsClientServerAddress -InterfaceIndex $adapter.ifIndex -ServerAddresses '{dns}'
-    }}
-
-    # Настройка hostname
-    Rename-Computer -NewName '{hostname}' -Force -PassThru
-    """
-
-
-    try:
-        _execute_guest_command(
-            vm,
-            "C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe",
-            f"-Command \"{ps_script}\"",
-            username or "Administrator",
-            password,
-            si
-        )
-    except Exception as e:
-        print(f"[X] Ошибка: {e}")
+# Обработчики настройки по типу ОС из vm_detect_os_type.
+# Сигнатура: (vm, static_ip, netmask, gateway, dns, username, password, si, hostname, auth_cache)
+OS_CUSTOMIZERS = {}
 
-    time.sleep(10)
-    print("[+] Настройка Windows завершена")
 
+def register_customizer(*os_types):
+    """Регистрирует обработчик настройки для перечисленных типов ОС"""
+    def decorator(func):
+        for os_type in os_types:
+            OS_CUSTOMIZERS[os_type] = func
+        return func
+    return decorator
 
-def customize_ubuntu_debian(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname):
-    """Настройка Ubuntu/Debian ВМ"""
-    print("[*] Начинаем настройку Ubuntu/Debian ВМ")
 
-    print("[*] Настраиваем hostname...")
-    # Установка /etc/hostname
-    cmd = f"-c 'echo \"{password}\" | sudo -S sh -c \"echo \\\"{hostname}\\\" > /etc/hostname\"'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    # Обновление /etc/hosts
-    cmd = f"-c 'echo \"{password}\" | sudo -S sh -c \"sed -i \\\"/127.0.1.1/d\\\" /etc/hosts && echo \\\"127.0.1.1 {hostname}\\\" >> /etc/hosts\"'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    # Применение hostname
-    cmd = f"-c 'echo \"{password}\" | sudo -S hostnamectl set-hostname {hostname}'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
+@register_customizer('windows')
+def customize_windows(vm, static_ip, netmask, gateway, dns, username, password, si, hostname, auth_cache=None):
+    """Настройка Windows ВМ"""
+    print(f"[*] Начинаем настройку Windows ВМ {vm.name}")
 
-    print("[+] Настройка hostname завершена")
+    script = render_windows_script(static_ip, netmask, gateway, dns, hostname)
+    stdout_path, stderr_path = _output_paths(_WINDOWS_SCRIPT_PATH)
+    # cmd.exe нужен только для перенаправления вывода PowerShell в файлы
+    command = (f'{_POWERSHELL_PATH} -NoProfile -NonInteractive -ExecutionPolicy Bypass '
+               f'-File "{_WINDOWS_SCRIPT_PATH}" > "{stdout_path}" 2> "{stderr_path}"')
+    try:
+        _run_customization_script(si, vm, username or "Administrator", password,
+                                  _WINDOWS_SCRIPT_PATH, script, _CMD_PATH, f'/c "{command}"', auth_cache)
+    except OperationCancelled:
+        raise
+    except Exception as e:
+        print(f"[X] Ошибка: {e}")
+        return
+
+    print(f"[+] Настройка Windows ВМ {vm.name} завершена")
+
+
+@register_customizer('ubuntu')
+def customize_ubuntu(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname, auth_cache=None):
+    """Настройка Ubuntu ВМ (netplan)"""
+    print(f"[*] Начинаем настройку Ubuntu ВМ {vm.name}")
+
+    script = render_linux_script(
+        _hostname_section(hostname, '127.0.1.1'),
+        _netplan_section(static_ip, netmask, gateway, dns),
+        # Выключение откладываем, чтобы скрипт успел завершиться и вернуть код
+        "nohup sh -c 'sleep 5; shutdown -h now' >/dev/null 2>&1 &"
+    )
+    _run_linux_script(service_instance, vm, username, password, script, auth_cache)
+    print(f"[+] Настройка Ubuntu ВМ {vm.name} завершена")
+
+
+@register_customizer('debian', 'astra')
+def customize_debian(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname, auth_cache=None):
+    """Настройка Debian/Astra Linux ВМ: netplan, NetworkManager или /etc/network/interfaces"""
+    print(f"[*] Начинаем настройку Debian/Astra ВМ {vm.name}")
+
+    script = render_linux_script(
+        _hostname_section(hostname, '127.0.1.1'),
+        _network_section(static_ip, netmask, gateway, dns,
+                         _netplan_section, _nmcli_section, _interfaces_section)
+    )
+    _run_linux_script(service_instance, vm, username, password, script, auth_cache)
+    print(f"[+] Настройка Debian/Astra ВМ {vm.name} завершена")
+
+
+@register_customizer('centos', 'redhat', 'redos')
+def customize_centos(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname, auth_cache=None):
+    """Настройка ВМ семейства RHEL (CentOS, RHEL, Rocky, Alma, RED OS): NetworkManager или ifcfg"""
+    print(f"[*] Начинаем настройку RHEL-совместимой ВМ {vm.name}")
+
+    script = render_linux_script(
+        _hostname_section(hostname, '127.0.0.1 localhost'),
+        _network_section(static_ip, netmask, gateway, dns, _nmcli_section, _ifcfg_section)
+    )
+    _run_linux_script(service_instance, vm, username or "root", password, script, auth_cache)
+    print(f"[+] Настройка RHEL-совместимой ВМ {vm.name} завершена")
+
+
+@register_customizer('linux')
+def customize_generic_linux(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname, auth_cache=None):
+    """Настройка для неизвестных Linux дистрибутивов: способ настройки сети выбирается в гостевой ОС"""
+    print(f"[*] Пытаемся настроить generic Linux на ВМ {vm.name}")
+
+    script = render_linux_script(
+        _hostname_section(hostname, '127.0.1.1'),
+        _network_section(static_ip, netmask, gateway, dns,
+                         _netplan_section, _nmcli_section, _ifcfg_section, _interfaces_section)
+    )
+    try:
+        _run_linux_script(service_instance, vm, username, password, script, auth_cache)
+    except OperationCancelled:
+        raise
+    except Exception as e:
+        raise Exception(f"Не удалось настроить Linux: {str(e)}")
 
-    print("[*] Определяем сетевой интерфейс...")
-    cmd = r"ip -o link show | grep -E '^[0-9]+: (ens|eth)' | head -n1 | cut -d':' -f2 | tr -d ' ' > /tmp/iface"
-    _execute_guest_command(vm, "/bin/bash", f'-c "{cmd}"', username, password, service_instance)
 
-    yaml_content = f"""network:
+def render_linux_script(*sections):
+    """Собирает bash-скрипт настройки: трассировка команд, остановка на первой ошибке, самоудаление"""
+    header = [
+        "#!/bin/bash",
+        "trap 'rm -f \"$0\"' EXIT",
+        "set -ex",
+    ]
+    return "\n".join(header + [section for section in sections if section]) + "\n"
+
+
+def _hostname_section(hostname, hosts_prefix):
+    if not hostname:
+        return ""
+    hosts_key = hosts_prefix.split()[0]
+    return f"""NEW_HOSTNAME={shlex.quote(hostname)}
+echo "$NEW_HOSTNAME" > /etc/hostname
+sed -i '/^{hosts_key}/d' /etc/hosts
+echo "{hosts_prefix} $NEW_HOSTNAME" >> /etc/hosts
+hostnamectl set-hostname "$NEW_HOSTNAME" || hostname "$NEW_HOSTNAME\""""
+
+
+def _iface_detection():
+    return """IFACE=$(ip -o link show | grep -E '^[0-9]+: (en|eth)' | head -n1 | cut -d':' -f2 | tr -d ' ')
+[ -n "$IFACE" ] || { echo 'Сетевой интерфейс не найден'; exit 3; }"""
+
+
+# Условие в гостевой ОС, при котором применим способ настройки сети
+_NETWORK_METHOD_CHECKS = {}
+
+
+def _network_method(check):
+    def decorator(func):
+        _NETWORK_METHOD_CHECKS[func] = check
+        return func
+    return decorator
+
+
+def _network_section(static_ip, netmask, gateway, dns, *methods):
+    """Выбор способа настройки сети в гостевой ОС: первый применимый из methods"""
+    if not static_ip:
+        return ""
+    lines = []
+    for index, method in enumerate(methods):
+        lines.append(f"{'if' if index == 0 else 'elif'} {_NETWORK_METHOD_CHECKS[method]}; then")
+        lines.append(method(static_ip, netmask, gateway, dns))
+    names = ", ".join(method.__name__.strip('_').replace('_section', '') for method in methods)
+    lines += [
+        "else",
+        f"    echo 'Не найден поддерживаемый способ настройки сети ({names})'",
+        "    exit 4",
+        "fi"
+    ]
+    return "\n".join(lines)
+
+
+@_network_method("command -v netplan >/dev/null 2>&1")
+def _netplan_section(static_ip, netmask, gateway, dns):
+    if not static_ip:
+        return ""
+    return f"""{_iface_detection()}
+rm -f /etc/netplan/*
+mkdir -p /etc/cloud/cloud.cfg.d
+echo 'network: {{config: disabled}}' > /etc/cloud/cloud.cfg.d/99-disable-network-config.cfg
+cat > /etc/netplan/01-netcfg.yaml <<EOF
+network:
     ethernets:
-        INTERFACE_PLACEHOLDER:
+        $IFACE:
             addresses:
-                - {static_ip}/{netmask}
+                - {static_ip}/{prefix_length(netmask)}
             nameservers:
                 addresses:
                     - {dns}
@@ -255,245 +385,145 @@ def customize_ubuntu_debian(vm, static_ip, netmask, gateway, dns, username, pass
                 - to: default
                   via: {gateway}
     version: 2
-"""
-
-    # Очистка старых конфигов netplan
-    print("[*] Удаляем старые конфиги Netplan...")
-    cmd = f"-c 'echo \"{password}\" | sudo -S sh -c \"rm -f /etc/netplan/*\"'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    # Отключаем cloud-init управление сетью
-    print("[*] Отключаем cloud-init управление сетью...")
-    cmd = f"-c 'echo \"{password}\" | sudo -S sh -c \"echo \\\"network: {{config: disabled}}\\\" > /etc/cloud/cloud.cfg.d/99-disable-network-config.cfg\"'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    # Экранируем кавычки и новые строки для bash
-    yaml_content_escaped = yaml_content.replace("'", "'\"'\"'").replace("\n", "\\n")
-
-    print("[*] Записываем netplan конфиг...")
-    cmd = f"-c \"printf \\\"{yaml_content_escaped}\\\" > /tmp/01-netcfg.yaml\""
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    print("[*] Заменяем INTERFACE_PLACEHOLDER в YAML на найденный интерфейс...")
-    cmd = "sed -i \"s/INTERFACE_PLACEHOLDER/$(cat /tmp/iface | sed 's/[\\/&]/\\\\&/g' | tr -d '\\n')/g\" /tmp/01-netcfg.yaml"
-    _execute_guest_command(vm, "/bin/bash", f'-c "{cmd}"', username, password, service_instance)
-
-    print("[*] Копируем /tmp/01-netcfg.yaml")
-    cmd = f"-c 'echo \"{password}\" | sudo -S cp /tmp/01-netcfg.yaml /etc/netplan/01-netcfg.yaml'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    print("[*] Устанавливаем владельца root:root...")
-    cmd = f"-c 'echo \"{password}\" | sudo -S chown root:root /etc/netplan/01-netcfg.yaml'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    print("[*] Выставляем права 644...")
-    cmd = f"-c 'echo \"{password}\" | sudo -S chmod 600 /etc/netplan/01-netcfg.yaml'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    # Применение конфига
-    print("[*] Применяем Netplan...")
-    cmd = f"-c 'echo \"{password}\" | sudo -S netplan apply && sudo -S shutdown now'"
-    _execute_guest_command(vm, "/bin/bash", cmd, username, password, service_instance)
-
-    print("[+] Настройка сети завершена")
-    print("[+] Настройка Ubuntu/Debian завершена")
-
-
-def customize_centos(vm, static_ip, netmask, gateway, dns, username, password, hostname):
-    """Настройка CentOS/RHEL ВМ"""
-    print("[*] Начинаем настройку CentOS ВМ")
-
-    commands = [
-        "cat > /etc/sysconfig/network-scripts/ifcfg-eth0 <<EOF",
-        "DEVICE=eth0",
-        "BOOTPROTO=none",
-        "ONBOOT=yes",
-        f"IPADDR={static_ip}",
-        f"NETMASK={netmask}",
-        f"GATEWAY={gateway}",
-        f"DNS1={dns}",
-        "EOF",
-
-        # Настройка hostname
-        f"echo '{hostname}' > /etc/hostname",
-        f"hostnamectl set-hostname {hostname}",
-
-        # Обновление /etc/hosts
-        f"sed -i '/127.0.1.1/d' /etc/hosts || true",
-        f"grep -q '127.0.0.1' /etc/hosts && sed -i 's/^127.0.0.1.*/127.0.0.1 localhost {hostname}/' /etc/hosts || echo '127.0.0.1 localhost {hostname}' >> /etc/hosts",
-
-        # Перезапуск сети
-        "systemctl restart network"
+EOF
+chown root:root /etc/netplan/01-netcfg.yaml
+chmod 600 /etc/netplan/01-netcfg.yaml
+netplan apply"""
+
+
+@_network_method("command -v nmcli >/dev/null 2>&1 && systemctl is-active --quiet NetworkManager")
+def _nmcli_section(static_ip, netmask, gateway, dns):
+    return f"""{_iface_detection()}
+CONN=$(nmcli -g GENERAL.CONNECTION device show "$IFACE" | head -n1)
+if [ -z "$CONN" ]; then
+    CONN="$IFACE"
+    nmcli connection add type ethernet ifname "$IFACE" con-name "$CONN"
+fi
+nmcli connection modify "$CONN" ipv4.method manual ipv4.addresses {static_ip}/{prefix_length(netmask)} \\
+    ipv4.gateway {gateway} ipv4.dns {dns} ipv6.method ignore connection.autoconnect yes
+nmcli connection up "$CONN\""""
+
+
+@_network_method("[ -f /etc/network/interfaces ]")
+def _interfaces_section(static_ip, netmask, gateway, dns):
+    return f"""{_iface_detection()}
+cat > /etc/network/interfaces <<EOF
+source /etc/network/interfaces.d/*
+
+auto lo
+iface lo inet loopback
+
+auto $IFACE
+iface $IFACE inet static
+    address {static_ip}/{prefix_length(netmask)}
+    gateway {gateway}
+    dns-nameservers {dns}
+EOF
+command -v resolvconf >/dev/null 2>&1 || echo "nameserver {dns}" > /etc/resolv.conf
+systemctl restart networking"""
+
+
+@_network_method("[ -d /etc/sysconfig/network-scripts ]")
+def _ifcfg_section(static_ip, netmask, gateway, dns):
+    if not static_ip:
+        return ""
+    return f"""{_iface_detection()}
+cat > /etc/sysconfig/network-scripts/ifcfg-$IFACE <<EOF
+DEVICE=$IFACE
+BOOTPROTO=none
+ONBOOT=yes
+IPADDR={static_ip}
+PREFIX={prefix_length(netmask)}
+GATEWAY={gateway}
+DNS1={dns}
+EOF
+systemctl restart network || systemctl restart NetworkManager"""
+
+
+def render_windows_script(static_ip, netmask, gateway, dns, hostname):
+    """Собирает PowerShell-скрипт настройки сети и имени компьютера"""
+    lines = [
+        "$ErrorActionPreference = 'Stop'",
+        "try {",
     ]
-
-    _execute_guest_commands(vm, commands, username or "root", password)
-    print("[+] Настройка CentOS завершена")
-
-
-def customize_generic_linux(vm, static_ip, netmask, gateway, dns, username, password, service_instance, hostname):
-    """Настройка для неизвестных Linux дистрибутивов"""
-    print("[*] Пытаемся настроить generic Linux")
-
-    try:
-        customize_ubuntu_debian(vm, static_ip, netmask, gateway, dns, username, password, hostname)
-    except Exception as e:
-        print(f"[!] Ubuntu метод не сработал: {str(e)}")
-        try:
-            customize_centos(vm, static_ip, netmask, gateway, dns, username, password, hostname)
-        except Exception as e:
-            raise Exception(f"Не удалось настроить Linux: {str(e)}")
+    if static_ip:
+        lines.append(f"""    $adapter = Get-NetAdapter | Where-Object {{ $_.Status -eq 'Up' }} | Select-Object -First 1
+    if (-not $adapter) {{ throw 'Активный сетевой адаптер не найден' }}
+    Set-NetIPInterface -InterfaceIndex $adapter.ifIndex -Dhcp Disabled
+
+    # Очистка старых IP, шлюза и DNS
+    Get-NetIPAddress -InterfaceIndex $adapter.ifIndex -ErrorAction SilentlyContinue | Remove-NetIPAddress -Confirm:$false -ErrorAction SilentlyContinue
+    Remove-NetRoute -InterfaceIndex $adapter.ifIndex -DestinationPrefix '0.0.0.0/0' -Confirm:$false -ErrorAction SilentlyContinue
+    Set-DnsClientServerAddress -InterfaceIndex $adapter.ifIndex -ResetServerAddresses
+
+    New-NetIPAddress -InterfaceIndex $adapter.ifIndex -IPAddress {_ps_quote(static_ip)} -PrefixLength {prefix_length(netmask)} -DefaultGateway {_ps_quote(gateway)}
+    Set-DnsClientServerAddress -InterfaceIndex $adapter.ifIndex -ServerAddresses {_ps_quote(dns)}""")
+    if hostname:
+        lines.append(f"    Rename-Computer -NewName {_ps_quote(hostname)} -Force -PassThru")
+    lines += [
+        "} finally {",
+        "    Remove-Item -LiteralPath $PSCommandPath -Force -ErrorAction SilentlyContinue",
+        "}",
+    ]
+    # BOM — иначе Windows PowerShell прочитает UTF-8 в кодировке ANSI
+    return "\ufeff" + "\r\n".join("\n".join(lines).split("\n")) + "\r\n"
 
 
-def _execute_guest_command(vm, program_path, arguments, username, password, service_instance=None):
-    """Выполняет одну команду в гостевой ОС"""
+def _run_linux_script(si, vm, username, password, script, auth_cache=None):
+    """Запускает bash-скрипт от root: напрямую или через sudo с паролем на stdin"""
+    stdout_path, stderr_path = _output_paths(_LINUX_SCRIPT_PATH)
+    if username == 'root':
+        command = f"/bin/bash {_LINUX_SCRIPT_PATH}"
+    else:
+        command = f"printf '%s\\n' {shlex.quote(password or '')} | sudo -S -p '' /bin/bash {_LINUX_SCRIPT_PATH}"
+    command += f" >{stdout_path} 2>{stderr_path}"
+    _run_customization_script(si, vm, username, password, _LINUX_SCRIPT_PATH, script,
+                              "/bin/bash", f"-c {shlex.quote(command)}", auth_cache)
+
+
+def _run_customization_script(si, vm, username, password, script_path, script, program_path, arguments,
+                              auth_cache=None):
+    """Загружает скрипт, выполняет его одним процессом и проверяет код возврата"""
+    if si is None:
+        raise Exception("Не передан service_instance для запуска команды в гостевой ОС")
+
+    print(f"[*] {vm.name}: загружаем скрипт настройки в гостевую ОС: {script_path}")
+    stdout_path, stderr_path = _output_paths(script_path)
+    own_cache = auth_cache is None
+    if own_cache:
+        auth_cache = GuestAuthCache(si)
     try:
-        if service_instance is None:
-            raise Exception("Не передан service_instance для запуска команды в гостевой ОС")
-
-        # print(f"[+] Получаем менеджер процессов гостевой ОС...")
-        process_manager = service_instance.content.guestOperationsManager.processManager
-
-        # print(f"[+] Аутентификация с пользователем '{username}'...")
-        auth = vim.vm.guest.NamePasswordAuthentication(
-            username=username,
-            password=password
-        )
-
-        pretty_cmd = arguments.replace("\\n", "\n")
-        print("[*] Подготовка команды:")
-        print(program_path + " " + pretty_cmd)
-        spec = vim.vm.guest.ProcessManager.ProgramSpec(
-            programPath=program_path,
-            arguments=arguments
-        )
-
-        print(f"[+] Выполняем команду в гостевой ОС...")
-        pid = process_manager.StartProgramInGuest(vm, auth, spec)
-
-        if not pid:
-            raise Exception("Команда вернула пустой PID (ошибка запуска)")
-
-        print(f"[ОК] Команда успешно запущена, PID: {pid}")
-
-        return pid
-
-    except vim.fault.InvalidGuestLogin as e:
-        raise Exception(f"[Ошибка] Неверный логин или пароль для гостевой ОС: {str(e)}")
-    except vim.fault.GuestOperationsFault as e:
-        raise Exception(f"[Ошибка] Ошибка операций в гостевой ОС: {str(e)}")
-    except vim.fault.ToolsUnavailable as e:
-        raise Exception(f"[Ошибка] VMware Tools недоступны или не запущены: {str(e)}")
-    except Exception as e:
-        raise Exception(f"[Ошибка] Не удалось выполнить команду: {str(e)}")
-
-
+        result = run_guest_script(si, vm, auth_cache.get(vm, username, password),
+                                  script_path, script, program_path, arguments,
+                                  stdout_path=stdout_path, stderr_path=stderr_path)
+    finally:
+        if own_cache:
+            auth_cache.release_all()
 
-def _execute_guest_commands(vm, commands, username, password, service_instance):
-    """Выполняет несколько команд в гостевой ОС"""
-    for cmd in commands:
-        _execute_guest_command(
-            vm,
-            "/bin/bash",
-            f"-c \"{cmd}\"",
-            username,
-            password,
-            service_instance
-        )
+    duration = (result['end_time'] - result['start_time']).total_seconds()
+    if result['exit_code'] != 0:
+        _print_guest_output(vm, result)
+        raise Exception(f"Скрипт настройки завершился с кодом {result['exit_code']} через {duration:.0f} сек")
+    print(f"[ОК] {vm.name}: скрипт настройки выполнен за {duration:.0f} сек")
 
 
+def _output_paths(script_path):
+    """Временные файлы для stdout/stderr скрипта — рядом с самим скриптом"""
+    base = script_path.rsplit('.', 1)[0]
+    return f"{base}.out", f"{base}.err"
 
-def _mask_to_prefix(netmask):
-    """Конвертирует маску в префикс CIDR"""
-    return sum(bin(int(x)).count('1') for x in netmask.split('.'))
 
+def _print_guest_output(vm, result, max_lines=30):
+    for stream in ('stdout', 'stderr'):
+        lines = result[stream].strip().splitlines()
+        if not lines:
+            continue
+        print(f"[*] {vm.name}: {stream} скрипта настройки (последние {min(len(lines), max_lines)} строк):")
+        for line in lines[-max_lines:]:
+            print(f"    {line}")
 
-def customize_vm_hardware(vm, vm_config):
-    """
-    Меняет конфигурацию CPU и RAM на уже существующей ВМ.
-    Если ВМ включена — сначала выключает, затем включает обратно.
-    """
-    print(f"[*] Начинаем изменение аппаратной конфигурации ВМ '{vm.name}'...")
-
-    cpu_count = int(cpu) if (cpu := vm_config.get('CPU_COUNT')) else None
-    memory_mb = int(mem) if (mem := vm_config.get('MEMORY_MB')) else None
-    network_name = vm_config.get('NETWORK_NAME')
 
-    # Получаем текущее состояние ВМ
-    was_powered_on = vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
+def _ps_quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
 
-    if was_powered_on:
-        vm_power_off(vm)
 
-    try:
-        # Создаем спецификацию новой конфигурации
-        config_spec = vim.vm.ConfigSpec(
-            numCPUs=cpu_count,
-            memoryMB=memory_mb,
-            numCoresPerSocket=cpu_count,  # Все ядра в одном сокете
-            cpuHotAddEnabled=True,  # Включение HotAdd CPU
-            memoryHotAddEnabled=True  # Включение HotAdd RAM
-        )
-
-        # Если указано сетевое имя - меняем сетевую карту
-        if network_name:
-            # Получаем список всех сетей на хосте
-            host = vm.runtime.host
-            network = None
-            for net in host.network:
-                if net.name == network_name:
-                    network = net
-                    break
-
-            if not network:
-                raise Exception(f"Сеть '{network_name}' не найдена на хосте")
-
-            # Находим первый сетевой адаптер в конфигурации ВМ
-            for dev in vm.config.hardware.device:
-                if isinstance(dev, vim.vm.device.VirtualEthernetCard):
-                    # Создаем спецификацию изменения устройства
-                    nic_spec = vim.vm.device.VirtualDeviceSpec()
-                    nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
-                    nic_spec.device = dev
-
-                    # Создаем правильный backing в зависимости от типа сети
-                    if isinstance(network, vim.Network):
-                        nic_spec.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
-                        nic_spec.device.backing.network = network
-                        nic_spec.device.backing.deviceName = network_name
-                    elif isinstance(network, vim.dvs.DistributedVirtualPortgroup):
-                        nic_spec.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
-                        nic_spec.device.backing.port = vim.dvs.PortConnection()
-                        nic_spec.device.backing.port.portgroupKey = network.key
-                        nic_spec.device.backing.port.switchUuid = network.config.distributedVirtualSwitch.uuid
-
-                    # Обновляем connectable
-                    nic_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-                    nic_spec.device.connectable.connected = True
-                    nic_spec.device.connectable.startConnected = True
-
-                    # Добавляем изменение в конфигурацию
-                    if not hasattr(config_spec, 'deviceChange'):
-                        config_spec.deviceChange = []
-                    config_spec.deviceChange.append(nic_spec)
-
-                    print(f"[*] Меняем сетевой адаптер на сеть '{network_name}'...")
-                    break
-
-        print(f"[*] Применяем конфигурацию: {cpu_count} CPU, {memory_mb} MB RAM" +
-              (f", сеть '{network_name}'" if network_name else "") + "...")
-        task = vm.ReconfigVM_Task(config_spec)
-        wait_for_task(task, "Изменение конфигурации ВМ")
-        print("[+] Конфигурация ВМ успешно обновлена.")
-
-        print("=" * 70)
-
-        if was_powered_on:
-            print("[*] Включаем ВМ так как изначально она была включена...")
-            vm_power_on(vm)
-
-    except Exception as e:
-        print(f"[-] Ошибка при изменении конфигурации ВМ: {str(e)}")
-        if was_powered_on:
-            print("[*] Включаем ВМ так как изначально она была включена...")
-            vm_power_on(vm)
-        raise
\ No newline at end of file
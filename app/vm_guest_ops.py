@@ -0,0 +1,328 @@
+import ssl
+import time
+import itertools
+import threading
+import urllib.request
+from urllib.parse import urlparse, urlunparse
+from pyVmomi import vim, vmodl
+from vm_retry import with_retry
+from vm_cancel import current_token
+
+# Операции внутри гостевой ОС через VMware Tools (guestOperationsManager):
+# передача файлов, запуск программ и ожидание их завершения.
+
+
+def _guest_ops(si):
+    return si.content.guestOperationsManager
+
+
+def _transfer_url(si, url):
+    """В URL передачи файла ESXi может вернуть '*' вместо имени хоста"""
+    parsed = urlparse(url)
+    if parsed.hostname in ('*', None):
+        host = si._stub.host
+        parsed = parsed._replace(netloc=host)
+    return urlunparse(parsed)
+
+
+def _ssl_context():
+    from esxi_connect import IGNORE_SSL
+    return ssl._create_unverified_context() if IGNORE_SSL else ssl.create_default_context()
+
+
+def guest_auth(username, password):
+    return vim.vm.guest.NamePasswordAuthentication(username=username, password=password)
+
+
+class GuestAuthSession:
+    """
+    Аутентификация guest operations для одной ВМ.
+    Учётные данные проверяются один раз через AcquireCredentialsInGuest,
+    дальше все вызовы используют полученный тикет. Просроченный тикет
+    перевыпускается автоматически; если гостевая ОС тикеты не поддерживает,
+    используется обычная аутентификация по логину и паролю.
+    """
+
+    _session_ids = itertools.count(1)
+
+    def __init__(self, si, vm, username, password):
+        self.si = si
+        self.vm = vm
+        self.credentials = guest_auth(username, password)
+        self.session_id = next(self._session_ids)
+        self.lock = threading.Lock()
+        self.ticket = None
+        self.tickets_supported = True
+
+    def _acquire(self):
+        try:
+            self.ticket = _guest_ops(self.si).authManager.AcquireCredentialsInGuest(
+                self.vm, self.credentials, self.session_id)
+        except (vim.fault.GuestAuthenticationChallenge, vmodl.fault.NotSupported,
+                vim.fault.GuestComponentsOutOfDate, vim.fault.OperationNotSupportedByGuest):
+            print(f"[!] {self.vm.name}: тикеты guest operations не поддерживаются, используем логин и пароль")
+            self.tickets_supported = False
+
+    @property
+    def auth(self):
+        with self.lock:
+            if self.ticket is None and self.tickets_supported:
+                self._acquire()
+            return self.ticket or self.credentials
+
+    def call(self, operation):
+        """Выполняет operation(auth); при истёкшем тикете перевыпускает его и повторяет один раз"""
+        auth = self.auth
+        try:
+            return operation(auth)
+        except vim.fault.InvalidGuestLogin:
+            if auth is self.credentials:
+                raise
+            with self.lock:
+                if self.ticket is auth:
+                    print(f"[*] {self.vm.name}: сессия guest operations истекла, получаем новую")
+                    self.ticket = None
+            return operation(self.auth)
+
+    def release(self):
+        with self.lock:
+            ticket, self.ticket = self.ticket, None
+        if ticket is None:
+            return
+        try:
+            _guest_ops(self.si).authManager.ReleaseCredentialsInGuest(self.vm, ticket)
+        except Exception:
+            # ВМ могла уже выключиться — тикет истечёт сам
+            pass
+
+
+class GuestAuthCache:
+    """
+    Сессии guest operations на время пакета операций: одна GuestAuthSession
+    на пару (ВМ, учётные данные), общая для всех потоков настройки.
+    release_all() освобождает полученные тикеты.
+    """
+
+    def __init__(self, si):
+        self.si = si
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def get(self, vm, username, password):
+        with self.lock:
+            key = (vm._moId, username, password)
+            if key not in self.sessions:
+                self.sessions[key] = GuestAuthSession(self.si, vm, username, password)
+            return self.sessions[key]
+
+    def release_all(self):
+        with self.lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            session.release()
+
+
+def _with_auth(auth, operation):
+    """
+    auth — объект аутентификации vim или GuestAuthSession.
+    Пока гостевые операции недоступны (Tools ещё стартуют), вызов повторяется.
+    """
+    def attempt():
+        if isinstance(auth, GuestAuthSession):
+            return auth.call(operation)
+        return operation(auth)
+
+    return with_retry(attempt, "Гостевая операция", idempotent=False)
+
+
+def upload_to_guest(si, vm, auth, guest_path, data):
+    """Загружает содержимое (bytes) в файл гостевой ОС, перезаписывая его"""
+    file_manager = _guest_ops(si).fileManager
+    url = _with_auth(auth, lambda a: file_manager.InitiateFileTransferToGuest(
+        vm, a, guest_path,
+        vim.vm.guest.FileManager.FileAttributes(),
+        len(data),
+        True
+    ))
+
+    request = urllib.request.Request(_transfer_url(si, url), data=data, method='PUT')
+    request.add_header('Content-Type', 'application/octet-stream')
+    request.add_header('Content-Length', str(len(data)))
+    with urllib.request.urlopen(request, context=_ssl_context(), timeout=60) as response:
+        if response.status not in (200, 201):
+            raise Exception(f"Не удалось передать файл {guest_path} в гостевую ОС: HTTP {response.status}")
+
+
+def download_from_guest(si, vm, auth, guest_path):
+    """Скачивает файл гостевой ОС и возвращает его содержимое (bytes)"""
+    file_manager = _guest_ops(si).fileManager
+    info = _with_auth(auth, lambda a: file_manager.InitiateFileTransferFromGuest(vm, a, guest_path))
+    with urllib.request.urlopen(_transfer_url(si, info.url), context=_ssl_context(), timeout=60) as response:
+        return response.read()
+
+
+def delete_guest_file(si, vm, auth, guest_path):
+    """Удаляет файл в гостевой ОС (отсутствие файла ошибкой не считается)"""
+    try:
+        file_manager = _guest_ops(si).fileManager
+        _with_auth(auth, lambda a: file_manager.DeleteFileInGuest(vm, a, guest_path))
+    except vim.fault.FileNotFound:
+        pass
+
+
+def start_guest_program(si, vm, auth, program_path, arguments, working_directory=None):
+    """Запускает программу в гостевой ОС и возвращает PID"""
+    spec = vim.vm.guest.ProcessManager.ProgramSpec(
+        programPath=program_path,
+        arguments=arguments,
+        workingDirectory=working_directory
+    )
+    process_manager = _guest_ops(si).processManager
+    pid = _with_auth(auth, lambda a: process_manager.StartProgramInGuest(vm, a, spec))
+    if not pid:
+        raise Exception("Команда вернула пустой PID (ошибка запуска)")
+    return pid
+
+
+class GuestProcessTracker:
+    """
+    Отслеживает процессы, запущенные в гостевой ОС одной ВМ.
+    Все незавершённые PID опрашиваются одним вызовом ListProcessesInGuest,
+    интервал опроса растёт от poll_min до poll_max, пока ничего не меняется.
+    Результат по каждому PID: {'pid', 'name', 'exit_code', 'start_time', 'end_time'}.
+    """
+
+    def __init__(self, si, vm, auth, poll_min=0.5, poll_max=5):
+        self.si = si
+        self.vm = vm
+        self.auth = auth
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.pending = set()
+        self.results = {}
+
+    def track(self, pid):
+        if pid not in self.results:
+            self.pending.add(pid)
+        return pid
+
+    def start(self, program_path, arguments, working_directory=None):
+        """Запускает программу и сразу ставит её PID на отслеживание"""
+        return self.track(start_guest_program(self.si, self.vm, self.auth,
+                                              program_path, arguments, working_directory))
+
+    def poll(self):
+        """Один опрос всех незавершённых PID. Возвращает завершившиеся за этот опрос."""
+        if not self.pending:
+            return {}
+
+        process_manager = _guest_ops(self.si).processManager
+        pids = sorted(self.pending)
+        processes = _with_auth(self.auth, lambda a: process_manager.ListProcessesInGuest(self.vm, a, pids))
+
+        finished = {}
+        for process in processes or []:
+            if process.pid in self.pending and process.endTime:
+                finished[process.pid] = {
+                    'pid': process.pid,
+                    'name': process.name,
+                    'exit_code': process.exitCode,
+                    'start_time': process.startTime,
+                    'end_time': process.endTime
+                }
+        self.pending.difference_update(finished)
+        self.results.update(finished)
+        return finished
+
+    def wait(self, pids=None, timeout=600):
+        """
+        Ждёт завершения указанных PID (по умолчанию — всех отслеживаемых).
+        Возвращает {pid: результат}; по таймауту выбрасывает исключение.
+        """
+        pids = set(self.pending | set(self.results) if pids is None else pids)
+        for pid in pids:
+            self.track(pid)
+
+        deadline = time.time() + timeout
+        interval = self.poll_min
+        token = current_token()
+        while pids & self.pending:
+            if self.poll():
+                interval = self.poll_min
+            elif time.time() >= deadline:
+                raise Exception(f"Процессы {sorted(pids & self.pending)} в гостевой ОС "
+                                f"не завершились за {timeout} сек")
+            else:
+                token.sleep(min(interval, max(deadline - time.time(), 0)), f"Ожидание процессов в ВМ {self.vm.name}")
+                interval = min(interval * 2, self.poll_max)
+
+        return {pid: self.results[pid] for pid in pids}
+
+
+def wait_for_guest_process(si, vm, auth, pid, timeout=600):
+    """Ждёт завершения процесса в гостевой ОС и возвращает код возврата"""
+    return GuestProcessTracker(si, vm, auth).wait([pid], timeout)[pid]['exit_code']
+
+
+def read_guest_output(si, vm, auth, guest_path):
+    """Забирает файл с перенаправленным выводом процесса и удаляет его в гостевой ОС"""
+    try:
+        data = download_from_guest(si, vm, auth, guest_path)
+    except vim.fault.FileNotFound:
+        return ''
+    delete_guest_file(si, vm, auth, guest_path)
+    return data.decode('utf-8', errors='replace')
+
+
+def _discard_guest_files(si, vm, auth, guest_paths):
+    """
+    Удаляет файлы одной попыткой, без повторов: после успешного скрипта
+    гостевая ОС может уже выключаться, и ошибки здесь ничего не значат.
+    """
+    file_manager = _guest_ops(si).fileManager
+    for guest_path in guest_paths:
+        def delete(a, guest_path=guest_path):
+            return file_manager.DeleteFileInGuest(vm, a, guest_path)
+        try:
+            if isinstance(auth, GuestAuthSession):
+                auth.call(delete)
+            else:
+                delete(auth)
+        except Exception:
+            pass
+
+
+def run_guest_script(si, vm, auth, script_path, script, program_path, arguments, timeout=600,
+                     stdout_path=None, stderr_path=None):
+    """
+    Загружает скрипт в гостевую ОС одним файлом, запускает его одним процессом
+    и дожидается завершения. Вывод забирается из файлов stdout_path/stderr_path,
+    в которые его перенаправляет командная строка arguments, только при ненулевом
+    коде возврата: успешный скрипт может сразу выключить ВМ (настройка Ubuntu),
+    и гостевые операции после него уже недоступны.
+    auth — объект аутентификации vim или GuestAuthSession.
+    Возвращает результат процесса с ключами 'stdout' и 'stderr'.
+    """
+    try:
+        upload_to_guest(si, vm, auth, script_path, script.encode('utf-8'))
+
+        tracker = GuestProcessTracker(si, vm, auth)
+        pid = tracker.start(program_path, arguments)
+        print(f"[*] {vm.name}: скрипт настройки запущен, PID: {pid}")
+        result = tracker.wait([pid], timeout)[pid]
+
+        if result['exit_code'] == 0:
+            result['stdout'] = result['stderr'] = ''
+            _discard_guest_files(si, vm, auth, [path for path in (stdout_path, stderr_path) if path])
+            return result
+
+        result['stdout'] = read_guest_output(si, vm, auth, stdout_path) if stdout_path else ''
+        result['stderr'] = read_guest_output(si, vm, auth, stderr_path) if stderr_path else ''
+        return result
+
+    except vim.fault.InvalidGuestLogin as e:
+        raise Exception(f"[Ошибка] Неверный логин или пароль для гостевой ОС: {e.msg}")
+    except vim.fault.ToolsUnavailable as e:
+        raise Exception(f"[Ошибка] VMware Tools недоступны или не запущены: {e.msg}")
+    except vim.fault.GuestOperationsFault as e:
+        raise Exception(f"[Ошибка] Ошибка операций в гостевой ОС: {e.msg}")
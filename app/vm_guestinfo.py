@@ -0,0 +1,112 @@
+import os
+import time
+import json
+import base64
+import hashlib
+from pyVmomi import vim
+from vm_operations import vm_power_on, wait_for_task
+from utils import prefix_length
+
+# Настройка гостевой ОС через cloud-init (datasource VMware): сеть и hostname
+# передаются в guestinfo.metadata/guestinfo.userdata при клонировании,
+# и ОС настраивает себя сама при первой загрузке — без guest operations.
+
+CUSTOMIZE_MODE_GUESTOPS = 'guestops'
+CUSTOMIZE_MODE_CLOUD_INIT = 'cloud-init'
+CUSTOMIZE_MODE_DEFAULT = os.getenv("CUSTOMIZE_MODE", CUSTOMIZE_MODE_GUESTOPS).lower()
+
+
+def customize_mode(vm_config):
+    """Способ настройки гостевой ОС: столбец customizeMode CSV или CUSTOMIZE_MODE из .env"""
+    mode = (vm_config.get('CUSTOMIZE_MODE') or CUSTOMIZE_MODE_DEFAULT).strip().lower()
+    return CUSTOMIZE_MODE_CLOUD_INIT if mode in ('cloud-init', 'cloudinit', 'guestinfo') else CUSTOMIZE_MODE_GUESTOPS
+
+
+def uses_guestinfo(vm_config):
+    return customize_mode(vm_config) == CUSTOMIZE_MODE_CLOUD_INIT
+
+
+def build_guestinfo(vm_config):
+    """
+    Ключи guestinfo.* для extraConfig/.vmx из строки CSV.
+    instance-id зависит от содержимого: cloud-init применит настройки заново
+    только при их изменении.
+    """
+    hostname = vm_config.get('TARGET_VM_HOSTNAME') or vm_config.get('TARGET_VM_NAME')
+    metadata = {'local-hostname': hostname}
+
+    static_ip = vm_config.get('STATIC_IP')
+    if static_ip:
+        ethernet = {
+            'match': {'name': 'e*'},
+            'dhcp4': False,
+            'addresses': [f"{static_ip}/{prefix_length(vm_config.get('NETMASK') or 24)}"]
+        }
+        if vm_config.get('GATEWAY'):
+            ethernet['routes'] = [{'to': 'default', 'via': vm_config['GATEWAY']}]
+        if vm_config.get('DNS'):
+            ethernet['nameservers'] = {'addresses': [vm_config['DNS']]}
+        metadata['network'] = {'version': 2, 'ethernets': {'primary': ethernet}}
+
+    userdata = "\n".join([
+        "#cloud-config",
+        f"hostname: {json.dumps(hostname)}",
+        "preserve_hostname: false",
+        "manage_etc_hosts: true",
+        ""
+    ])
+
+    digest = hashlib.sha1(json.dumps([metadata, userdata], sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    metadata['instance-id'] = f"{vm_config.get('TARGET_VM_NAME')}-{digest}"
+
+    return {
+        'guestinfo.metadata': base64.b64encode(json.dumps(metadata, sort_keys=True).encode('utf-8')).decode('ascii'),
+        'guestinfo.metadata.encoding': 'base64',
+        'guestinfo.userdata': base64.b64encode(userdata.encode('utf-8')).decode('ascii'),
+        'guestinfo.userdata.encoding': 'base64'
+    }
+
+
+def apply_guestinfo_to_vmx(vmx, vm_config):
+    """Записывает guestinfo в .vmx клона (standalone ESXi)"""
+    for key, value in build_guestinfo(vm_config).items():
+        vmx.set(key, value)
+    return vmx
+
+
+def guestinfo_extra_config(vm_config):
+    """guestinfo в виде ConfigSpec.extraConfig (vCenter / ReconfigVM_Task)"""
+    return [vim.option.OptionValue(key=key, value=value) for key, value in build_guestinfo(vm_config).items()]
+
+
+def customize_vm_guestinfo(vm, vm_config, timings=None):
+    """
+    Настройка ВМ через cloud-init. Если guestinfo уже записаны при клонировании,
+    ВМ просто запускается; иначе они записываются через ReconfigVM_Task,
+    а запущенная ВМ перезагружается, чтобы cloud-init применил их.
+    Ожидание VMware Tools и учётные данные гостевой ОС не нужны.
+    """
+    if timings is None:
+        timings = {}
+
+    guestinfo = build_guestinfo(vm_config)
+    current = {option.key: option.value for option in vm.config.extraConfig
+               if option.key in guestinfo}
+
+    powered_on = vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
+    if current != guestinfo:
+        print(f"[*] {vm.name}: записываем метаданные cloud-init в guestinfo...")
+        spec = vim.vm.ConfigSpec(extraConfig=guestinfo_extra_config(vm_config))
+        wait_for_task(vm.ReconfigVM_Task(spec), f"Запись guestinfo ВМ {vm.name}")
+        if powered_on:
+            print(f"[*] {vm.name}: перезагружаем гостевую ОС для применения cloud-init...")
+            vm.RebootGuest()
+    else:
+        print(f"[=] {vm.name}: метаданные cloud-init уже записаны при клонировании")
+
+    if not powered_on:
+        boot_start = time.time()
+        vm_power_on(vm)
+        timings['boot'] = time.time() - boot_start
+    print(f"[+] {vm.name}: гостевая ОС настроится cloud-init при загрузке")
+    print("=" * 70)
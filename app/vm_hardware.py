@@ -0,0 +1,213 @@
+from pyVmomi import vim
+from vm_operations import vm_power_on, vm_power_off, run_task
+from vmx_file import ethernet_ids
+
+# Единое описание аппаратной конфигурации ВМ из строки CSV.
+# Применяется тремя способами: правкой .vmx при клонировании на ESXi,
+# через CloneSpec.config на vCenter и через ReconfigVM_Task на готовой ВМ.
+
+_CDROM_DEVICE_TYPES = ('cdrom-image', 'cdrom-raw', 'atapi-cdrom')
+
+
+def hardware_from_config(vm_config):
+    """Целевые параметры железа из конфига ВМ (None — не менять)"""
+    cpu_count = int(cpu) if (cpu := vm_config.get('CPU_COUNT')) else None
+    memory_mb = int(mem) if (mem := vm_config.get('MEMORY_MB')) else None
+    return {
+        'cpu_count': cpu_count,
+        'cores_per_socket': cpu_count,  # Все ядра в одном сокете
+        'memory_mb': memory_mb,
+        'network_name': vm_config.get('NETWORK_NAME') or None
+    }
+
+
+def find_network(host, network_name):
+    network = next((net for net in host.network if net.name == network_name), None)
+    if not network:
+        raise Exception(f"Сеть '{network_name}' не найдена на хосте")
+    return network
+
+
+def _nic_backing(network, network_name):
+    if isinstance(network, vim.dvs.DistributedVirtualPortgroup):
+        backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
+        backing.port = vim.dvs.PortConnection()
+        backing.port.portgroupKey = network.key
+        backing.port.switchUuid = network.config.distributedVirtualSwitch.uuid
+    else:
+        backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
+        backing.network = network
+        backing.deviceName = network_name
+    return backing
+
+
+def build_config_spec(devices, host, hardware, remove_cdrom=False, cpu_layout=True):
+    """
+    Собирает ConfigSpec по описанию железа.
+    devices — текущие устройства ВМ (или снапшота, из которого клонируем).
+    remove_cdrom — удалить DVD-приводы.
+    cpu_layout=False — не трогать число ядер на сокет (для горячего добавления CPU).
+    """
+    config_spec = vim.vm.ConfigSpec()
+    device_changes = []
+
+    if hardware.get('cpu_count'):
+        config_spec.numCPUs = hardware['cpu_count']
+        if cpu_layout and hardware.get('cores_per_socket'):
+            config_spec.numCoresPerSocket = hardware['cores_per_socket']
+
+    if hardware.get('memory_mb'):
+        config_spec.memoryMB = hardware['memory_mb']
+
+    if remove_cdrom:
+        for dev in devices:
+            if isinstance(dev, vim.vm.device.VirtualCdrom):
+                spec = vim.vm.device.VirtualDeviceSpec()
+                spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.remove
+                spec.device = dev
+                device_changes.append(spec)
+
+    network_name = hardware.get('network_name')
+    if network_name:
+        network = find_network(host, network_name)
+
+        # Меняем первый сетевой адаптер
+        nic = next((dev for dev in devices if isinstance(dev, vim.vm.device.VirtualEthernetCard)), None)
+        if nic:
+            nic_spec = vim.vm.device.VirtualDeviceSpec()
+            nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+            nic_spec.device = nic
+            nic_spec.device.backing = _nic_backing(network, network_name)
+            nic_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+            nic_spec.device.connectable.connected = True
+            nic_spec.device.connectable.startConnected = True
+            device_changes.append(nic_spec)
+        else:
+            print(f"[!] У ВМ нет сетевого адаптера, сеть '{network_name}' не назначена")
+
+    if device_changes:
+        config_spec.deviceChange = device_changes
+
+    return config_spec
+
+
+def apply_hardware_to_vmx(vmx, hardware, remove_cdrom=True):
+    """Применяет описание железа к .vmx клона (standalone ESXi)"""
+    if hardware.get('cpu_count'):
+        vmx.set('numvcpus', hardware['cpu_count'])
+        if hardware.get('cores_per_socket'):
+            vmx.set('cpuid.coresPerSocket', hardware['cores_per_socket'])
+
+    if hardware.get('memory_mb'):
+        vmx.set('memSize', hardware['memory_mb'])
+
+    if remove_cdrom:
+        for key, value in vmx.items():
+            if key.lower().endswith('.devicetype') and value.lower() in _CDROM_DEVICE_TYPES:
+                device_id = key[:-len('.deviceType')]
+                vmx.set(f"{device_id}.present", 'FALSE')
+                vmx.set(f"{device_id}.startConnected", 'FALSE')
+
+    network_name = hardware.get('network_name')
+    if network_name:
+        eth = next(iter(ethernet_ids(vmx)), None)
+        if eth:
+            vmx.set(f"{eth}.networkName", network_name)
+            vmx.set(f"{eth}.startConnected", 'TRUE')
+        else:
+            print(f"[!] В .vmx нет сетевого адаптера, сеть '{network_name}' не назначена")
+
+    return vmx
+
+
+def current_network_name(vm):
+    """Имя сети первого сетевого адаптера ВМ"""
+    nic = next((dev for dev in vm.config.hardware.device if isinstance(dev, vim.vm.device.VirtualEthernetCard)), None)
+    if not nic:
+        return None
+    backing = nic.backing
+    if isinstance(backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo):
+        portgroup = next((net for net in vm.network
+                          if isinstance(net, vim.dvs.DistributedVirtualPortgroup) and net.key == backing.port.portgroupKey), None)
+        return portgroup.name if portgroup else None
+    return getattr(backing, 'deviceName', None)
+
+
+def hardware_diff(vm, hardware):
+    """Оставляет в описании железа только то, что отличается от текущей ВМ"""
+    current = vm.config.hardware
+    diff = dict(hardware)
+    if diff.get('cpu_count') == current.numCPU and diff.get('cores_per_socket') in (None, current.numCoresPerSocket):
+        diff['cpu_count'] = diff['cores_per_socket'] = None
+    if diff.get('memory_mb') == current.memoryMB:
+        diff['memory_mb'] = None
+    if diff.get('network_name') and diff['network_name'] == current_network_name(vm):
+        diff['network_name'] = None
+    return diff
+
+
+def _needs_power_off(vm, hardware):
+    """Требуется ли выключение ВМ (горячее добавление и смена сети его не требуют)"""
+    current = vm.config.hardware
+    cpu_count = hardware.get('cpu_count')
+    memory_mb = hardware.get('memory_mb')
+
+    if cpu_count and cpu_count != current.numCPU:
+        if not (vm.config.cpuHotAddEnabled and cpu_count > current.numCPU):
+            return True
+    if memory_mb and memory_mb != current.memoryMB:
+        if not (vm.config.memoryHotAddEnabled and memory_mb > current.memoryMB):
+            return True
+    return False
+
+
+def customize_vm_hardware(vm, vm_config):
+    """
+    Меняет конфигурацию CPU, RAM и сети на уже существующей ВМ.
+    ВМ выключается только если изменения нельзя применить на лету
+    (смена сети и горячее добавление CPU/RAM выключения не требуют).
+    """
+    print(f"[*] Начинаем изменение аппаратной конфигурации ВМ '{vm.name}'...")
+
+    current = vm.config.hardware
+    hardware = hardware_diff(vm, hardware_from_config(vm_config))
+    if not any(hardware.values()):
+        print(f"[=] Конфигурация ВМ '{vm.name}' уже соответствует заданной, изменения не требуются")
+        print("=" * 70)
+        return
+
+    # Получаем текущее состояние ВМ
+    was_powered_on = vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
+    power_cycle = was_powered_on and _needs_power_off(vm, hardware)
+
+    if power_cycle:
+        vm_power_off(vm)
+    elif was_powered_on:
+        print("[*] Изменения применяются без выключения ВМ")
+
+    try:
+        config_spec = build_config_spec(current.device, vm.runtime.host, hardware,
+                                        cpu_layout=not was_powered_on or power_cycle)
+        if not was_powered_on or power_cycle:
+            config_spec.cpuHotAddEnabled = True  # Включение HotAdd CPU
+            config_spec.memoryHotAddEnabled = True  # Включение HotAdd RAM
+
+        print(f"[*] Применяем конфигурацию: {hardware['cpu_count'] or current.numCPU} CPU, "
+              f"{hardware['memory_mb'] or current.memoryMB} MB RAM" +
+              (f", сеть '{hardware['network_name']}'" if hardware['network_name'] else "") + "...")
+        # Спецификация может добавлять устройства — повтор только если задача отклонена
+        run_task(lambda: vm.ReconfigVM_Task(config_spec), "Изменение конфигурации ВМ", idempotent=False)
+        print("[+] Конфигурация ВМ успешно обновлена.")
+
+        print("=" * 70)
+
+        if power_cycle:
+            print("[*] Включаем ВМ так как изначально она была включена...")
+            vm_power_on(vm)
+
+    except Exception as e:
+        print(f"[-] Ошибка при изменении конфигурации ВМ: {str(e)}")
+        if power_cycle:
+            print("[*] Включаем ВМ так как изначально она была включена...")
+            vm_power_on(vm)
+        raise
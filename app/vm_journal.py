@@ -0,0 +1,113 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+# Журнал пакетов операций: append-only файл (одна json-запись на строку)
+# рядом с exe. Перед шагом пишется намерение, после — результат, поэтому
+# после падения приложения или обрыва связи видно, какие шаги пакета
+# завершились, и пакет можно продолжить с первого незавершённого шага.
+
+_journal_lock = threading.Lock()
+_journal_path = None
+
+
+def init_batch_journal(journal_path):
+    """Открывает журнал и оставляет в нём только записи незавершённых пакетов"""
+    global _journal_path
+    _journal_path = journal_path
+
+    batches = _read_batches()
+    incomplete = {batch_id: batch for batch_id, batch in batches.items() if not batch['finished']}
+    # Сжатый журнал пишется во временный файл и атомарно подменяет старый:
+    # падение посреди записи не должно потерять незавершённые пакеты
+    temp_path = journal_path + '.tmp'
+    try:
+        with _journal_lock:
+            with open(temp_path, mode='w', encoding='utf-8') as file:
+                for batch_id, batch in incomplete.items():
+                    for record in batch['records']:
+                        file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, journal_path)
+    except Exception as e:
+        print(f"[!] Не удалось открыть журнал пакетов {journal_path}: {e}")
+    if incomplete:
+        print(f"[!] В журнале есть незавершённые пакеты операций: {len(incomplete)}")
+
+
+def _append(record):
+    if not _journal_path:
+        return
+    record['time'] = datetime.now().isoformat(timespec='seconds')
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    try:
+        with _journal_lock:
+            with open(_journal_path, mode='a', encoding='utf-8') as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+    except Exception as e:
+        print(f"[!] Не удалось записать в журнал пакетов: {e}")
+
+
+def journal_batch_started(batch_id, vm_operations):
+    _append({'type': 'batch', 'batch': batch_id, 'vm_operations': vm_operations})
+
+
+def journal_step_started(batch_id, key):
+    _append({'type': 'step', 'batch': batch_id, 'key': key, 'status': 'active'})
+
+
+def journal_step_finished(batch_id, key, status, error=None):
+    record = {'type': 'step', 'batch': batch_id, 'key': key, 'status': status}
+    if error:
+        record['error'] = str(error)
+    _append(record)
+
+
+def journal_batch_finished(batch_id, status='finished'):
+    _append({'type': 'finish', 'batch': batch_id, 'status': status})
+
+
+def _read_batches():
+    """{batch_id: {'vm_operations', 'steps': {ключ: статус}, 'started', 'finished', 'records'}}"""
+    batches = {}
+    if not _journal_path or not os.path.exists(_journal_path):
+        return batches
+
+    with _journal_lock:
+        with open(_journal_path, mode='r', encoding='utf-8') as file:
+            lines = file.readlines()
+
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Последняя строка могла не дописаться при падении
+            continue
+        batch_id = record.get('batch')
+        if record.get('type') == 'batch':
+            batches[batch_id] = {'vm_operations': record['vm_operations'], 'steps': {},
+                                 'started': record.get('time'), 'finished': False, 'records': [record]}
+            continue
+        batch = batches.get(batch_id)
+        if batch is None:
+            continue
+        batch['records'].append(record)
+        if record.get('type') == 'step':
+            batch['steps'][record['key']] = record['status']
+        elif record.get('type') == 'finish':
+            batch['finished'] = True
+    return batches
+
+
+def incomplete_batches():
+    """Незавершённые пакеты: [{'batch', 'started', 'vm_operations', 'steps'}], новые первыми"""
+    batches = [
+        {'batch': batch_id, 'started': batch['started'],
+         'vm_operations': batch['vm_operations'], 'steps': batch['steps']}
+        for batch_id, batch in _read_batches().items() if not batch['finished']
+    ]
+    return sorted(batches, key=lambda batch: batch['started'] or '', reverse=True)
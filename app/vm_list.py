@@ -41,6 +41,23 @@ def get_vm_by_name(si, name):
         vm_view.Destroy()
 
 
+def get_vms_by_names(si, names):
+    """Находит несколько ВМ за один проход по инвентарю. Возвращает {имя: ВМ}"""
+    wanted = set(names)
+    content = get_content(si)
+    vm_view = content.viewManager.CreateContainerView(
+        content.rootFolder, [vim.VirtualMachine], True)
+    try:
+        found = {}
+        for vm in vm_view.view:
+            name = vm.name
+            if name in wanted:
+                found[name] = vm
+        return found
+    finally:
+        vm_view.Destroy()
+
+
 def get_content(si):
     content = si.RetrieveContent()
     return content
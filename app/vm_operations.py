@@ -1,56 +1,101 @@
 import time
+import threading
+import contextlib
 from pyVmomi import vim
 from tqdm import tqdm
-
-def vm_detect_os_type(vm) -> str:
+from concurrent.futures import ThreadPoolExecutor
+from vm_power import record_shutdown, shutdown_timeout_for, power_state_watcher, is_powered_off, wait_for_power_off
+from vm_retry import with_retry, TaskFault
+from vm_cancel import current_token, cancel_vsphere_task, OperationCancelled
+
+# Признаки ОС в guestId/guestFullName. Порядок важен: Astra определяется
+# VMware как Debian, а RED OS — как CentOS/RHEL, поэтому они проверяются раньше.
+_OS_SIGNATURES = (
+    ('windows', ('windows',)),
+    ('ubuntu', ('ubuntu',)),
+    ('astra', ('astra',)),
+    ('redos', ('redos', 'red os')),
+    ('centos', ('centos', 'rocky', 'alma')),
+    ('redhat', ('rhel', 'red hat', 'oracle linux', 'oraclelinux')),
+    ('debian', ('debian',)),
+    ('linux', ('linux',)),
+)
+
+# Результаты определения ОС по UUID ВМ
+_os_type_cache = {}
+_os_type_lock = threading.Lock()
+
+
+def vm_detect_os_type(vm, refresh=False) -> str:
     """
-    Определяет ОС виртуальной машины по guestId и guestFullName.
-    Возвращает один из: 'windows', 'ubuntu', 'centos', 'debian', 'redos', 'astra', 'linux', 'unknown'
+    Определяет ОС виртуальной машины по guestId и guestFullName из конфигурации
+    и по имени ОС, которое сообщают VMware Tools.
+    Возвращает один из: 'windows', 'ubuntu', 'centos', 'redhat', 'debian', 'redos', 'astra', 'linux', 'unknown'.
+    Результат кэшируется по UUID ВМ; общий ответ ('linux', 'unknown') без данных
+    от VMware Tools не кэшируется — после загрузки ОС его можно уточнить.
     """
     try:
-        guest_id = (vm.config.guestId or "").lower()
-        guest_name = (vm.config.guestFullName or "").lower()
-        combined = guest_id + " " + guest_name
-
-        if "windows" in combined:
-            return "windows"
-        elif "ubuntu" in combined:
-            return "ubuntu"
-        elif "centos" in combined:
-            return "centos"
-        elif "debian" in combined:
-            return "debian"
-        elif "redos" in combined:
-            return "redos"
-        elif "astra" in combined:
-            return "astra"
-        elif "linux" in combined:
-            return "linux"
-        else:
-            return "unknown"
+        summary_config = vm.summary.config
+        vm_uuid = summary_config.instanceUuid or summary_config.uuid
+
+        if not refresh:
+            with _os_type_lock:
+                if vm_uuid in _os_type_cache:
+                    return _os_type_cache[vm_uuid]
+
+        tools_guest_name = (vm.guest.guestFullName or "") if vm.guest else ""
+        combined = " ".join((summary_config.guestId or "", summary_config.guestFullName or "",
+                             tools_guest_name)).lower()
+
+        os_type = next((os_type for os_type, signatures in _OS_SIGNATURES
+                        if any(signature in combined for signature in signatures)), "unknown")
+
+        if tools_guest_name or os_type not in ('linux', 'unknown'):
+            with _os_type_lock:
+                _os_type_cache[vm_uuid] = os_type
+        return os_type
     except Exception:
         return "unknown"
 
 
 def wait_for_task(task, description="Операция"):
-    # Сначала даем задаче хотя бы немного времени на старт
-    time.sleep(0.1)
+    # При отмене пакета задача отменяется (если это возможно), ожидание прерывается
+    token = current_token()
+    with token.on_cancel(lambda: cancel_vsphere_task(task)):
+        # Сначала даем задаче хотя бы немного времени на старт
+        token.sleep(0.1, description)
 
-    while task.info.state == vim.TaskInfo.State.running:
-        time.sleep(0.1)  # Уменьшаем интервал проверки
+        while task.info.state in (vim.TaskInfo.State.queued, vim.TaskInfo.State.running):
+            token.sleep(0.1, description)  # Уменьшаем интервал проверки
 
     if task.info.state == vim.TaskInfo.State.success:
         return task.info.result
     else:
         err = task.info.error
         if err is None:
-            raise Exception(f"{description} завершилась с ошибкой, но информация об ошибке отсутствует.")
+            raise TaskFault(f"{description} завершилась с ошибкой, но информация об ошибке отсутствует.")
         # Пытаемся получить подробное сообщение
         msg = getattr(err, 'localizedMessage', None)
         if not msg:
             # Если localizedMessage нет, пытаемся вывести всю ошибку как есть
             msg = str(err)
-        raise Exception(f"{description} завершилась с ошибкой: {msg}")
+        raise TaskFault(f"{description} завершилась с ошибкой: {msg}", err)
+
+
+def run_task(start_task, description="Операция", idempotent=True, watcher=None):
+    """
+    Запускает задачу vSphere (start_task() возвращает Task) и ждёт её завершения,
+    повторяя запуск при временных сбоях (vm_retry.with_retry).
+    idempotent=False — повтор, только если сервер отклонил задачу, не начав её.
+    watcher — общий vm_watch.TaskWatcher, без него завершение ожидается опросом.
+    """
+    def attempt():
+        task = start_task()
+        if watcher:
+            return watcher.wait(task, description)
+        return wait_for_task(task, description=description)
+
+    return with_retry(attempt, description, idempotent=idempotent)
 
 
 # def vm_power_off(vm):
@@ -62,15 +107,17 @@ def wait_for_task(task, description="Операция"):
 #     else:
 #         print(f"[!] ВМ {vm.name} уже выключена.")
 
-def vm_power_off(vm, shutdown_timeout=60, poweroff_timeout=10):
+def vm_power_off(vm, shutdown_timeout=None, poweroff_timeout=10, watcher=None):
     """
     Выключает виртуальную машину с попыткой graceful shutdown через гостевую ОС.
     Если гостевые инструменты недоступны или выключение не завершается в течение shutdown_timeout,
     выполняется принудительное выключение (power off).
 
     :param vm: Объект виртуальной машины
-    :param shutdown_timeout: Таймаут ожидания graceful shutdown (секунды)
+    :param shutdown_timeout: Таймаут ожидания graceful shutdown (секунды);
+                             по умолчанию подбирается по истории выключений для типа ОС
     :param poweroff_timeout: Таймаут ожидания принудительного выключения (секунды)
+    :param watcher: Общий наблюдатель за состоянием питания (vm_power.power_state_watcher)
     """
     if vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
         print(f"[!] ВМ {vm.name} уже выключена.")
@@ -87,21 +134,28 @@ def vm_power_off(vm, shutdown_timeout=60, poweroff_timeout=10):
 
             # 2. Пробуем выполнить graceful shutdown
             try:
-                vm.ShutdownGuest()
-                print(f"[*] Ожидаем завершения работы (таймаут {shutdown_timeout} сек)...")
-
-                # 3. Ожидаем выключения
+                os_type = vm_detect_os_type(vm)
+                if shutdown_timeout is None:
+                    shutdown_timeout = shutdown_timeout_for(os_type)
                 start_time = time.time()
-                while time.time() - start_time < shutdown_timeout:
-                    if vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
-                        print(f"[+] ВМ {vm.name} успешно выключена через graceful shutdown.")
-                        print("=" * 70)
-                        return
-                    time.sleep(2)
-
-                print(f"[!] ВМ {vm.name} не выключилась за {shutdown_timeout} сек")
+                vm.ShutdownGuest()
+                print(f"[*] Ожидаем завершения работы (таймаут {shutdown_timeout:.0f} сек)...")
+
+                # 3. Ожидаем выключения по уведомлению об изменении состояния питания
+                if wait_for_power_off(vm, shutdown_timeout, watcher):
+                    record_shutdown(os_type, time.time() - start_time)
+                    print(f"[+] ВМ {vm.name} успешно выключена через graceful shutdown "
+                          f"за {time.time() - start_time:.0f} сек.")
+                    print("=" * 70)
+                    return
+
+                # Выключение заняло бы не меньше таймаута — следующий таймаут будет больше
+                record_shutdown(os_type, shutdown_timeout)
+                print(f"[!] ВМ {vm.name} не выключилась за {shutdown_timeout:.0f} сек")
                 print("=" * 70)
 
+            except OperationCancelled:
+                raise
             except Exception as shutdown_error:
                 print(f"[!] Ошибка graceful shutdown: {str(shutdown_error)}")
                 print("=" * 70)
@@ -110,6 +164,8 @@ def vm_power_off(vm, shutdown_timeout=60, poweroff_timeout=10):
             print(f"[!] VMware Tools не работают (status: {tools_status})")
             print("=" * 70)
 
+    except OperationCancelled:
+        raise
     except Exception as tools_check_error:
         print(f"[!] Ошибка проверки VMware Tools: {str(tools_check_error)}")
         print("=" * 70)
@@ -117,19 +173,92 @@ def vm_power_off(vm, shutdown_timeout=60, poweroff_timeout=10):
     # 4. Если graceful shutdown не сработал или Tools не доступны - выполняем power off
     print(f"[*] Выполняем принудительное выключение (power off)...")
     try:
-        task = vm.PowerOffVM_Task()
-        wait_for_task(task, description=f"Принудительное выключение ВМ {vm.name}")
+        run_task(vm.PowerOffVM_Task, f"Принудительное выключение ВМ {vm.name}", idempotent=False)
         print(f"[+] ВМ {vm.name} успешно выключена через power off.")
+    except OperationCancelled:
+        raise
     except Exception as poweroff_error:
         print(f"[!!!] Критическая ошибка при power off ВМ {vm.name}: {str(poweroff_error)}")
     finally:
         print("=" * 70)
 
+
+def vm_power_off_many(si, vms, shutdown_timeout=None):
+    """
+    Выключает группу ВМ параллельно: ShutdownGuest отправляется всем ВМ сразу,
+    выключение отслеживается одним наблюдателем, а принудительный power off
+    выполняется только для ВМ, не успевших выключиться за свой таймаут.
+    Возвращает {имя ВМ: {'status', 'message', 'seconds'}}.
+    """
+    results = {}
+    start_time = time.time()
+    watcher = power_state_watcher(si)
+    try:
+        pending = []
+        stragglers = []
+        for vm in vms:
+            if vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
+                results[vm.name] = {'status': 'success', 'message': 'ВМ уже выключена', 'seconds': 0}
+                continue
+            watcher.watch(vm)
+            if getattr(vm.guest, 'toolsRunningStatus', None) != 'guestToolsRunning':
+                stragglers.append(vm)
+                continue
+            try:
+                os_type = vm_detect_os_type(vm)
+                vm.ShutdownGuest()
+                pending.append((vm, os_type, shutdown_timeout or shutdown_timeout_for(os_type), time.time()))
+            except Exception as e:
+                print(f"[!] {vm.name}: ошибка graceful shutdown: {e}")
+                stragglers.append(vm)
+
+        print(f"[*] Выключение {len(vms)} ВМ: ShutdownGuest отправлен {len(pending)}, "
+              f"будут выключены принудительно {len(stragglers)}")
+
+        def wait_one(entry):
+            vm, os_type, timeout, started = entry
+            if watcher.wait_until(vm, is_powered_off, timeout - (time.time() - started)):
+                seconds = time.time() - started
+                record_shutdown(os_type, seconds)
+                results[vm.name] = {'status': 'success', 'message': 'Graceful shutdown', 'seconds': round(seconds, 1)}
+                return None
+            record_shutdown(os_type, timeout)
+            print(f"[!] ВМ {vm.name} не выключилась за {timeout:.0f} сек")
+            return vm
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(len(pending), 32), thread_name_prefix="shutdown") as pool:
+                stragglers += [vm for vm in pool.map(wait_one, pending) if vm is not None]
+
+        # Принудительно выключаем оставшиеся ВМ — тоже все сразу
+        tasks = []
+        for vm in stragglers:
+            try:
+                tasks.append((vm, vm.PowerOffVM_Task()))
+            except Exception as e:
+                results[vm.name] = {'status': 'error', 'message': str(e), 'seconds': round(time.time() - start_time, 1)}
+        for vm, task in tasks:
+            try:
+                wait_for_task(task, description=f"Принудительное выключение ВМ {vm.name}")
+                results[vm.name] = {'status': 'success', 'message': 'Power off',
+                                    'seconds': round(time.time() - start_time, 1)}
+            except Exception as e:
+                results[vm.name] = {'status': 'error', 'message': str(e),
+                                    'seconds': round(time.time() - start_time, 1)}
+    finally:
+        watcher.close()
+
+    forced = sum(1 for result in results.values() if result['message'] == 'Power off')
+    print(f"[+] Выключено {len(results)} ВМ за {time.time() - start_time:.0f} сек "
+          f"(принудительно: {forced})")
+    print("=" * 70)
+    return results
+
+
 def vm_power_on(vm):
     if vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
         print(f"[*] Запускаем ВМ {vm.name} ...")
-        task = vm.PowerOnVM_Task()
-        wait_for_task(task, description=f"Запуск ВМ {vm.name}")
+        run_task(vm.PowerOnVM_Task, f"Запуск ВМ {vm.name}", idempotent=False)
         print(f"[+] ВМ {vm.name} успешно запущена.")
     else:
         print(f"[!] ВМ {vm.name} уже запущена.")
@@ -137,6 +266,117 @@ def vm_power_on(vm):
     print("=" * 70)
 
 
+def _vm_datacenter(vm):
+    """Datacenter, в котором находится ВМ (None для standalone ESXi без иерархии)"""
+    parent = vm.parent
+    while parent is not None and not isinstance(parent, vim.Datacenter):
+        parent = parent.parent
+    return parent
+
+
+def _power_on_wave(si, vms, results, start_time):
+    """
+    Запускает набор ВМ одновременно. На vCenter — одной задачей
+    Datacenter.PowerOnMultiVM_Task на каждый datacenter (размещение выполняет DRS),
+    на ESXi — отдельными PowerOnVM_Task, которые выполняются параллельно.
+    """
+    def done(vm, error=None):
+        results[vm.name] = {'status': 'error' if error else 'success',
+                            'message': str(error) if error else 'ВМ запущена',
+                            'seconds': round(time.time() - start_time, 1)}
+
+    tasks = []
+
+    def start_each(vms_to_start):
+        # Ошибка запуска одной ВМ не должна прерывать волну
+        for vm in vms_to_start:
+            try:
+                tasks.append((vm, vm.PowerOnVM_Task()))
+            except Exception as e:
+                done(vm, e)
+
+    if is_vcenter(si):
+        by_datacenter = {}
+        for vm in vms:
+            datacenter = _vm_datacenter(vm)
+            by_datacenter.setdefault(datacenter._moId if datacenter else None, (datacenter, []))[1].append(vm)
+        for datacenter, datacenter_vms in by_datacenter.values():
+            if datacenter is None:
+                start_each(datacenter_vms)
+                continue
+            try:
+                result = wait_for_task(datacenter.PowerOnMultiVM_Task(vm=datacenter_vms),
+                                       f"Групповой запуск ВМ в {datacenter.name}")
+            except Exception as e:
+                for vm in datacenter_vms:
+                    done(vm, e)
+                continue
+            by_id = {vm._moId: vm for vm in datacenter_vms}
+            for attempted in result.attempted or []:
+                vm = by_id.get(attempted.vm._moId, attempted.vm)
+                if attempted.task:
+                    tasks.append((vm, attempted.task))
+                else:
+                    # DRS в ручном режиме: задача не создаётся, нужна рекомендация
+                    done(vm, Exception("DRS не запустил ВМ автоматически (рекомендация не применена)"))
+            for not_attempted in result.notAttempted or []:
+                vm = by_id.get(not_attempted.vm._moId, not_attempted.vm)
+                fault = not_attempted.fault
+                done(vm, Exception(getattr(fault, 'localizedMessage', None) or str(fault)))
+    else:
+        start_each(vms)
+
+    for vm, task in tasks:
+        try:
+            wait_for_task(task, description=f"Запуск ВМ {vm.name}")
+            done(vm)
+        except Exception as e:
+            done(vm, e)
+
+
+def vm_power_on_many(si, vms, boot_order=None, stagger=0, wave_size=0):
+    """
+    Запускает группу ВМ волнами. boot_order — {имя ВМ: порядок} (столбец bootOrder CSV):
+    ВМ с меньшим порядком запускаются раньше, ВМ с одинаковым — одновременно.
+    wave_size ограничивает число ВМ, запускаемых разом, stagger — пауза между волнами (сек),
+    чтобы не создавать «шторм загрузок» на хранилище.
+    Возвращает {имя ВМ: {'status', 'message', 'seconds'}}.
+    """
+    results = {}
+    start_time = time.time()
+
+    to_start = []
+    for vm in vms:
+        if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
+            results[vm.name] = {'status': 'success', 'message': 'ВМ уже запущена', 'seconds': 0}
+        else:
+            to_start.append(vm)
+
+    def order_of(vm):
+        try:
+            return int((boot_order or {}).get(vm.name) or 0)
+        except ValueError:
+            return 0
+
+    waves = []
+    for order in sorted({order_of(vm) for vm in to_start}):
+        same_order = [vm for vm in to_start if order_of(vm) == order]
+        step = wave_size if wave_size and wave_size > 0 else len(same_order)
+        waves += [same_order[i:i + step] for i in range(0, len(same_order), step)]
+
+    print(f"[*] Запуск {len(to_start)} ВМ ({len(vms) - len(to_start)} уже запущены), волн: {len(waves)}")
+    for number, wave in enumerate(waves, 1):
+        if number > 1 and stagger:
+            current_token().sleep(stagger, "Запуск ВМ волнами")
+        print(f"[*] Волна {number}/{len(waves)}: {', '.join(vm.name for vm in wave)}")
+        _power_on_wave(si, wave, results, start_time)
+
+    failed = sum(1 for result in results.values() if result['status'] == 'error')
+    print(f"[+] Запущено {len(results) - failed} из {len(results)} ВМ за {time.time() - start_time:.0f} сек")
+    print("=" * 70)
+    return results
+
+
 def vm_reboot(vm):
     if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
         print(f"[*] Перезапуск ВМ {vm.name} ...")
@@ -162,91 +402,108 @@ def is_vcenter(si):
         return False
 
 
+# ====================== ПОДГОТОВКА ИСХОДНОЙ ВМ ======================
+def prepare_clone_source(si, source_vm_name, source_snapshot_name=None):
+    """
+    Находит исходную ВМ и снапшот, из которого будет выполняться клонирование.
+    Возвращает словарь: vm, snapshot_tree (или None), change_version.
+    """
+    print(f"[*] Подготовка исходной ВМ '{source_vm_name}'" +
+          (f" (снапшот '{source_snapshot_name}')" if source_snapshot_name else "") + "...")
+
+    from vm_list import get_vm_by_name
+    source_vm = get_vm_by_name(si, source_vm_name)
+    if not source_vm:
+        raise Exception(f"Исходная ВМ '{source_vm_name}' не найдена")
+
+    snapshot_tree = None
+    if source_snapshot_name:
+        from vm_snapshot import find_snapshot
+        snapshot_tree = find_snapshot(source_vm, source_snapshot_name, refresh=True)
+        if not snapshot_tree:
+            print(f"[!] Снапшот '{source_snapshot_name}' не найден. Будет клонировано текущее состояние.")
+
+    return {
+        'vm': source_vm,
+        'snapshot_tree': snapshot_tree,
+        'change_version': source_vm.config.changeVersion
+    }
+
+
 # ====================== ОСНОВНАЯ ФУНКЦИЯ КЛОНИРОВАНИЯ ======================
-def vm_clone(si, vm_config):
-    """Универсальное клонирование: автоматически выбирает метод в зависимости от vCenter/ESXi"""
+def vm_clone(si, vm_config, template_cache=None):
+    """
+    Универсальное клонирование: автоматически выбирает метод в зависимости от vCenter/ESXi.
+    template_cache — кэш подготовленных исходных ВМ на время пакета операций (vm_batch).
+    """
     source_vm_name = vm_config.get('SOURCE_VM_NAME')
     source_snapshot_name = vm_config.get('SOURCE_SNAPSHOT_NAME')
     target_datastore_name = vm_config.get('TARGET_DATASTORE_NAME')
     target_vm_name = vm_config.get('TARGET_VM_NAME')
-    cpu_count = int(cpu) if (cpu := vm_config.get('CPU_COUNT')) else None
-    memory_mb = int(mem) if (mem := vm_config.get('MEMORY_MB')) else None
 
     if not all([source_vm_name, target_vm_name, target_datastore_name]):
         raise Exception("Не указаны обязательные параметры для клонирования (SOURCE_VM_NAME, TARGET_VM_NAME, TARGET_DATASTORE_NAME)")
 
     print(f"[*] Клонирование '{source_vm_name}' → '{target_vm_name}'")
 
-    from vm_list import get_vm_by_name
-    source_vm = get_vm_by_name(si, source_vm_name)
-    if not source_vm:
-        raise Exception(f"Исходная ВМ '{source_vm_name}' не найдена")
+    if template_cache is not None:
+        source = template_cache.get(source_vm_name, source_snapshot_name)
+    else:
+        source = prepare_clone_source(si, source_vm_name, source_snapshot_name)
 
     # Автоопределение типа подключения
     if is_vcenter(si):
         print("[*] Обнаружен vCenter → используем быстрый метод CloneVM_Task")
-        return clone_via_vcenter(si, source_vm, vm_config)
+        return clone_via_vcenter(si, source['vm'], vm_config, source['snapshot_tree'])
     else:
         print("[*] Обнаружен standalone ESXi → используем vmkfstools")
-        return clone_via_esxi(si, source_vm, vm_config)
+        return clone_via_esxi(si, source['vm'], vm_config, source['snapshot_tree'])
 
 
 # ====================== БЫСТРЫЙ МЕТОД ЧЕРЕЗ VCENTER ======================
-def clone_via_vcenter(si, source_vm, vm_config):
+def clone_via_vcenter(si, source_vm, vm_config, snapshot_tree=None):
     """Метод клонирования через vCenter"""
     target_vm_name = vm_config.get('TARGET_VM_NAME')
     target_datastore_name = vm_config.get('TARGET_DATASTORE_NAME')
-    cpu_count = int(cpu) if (cpu := vm_config.get('CPU_COUNT')) else None
-    memory_mb = int(mem) if (mem := vm_config.get('MEMORY_MB')) else None
 
     datastore = next((ds for ds in source_vm.runtime.host.datastore if ds.name == target_datastore_name), None)
     if not datastore:
         raise Exception(f"Datastore '{target_datastore_name}' не найден на хосте")
 
-    # Выключаем ВМ
-    vm_power_off(source_vm)
+    # Клонируем напрямую из состояния снапшота: исходная ВМ не выключается
+    # и не откатывается, поэтому клоны одного шаблона не мешают друг другу
+    source_devices = (snapshot_tree.snapshot.config if snapshot_tree else source_vm.config).hardware.device
 
-    # Откат к снапшоту
-    if vm_config.get('SOURCE_SNAPSHOT_NAME'):
-        from vm_snapshot import revert_to_snapshot
-        try:
-            revert_to_snapshot(source_vm, vm_config['SOURCE_SNAPSHOT_NAME'])
-        except Exception as e:
-            print(f"[i] Снапшот не найден или ошибка отката: {e}")
-
-    # Отключаем DVD-приводы
-    config_spec = vim.vm.ConfigSpec()
-    devices_to_edit = []
-    for dev in source_vm.config.hardware.device:
-        if isinstance(dev, vim.vm.device.VirtualCdrom):
-            cd_spec = vim.vm.device.VirtualDeviceSpec()
-            cd_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
-            cd_spec.device = dev
-            cd_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-            cd_spec.device.connectable.connected = False
-            cd_spec.device.connectable.startConnected = False
-            devices_to_edit.append(cd_spec)
-
-    if devices_to_edit:
-        config_spec.deviceChange = devices_to_edit
-        task = source_vm.ReconfigVM_Task(config_spec)
-        wait_for_task(task)
+    # CPU/RAM, удаление DVD-приводов и сеть применяются в самом клонировании,
+    # отдельный ReconfigVM_Task после него не нужен
+    from vm_hardware import hardware_from_config, build_config_spec
+    config_spec = build_config_spec(source_devices, source_vm.runtime.host, hardware_from_config(vm_config),
+                                    remove_cdrom=True)
+
+    # Режим cloud-init: сеть и hostname уходят в guestinfo вместе с клоном
+    from vm_guestinfo import uses_guestinfo, guestinfo_extra_config
+    if uses_guestinfo(vm_config):
+        config_spec.extraConfig = guestinfo_extra_config(vm_config)
 
     # Клонирование
     relocate_spec = vim.vm.RelocateSpec(datastore=datastore, diskMoveType='moveAllDiskBackingsAndDisallowSharing')
     clone_spec = vim.vm.CloneSpec(
         location=relocate_spec,
         powerOn=False,
-        config=vim.vm.ConfigSpec(numCPUs=cpu_count, memoryMB=memory_mb)
+        config=config_spec
     )
+    if snapshot_tree:
+        clone_spec.snapshot = snapshot_tree.snapshot
 
     print(f"[*] Клонируем ВМ через vCenter...")
     task = source_vm.CloneVM_Task(folder=source_vm.parent, name=target_vm_name, spec=clone_spec)
 
-    with tqdm(total=100, desc="Клонирование", bar_format="{desc}: {percentage:3.0f}%|{bar}| {elapsed} прошло") as pbar:
+    token = current_token()
+    with tqdm(total=100, desc="Клонирование", bar_format="{desc}: {percentage:3.0f}%|{bar}| {elapsed} прошло") as pbar, \
+            token.on_cancel(lambda: cancel_vsphere_task(task)):
         last_progress = 0
-        while task.info.state == vim.TaskInfo.State.running:
-            time.sleep(1)
+        while task.info.state in (vim.TaskInfo.State.queued, vim.TaskInfo.State.running):
+            token.sleep(1, f"Клонирование ВМ '{target_vm_name}'")
             current_progress = getattr(task.info, 'progress', last_progress)
             if current_progress is not None:
                 pbar.n = current_progress
@@ -265,137 +522,169 @@ def clone_via_vcenter(si, source_vm, vm_config):
 import paramiko
 
 
+def datastore_path_to_vmfs(datastore_path):
+    """'[datastore1] vm/vm.vmdk' → '/vmfs/volumes/datastore1/vm/vm.vmdk'"""
+    datastore_name, _, relative_path = datastore_path.partition('] ')
+    return f"/vmfs/volumes/{datastore_name.lstrip('[')}/{relative_path}"
+
+
+def vmx_disk_id(disk, devices):
+    """Идентификатор диска в .vmx (например scsi0:0) по контроллеру и номеру юнита"""
+    controller = next((dev for dev in devices if dev.key == disk.controllerKey), None)
+    if isinstance(controller, vim.vm.device.VirtualSCSIController):
+        prefix = 'scsi'
+    elif isinstance(controller, vim.vm.device.VirtualSATAController):
+        prefix = 'sata'
+    elif isinstance(controller, vim.vm.device.VirtualNVMEController):
+        prefix = 'nvme'
+    elif isinstance(controller, vim.vm.device.VirtualIDEController):
+        prefix = 'ide'
+    else:
+        raise Exception(f"Неизвестный контроллер диска '{disk.deviceInfo.label}'")
+    return f"{prefix}{controller.busNumber}:{disk.unitNumber}"
+
+
+def apply_snapshot_config_to_vmx(vmx, snapshot_config):
+    """
+    Приводит .vmx, прочитанный с текущей конфигурации ВМ, к конфигурации снапшота:
+    CPU, память, гостевая ОС и набор дисков. Диски, добавленные после снапшота,
+    удаляются из .vmx. Если не совпадают диски или сетевые адаптеры, которые
+    нельзя согласовать (удалены после снапшота), — исключение.
+    """
+    from vmx_file import ethernet_ids
+    hardware = snapshot_config.hardware
+    vmx.set('numvcpus', hardware.numCPU)
+    if hardware.numCoresPerSocket:
+        vmx.set('cpuid.coresPerSocket', hardware.numCoresPerSocket)
+    vmx.set('memSize', hardware.memoryMB)
+    vmx.set('guestOS', snapshot_config.guestId)
+
+    snapshot_disks = {vmx_disk_id(dev, hardware.device) for dev in hardware.device
+                      if isinstance(dev, vim.vm.device.VirtualDisk)}
+    vmx_disks = {key[:-len('.fileName')] for key, value in vmx.items()
+                 if key.lower().endswith('.filename') and value.lower().endswith('.vmdk')
+                 and (vmx.get(f"{key[:-len('.fileName')]}.present") or 'TRUE').lower() == 'true'}
+
+    missing = snapshot_disks - {disk_id.lower() for disk_id in vmx_disks}
+    if missing:
+        raise Exception(f"Диски снапшота {', '.join(sorted(missing))} отсутствуют в текущей конфигурации ВМ. "
+                        f"Клонирование из этого снапшота через vmkfstools невозможно")
+
+    for disk_id in vmx_disks:
+        if disk_id.lower() not in snapshot_disks:
+            print(f"[*] Диск {disk_id} добавлен после снапшота, в клон не попадёт")
+            for key, _ in vmx.items(f"{disk_id}."):
+                vmx.remove(key)
+
+    snapshot_nics = sum(isinstance(dev, vim.vm.device.VirtualEthernetCard) for dev in hardware.device)
+    if snapshot_nics != len(ethernet_ids(vmx)):
+        raise Exception(f"Сетевые адаптеры ВМ изменились после снапшота ({snapshot_nics} → {len(ethernet_ids(vmx))}). "
+                        f"Клонирование из этого снапшота через vmkfstools невозможно")
+
+    return vmx
+
+
 # ====================== АЛЬТЕРНАТИВНЫЙ МЕТОД ДЛЯ ESXi с vmkfstools ======================
-def clone_via_esxi(si, source_vm, vm_config):
+def clone_via_esxi(si, source_vm, vm_config, snapshot_tree=None):
     """Клонирование на standalone ESXi с использованием vmkfstools -i -d thin через SSH"""
     source_vm_name = vm_config.get('SOURCE_VM_NAME')
     target_vm_name = vm_config.get('TARGET_VM_NAME')
     target_datastore_name = vm_config.get('TARGET_DATASTORE_NAME')
-    cpu_count = int(cpu) if (cpu := vm_config.get('CPU_COUNT')) else None
-    memory_mb = int(mem) if (mem := vm_config.get('MEMORY_MB')) else None
-    source_snapshot_name = vm_config.get('SOURCE_SNAPSHOT_NAME')
 
     if not all([source_vm_name, target_vm_name, target_datastore_name]):
         raise Exception("Не указаны обязательные параметры для клонирования")
 
     print(f"[*] Клонирование '{source_vm_name}' → '{target_vm_name}' через vmkfstools (ESXi)")
 
-    # Откат к снапшоту
-    if source_snapshot_name:
-        from vm_snapshot import revert_to_snapshot
-        try:
-            revert_to_snapshot(source_vm, source_snapshot_name)
-        except Exception as e:
-            print(f"[!] Не удалось откатить снапшот: {e}")
-
-    # Выключаем исходную ВМ
-    was_powered_on = source_vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
-    if was_powered_on:
+    # Диски снапшота уже неизменяемы (родительские в цепочке), их можно читать
+    # при работающей ВМ. Текущие диски без снапшота заблокированы — ВМ выключаем.
+    was_powered_on = False
+    if not snapshot_tree and source_vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
+        was_powered_on = True
         vm_power_off(source_vm)
 
-    ssh = None
+    source_devices = (snapshot_tree.snapshot.config if snapshot_tree else source_vm.config).hardware.device
+
+    # SSH-сессия берётся из пула хоста, на котором находится ВМ (esxi_hosts)
+    resources = contextlib.ExitStack()
     try:
-        # Импортируем параметры подключения
-        from esxi_connect import ESXI_HOST, ESXI_USER, ESXI_PASSWORD, ESXI_PORT, SSH_HOST, SSH_USER, SSH_PASSWORD, SSH_PORT
-
-        print(f"[*] Подключение по SSH к {SSH_HOST}...")
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        # Улучшенные параметры подключения для ESXi
-        ssh.connect(
-            hostname=SSH_HOST,
-            username=SSH_USER,
-            password=SSH_PASSWORD,
-            port=SSH_PORT,
-            timeout=20,
-            banner_timeout=10,
-            auth_timeout=10,
-            allow_agent=False,
-            look_for_keys=False
-        )
-        print("[+] SSH подключение успешно")
+        from esxi_connect import ssh_exec
+        from esxi_hosts import endpoint_for
+        endpoint = endpoint_for(vm_config)
+        ssh = resources.enter_context(endpoint.ssh_pool.session())
 
         target_path = f"/vmfs/volumes/{target_datastore_name}/{target_vm_name}"
         print(f"[*] Создаём целевую папку: {target_path}")
-        ssh.exec_command(f"mkdir -p '{target_path}'")
+        ssh_exec(ssh, f"mkdir -p '{target_path}'", check=True)
 
         # Клонируем диски через vmkfstools
         print(f"[*] Клонируем виртуальные диски с помощью vmkfstools...")
-        for device in source_vm.config.hardware.device:
-            if isinstance(device, vim.vm.device.VirtualDisk):
-                backing = device.backing
-                while backing.parent:
-                    backing = backing.parent
-                source_datastore_name = backing.datastore.name
-                # print(f"Datastore : {source_datastore_name}")
-
-        from vm_snapshot import find_snapshot
-        if source_snapshot_name:
-            needed_snapshot_tree = find_snapshot(source_vm, source_snapshot_name)
-            if not needed_snapshot_tree:
-                print(f"Снапшот {source_snapshot_name} не найден. Будет клонирован базовый диск.")
-                source_vmdk_name = f"/vmfs/volumes/{source_datastore_name}/{source_vm.name}/{source_vm.name}.vmdk"
-            else:
-                needed_snapshot = needed_snapshot_tree.snapshot
-
-                for device in needed_snapshot.config.hardware.device:
-                    if isinstance(device, vim.vm.device.VirtualDisk):
-                        source_vmdk_name = device.backing.fileName
-                        source_vmdk_name = f"/vmfs/volumes/{source_datastore_name}/{source_vm.name}/{source_vmdk_name.split('/')[-1]}"
-        else:
-            print(f"Снапшот не указан. Будет клонирован базовый диск.")
-            source_vmdk_name = f"/vmfs/volumes/{source_datastore_name}/{source_vm.name}/{source_vm.name}.vmdk"
-
-        # Новое имя диска в целевой папке
-        target_vmdk_name = f"/vmfs/volumes/{target_datastore_name}/{target_vm_name}/{target_vm_name}.vmdk"
-
-        print(f" → Клонируем:")
-        print(f"{source_vmdk_name}")
-        print("↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓")
-        print(f"{target_vmdk_name}")
-
-        cmd = f'vmkfstools -i "{source_vmdk_name}" "{target_vmdk_name}" -d thin'
-        _, stdout, stderr = ssh.exec_command(cmd)
-
-        output = stdout.read().decode().strip()
-        error_out = stderr.read().decode().strip()
-
-        if output:
-            print(output)
-        if error_out:
-            print(f"[!] {error_out}")
-
-
-
-        # Копируем vmx
-        print(f"[*] Копируем vmx...")
-        vmx_old = f"/vmfs/volumes/{source_datastore_name}/{source_vm.name}/{source_vm.name}.vmx"
-        vmx_new = f"/vmfs/volumes/{target_datastore_name}/{target_vm_name}/{target_vm_name}.vmx"
-
-        cmd = f'cp -r "{vmx_old}" "{vmx_new}" 2>/dev/null || true'
-        _, stdout, stderr = ssh.exec_command(cmd)
-
-        output = stdout.read().decode().strip()
-        error_out = stderr.read().decode().strip()
-
-        if output:
-            print(output)
-        if error_out:
-            print(f"[!] {error_out}")
-
-
-        # Переименовываем .vmx и исправляем содержимое
-        print(f"[*] Обновляем .vmx файл...")
-        ssh.exec_command(f'sed -i "s/{source_vm.name}/{target_vm_name}/g" "{vmx_new}"')
-
-        target_disk_filename = f"{target_vm_name}.vmdk"
-        cmd = f"""sed -i 's|^\\([a-zA-Z0-9]\\+:[0-9]\\+\\.fileName = \\)".*\\.vmdk"|\\1"{target_disk_filename}"|' "{vmx_new}" """
-        ssh.exec_command(cmd)
-
-        ssh.exec_command(f'echo \'uuid.action = "create"\' >> "{vmx_new}"')
+        disk_files = {}
+        disks = [dev for dev in source_devices if isinstance(dev, vim.vm.device.VirtualDisk)]
+        for index, disk in enumerate(disks):
+            source_vmdk_name = datastore_path_to_vmfs(disk.backing.fileName)
+
+            # Снапшот неизменен — копируем диск один раз в кэш на целевом datastore
+            # и дальше клонируем из локальной копии; до конца клонирования
+            # образ не вытесняется из кэша
+            if snapshot_tree:
+                from vm_clone_cache import get_cached_disk
+                source_vmdk_name = resources.enter_context(get_cached_disk(
+                    ssh, source_vm, snapshot_tree, target_datastore_name,
+                    disk.key, source_vmdk_name, endpoint=endpoint.name))
+
+            # Новое имя диска в целевой папке
+            target_disk_filename = f"{target_vm_name}.vmdk" if index == 0 else f"{target_vm_name}_{index}.vmdk"
+            target_vmdk_name = f"{target_path}/{target_disk_filename}"
+            disk_files[vmx_disk_id(disk, source_devices)] = target_disk_filename
+
+            print(f" → Клонируем:")
+            print(f"{source_vmdk_name}")
+            print("↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓↓")
+            print(f"{target_vmdk_name}")
 
+            try:
+                exit_code, output, error_out = ssh_exec(
+                    ssh, f'vmkfstools -i "{source_vmdk_name}" "{target_vmdk_name}" -d thin', kill_on_cancel=True)
+            except OperationCancelled:
+                # Недокопированный диск помешает повторному клонированию
+                ssh_exec(ssh, f'vmkfstools -U "{target_vmdk_name}"')
+                raise
+            if output:
+                print(output)
+            if exit_code != 0:
+                raise Exception(f"vmkfstools не смог клонировать диск: {error_out or output}")
+
+        # Копируем vmx: читаем по SFTP, правим структурно и записываем один раз.
+        # .vmx на datastore соответствует текущей конфигурации ВМ, поэтому
+        # при клонировании из снапшота он приводится к конфигурации снапшота
+        print(f"[*] Копируем и обновляем .vmx файл...")
+        vmx_old = datastore_path_to_vmfs(source_vm.config.files.vmPathName)
+        vmx_new = f"{target_path}/{target_vm_name}.vmx"
+
+        from vmx_file import read_vmx, write_vmx, apply_clone_edits
+        from vm_hardware import hardware_from_config, apply_hardware_to_vmx, find_network
+        from vm_guestinfo import uses_guestinfo, apply_guestinfo_to_vmx
+        hardware = hardware_from_config(vm_config)
+        if hardware['network_name']:
+            find_network(source_vm.runtime.host, hardware['network_name'])
+        sftp = ssh.open_sftp()
+        try:
+            vmx = read_vmx(sftp, vmx_old)
+            if snapshot_tree:
+                apply_snapshot_config_to_vmx(vmx, snapshot_tree.snapshot.config)
+            apply_clone_edits(vmx, target_vm_name, disk_files)
+            apply_hardware_to_vmx(vmx, hardware)
+            if uses_guestinfo(vm_config):
+                apply_guestinfo_to_vmx(vmx, vm_config)
+            write_vmx(sftp, vmx_new, vmx)
+        finally:
+            sftp.close()
+
+        # Диски скопированы — исходную ВМ можно вернуть в прежнее состояние
+        if was_powered_on:
+            vm_power_on(source_vm)
+            was_powered_on = False
 
         # Регистрируем VM
         print(f"[*] Регистрируем новую ВМ '{target_vm_name}'...")
@@ -434,78 +723,39 @@ def clone_via_esxi(si, source_vm, vm_config):
         if not new_vm:
             raise Exception(f"Не удалось найти ВМ '{target_vm_name}'")
 
-        if was_powered_on:
-            vm_power_on(new_vm)
-
         print(f"[+] Клонирование успешно завершено через vmkfstools!")
         print("=" * 70)
 
-        # Переконфигурируем (CPU, RAM)
-        reconfig_vm_after_clone(new_vm, cpu_count, memory_mb)
-
-        if was_powered_on and source_vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
-            vm_power_on(source_vm)
-
         return new_vm
 
+    except OperationCancelled:
+        raise
     except paramiko.SSHException as ssh_err:
         raise Exception(f"Ошибка SSH подключения: {str(ssh_err)}")
     except Exception as e:
         raise Exception(f"Ошибка клонирования через vmkfstools: {str(e)}")
     finally:
-        if ssh:
-            try:
-                ssh.close()
-            except:
-                pass
-
-
-def reconfig_vm_after_clone(vm, cpu_count=None, memory_mb=None):
-    """Настройка новой ВМ после клонирования на ESXi"""
-    config_spec = vim.vm.ConfigSpec()
-
-    if cpu_count:
-        config_spec.numCPUs = cpu_count
-        config_spec.numCoresPerSocket = cpu_count
-
-    if memory_mb:
-        config_spec.memoryMB = memory_mb
-
-    # Удаляем DVD-приводы
-    device_changes = []
-    for dev in vm.config.hardware.device:
-        if isinstance(dev, vim.vm.device.VirtualCdrom):
-            spec = vim.vm.device.VirtualDeviceSpec()
-            spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.remove
-            spec.device = dev
-            device_changes.append(spec)
-
-    if device_changes:
-        config_spec.deviceChange = device_changes
-
-    if config_spec.numCPUs or config_spec.memoryMB or device_changes:
-        task = vm.ReconfigVM_Task(config_spec)
-        wait_for_task(task, "Настройка новой ВМ")
-
-    print("[+] Параметры новой ВМ применены")
+        if was_powered_on:
+            vm_power_on(source_vm)
+        resources.close()
 
 
-def vm_delete(vm):
+def vm_delete(vm, task_watcher=None, power_watcher=None):
     """
     Удаляет ВМ. Предварительно выключает её, если она включена.
+    Возвращает управление только после фактического завершения Destroy_Task;
+    ошибка удаления выбрасывается исключением.
+    task_watcher / power_watcher — общие наблюдатели пакета (vm_watch.TaskWatcher,
+    vm_power.power_state_watcher), без них завершение ожидается опросом задачи.
     """
-    print(f"[*] Удаление ВМ '{vm.name}'...")
-
-    try:
-        if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
-            print(f"[*] ВМ '{vm.name}' включена, выключаем перед удалением.")
-            vm_power_off(vm)
+    vm_name = vm.name
+    print(f"[*] Удаление ВМ '{vm_name}'...")
 
-        task = vm.Destroy_Task()
-        # wait_for_task(task, description=f"Удаление ВМ {vm.name}")
+    if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
+        print(f"[*] ВМ '{vm_name}' включена, выключаем перед удалением.")
+        vm_power_off(vm, watcher=power_watcher)
 
-        print(f"[+] ВМ '{vm.name}' успешно удалена.")
-    except Exception as e:
-        print(f"[!] Ошибка при удалении ВМ '{vm.name}': {e}")
+    run_task(vm.Destroy_Task, f"Удаление ВМ {vm_name}", idempotent=False, watcher=task_watcher)
 
-    print("=" * 70)
\ No newline at end of file
+    print(f"[+] ВМ '{vm_name}' успешно удалена.")
+    print("=" * 70)
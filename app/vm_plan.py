@@ -0,0 +1,394 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pyVmomi import vim
+from vm_batch import SNAPSHOT_MAX_PARALLEL
+from vm_snapshot import get_snapshot_index
+from vm_hardware import hardware_diff, hardware_from_config
+from esxi_hosts import DEFAULT_ENDPOINT, endpoint_name, get_endpoint
+
+# Планировщик пакета операций: операции всех ВМ собираются в граф зависимостей
+# и выполняются параллельно, как только готовы их зависимости, с учётом
+# ограничений на число одновременных операций каждого вида. Ограничения
+# действуют на каждый хост отдельно (esxi_hosts), поэтому пакет на несколько
+# хостов выполняется на всех хостах одновременно.
+
+PLAN_MAX_PARALLEL = int(os.getenv("PLAN_MAX_PARALLEL", "16"))
+CLONE_MAX_PARALLEL = int(os.getenv("CLONE_MAX_PARALLEL", "4"))
+HARDWARE_MAX_PARALLEL = int(os.getenv("HARDWARE_MAX_PARALLEL", "8"))
+POWER_MAX_PARALLEL = int(os.getenv("POWER_MAX_PARALLEL", "16"))
+
+# Порядок операций одной ВМ независимо от порядка в интерфейсе:
+# удаление перед повторным клонированием, откат до изменений, настройка ОС
+# после изменения железа (пока ВМ выключена после клонирования),
+# снапшот — по готовой ВМ, питание — в конце.
+PLAN_ORDER = ['delete', 'clone', 'revert', 'hardware', 'customize', 'snapshot', 'poweroff', 'poweron']
+
+# Служебный шаг: подготовка исходной ВМ перед клонами, которые её используют
+PREPARE = 'prepare'
+
+# Ограничения параллельности по видам операций (None — ограничивает сам исполнитель операции,
+# например очередь удаления или пул настройки гостевых ОС)
+OPERATION_LIMITS = {
+    PREPARE: CLONE_MAX_PARALLEL,
+    'clone': CLONE_MAX_PARALLEL,
+    'hardware': HARDWARE_MAX_PARALLEL,
+    'snapshot': SNAPSHOT_MAX_PARALLEL,
+    'revert': SNAPSHOT_MAX_PARALLEL,
+    'poweroff': POWER_MAX_PARALLEL,
+    'poweron': POWER_MAX_PARALLEL,
+    'delete': None,
+    'customize': None,
+}
+
+# Относительная длительность операций — для выбора порядка: первыми запускаются
+# шаги с самой длинной цепочкой зависящих от них операций
+OPERATION_COST = {
+    PREPARE: 3, 'delete': 2, 'clone': 10, 'revert': 2, 'hardware': 1,
+    'customize': 8, 'snapshot': 3, 'poweroff': 2, 'poweron': 1,
+}
+
+# Состояние питания, в котором операция оставляет ВМ (None — неизвестно);
+# hardware и snapshot восстанавливают исходное состояние и в таблицу не входят
+_LEAVES_POWER = {'delete': None, 'clone': 'off', 'revert': None, 'customize': None,
+                 'poweroff': 'off', 'poweron': 'on'}
+
+
+def step_key(vm_name, operation):
+    return f"{vm_name}_{operation}"
+
+
+def build_plan(vm_operations, vm_config_map):
+    """
+    Строит граф шагов по выбранным в интерфейсе операциям.
+    Возвращает {ключ: шаг}, шаг — словарь:
+      'key', 'vm', 'operation', 'deps' (ключи шагов), 'merged_into' (ключ шага,
+      который выполняет эту операцию заодно, или None), 'hidden' (служебный шаг),
+      'endpoint' (хост ВМ), 'priority' (длина критического пути), 'options' (данные из запроса).
+    """
+    steps = {}
+    chains = {}
+
+    for vm_data in vm_operations:
+        vm_name = vm_data['vm']
+        operations = sorted(set(vm_data.get('operations', [])), key=PLAN_ORDER.index)
+        options = {key: value for key, value in vm_data.items() if key not in ('vm', 'operations')}
+        endpoint = endpoint_name(vm_config_map.get(vm_name))
+        chain = []
+        power = None
+        for operation in operations:
+            step = {
+                'key': step_key(vm_name, operation),
+                'vm': vm_name,
+                'operation': operation,
+                'deps': set(),
+                'merged_into': None,
+                'hidden': False,
+                'endpoint': endpoint,
+                'options': options,
+            }
+
+            # Железо задаётся при клонировании из той же строки CSV — отдельный шаг не нужен
+            if operation == 'hardware' and 'clone' in operations:
+                step['merged_into'] = step_key(vm_name, 'clone')
+            # Выключение сразу после шага, который уже оставил ВМ выключенной
+            elif operation == 'poweroff' and power == 'off':
+                step['merged_into'] = chain[-1]['key']
+            elif chain:
+                step['deps'].add(chain[-1]['key'])
+
+            if not step['merged_into']:
+                chain.append(step)
+                if operation in _LEAVES_POWER:
+                    power = _LEAVES_POWER[operation]
+            steps[step['key']] = step
+        chains[vm_name] = chain
+
+    # Зависимости между ВМ: подготовка исходной ВМ перед клонами;
+    # исходная ВМ, которая сама пересоздаётся в пакете, должна быть готова к этому моменту;
+    # исходную ВМ, которая удаляется, удаляем только после всех её клонов.
+    # Исходная ВМ ищется на хосте клона: у каждого хоста свои шаблоны
+    for vm_name, chain in chains.items():
+        clone = steps.get(step_key(vm_name, 'clone'))
+        if not clone:
+            continue
+        config = vm_config_map.get(vm_name, {})
+        source_name = config.get('SOURCE_VM_NAME')
+        if not source_name:
+            continue
+
+        endpoint = clone['endpoint']
+        same_host = endpoint_name(vm_config_map.get(source_name)) == endpoint
+        source_chain = chains.get(source_name, []) if same_host else []
+        source_steps = [step for step in source_chain if step['operation'] != 'delete']
+        source_delete = steps.get(step_key(source_name, 'delete')) if same_host else None
+        if source_steps:
+            depends_on = source_steps[-1]['key']
+        else:
+            depends_on = None
+            if source_delete:
+                source_delete['deps'].add(clone['key'])
+
+        snapshot_name = config.get('SOURCE_SNAPSHOT_NAME') or ''
+        source = f"{source_name}@{snapshot_name}"
+        if endpoint != DEFAULT_ENDPOINT:
+            source = f"{endpoint}/{source}"
+        prepare_key = step_key(source, PREPARE)
+        if prepare_key not in steps:
+            steps[prepare_key] = {
+                'key': prepare_key,
+                'vm': source_name,
+                'operation': PREPARE,
+                'deps': set(),
+                'merged_into': None,
+                'hidden': True,
+                'endpoint': endpoint,
+                'options': {'snapshot_name': snapshot_name},
+            }
+        if depends_on:
+            steps[prepare_key]['deps'].add(depends_on)
+        clone['deps'].add(prepare_key)
+
+    _assign_priorities(steps)
+    return steps
+
+
+def _assign_priorities(steps):
+    dependents = {key: [] for key in steps}
+    for step in steps.values():
+        for dep in step['deps']:
+            dependents[dep].append(step['key'])
+
+    priorities = {}
+
+    def priority(key):
+        if key not in priorities:
+            priorities[key] = 0  # защита от циклов
+            step = steps[key]
+            own = 0 if step['merged_into'] else OPERATION_COST.get(step['operation'], 1)
+            priorities[key] = own + max((priority(child) for child in dependents[key]), default=0)
+        return priorities[key]
+
+    for key in steps:
+        steps[key]['priority'] = priority(key)
+
+
+def step_satisfied(step, journal_status, vm, vm_config):
+    """
+    Можно ли не выполнять шаг при продолжении пакета: по журналу шаг завершён,
+    или он был начат и текущее состояние инфраструктуры показывает, что он
+    успел выполниться. vm — ВМ шага или None, если её нет в inventory.
+    """
+    operation = step['operation']
+    if operation == PREPARE or journal_status == 'error':
+        return False
+    if journal_status == 'success':
+        return True
+
+    if operation == 'delete':
+        return vm is None
+    if operation == 'clone':
+        return vm is not None
+    if vm is None:
+        return False
+    if operation == 'hardware':
+        return not any(hardware_diff(vm, hardware_from_config(vm_config)).values())
+    if journal_status != 'active':
+        return False
+    # Шаг был начат: проверяем, дошёл ли он до конца
+    if operation == 'snapshot':
+        name = step['options'].get('snapshot_name') or vm_config.get('TARGET_SNAPSHOT_NAME')
+        return bool(name) and name in get_snapshot_index(vm, refresh=True).by_name
+    if operation == 'poweroff':
+        return vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOff
+    if operation == 'poweron':
+        return vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
+    return False
+
+
+def completed_steps(steps, journal, vm_lookup, vm_config_map):
+    """
+    Шаги, которые при продолжении пакета выполнять не нужно. Шаг считается
+    выполненным, только если выполнены все шаги, от которых он зависит:
+    после повторного удаления ВМ заново выполняется и всё, что идёт за ним.
+    journal — {ключ шага: статус из журнала}, vm_lookup(имя) — ВМ или None.
+    """
+    completed = set()
+    visited = {}
+
+    def visit(key):
+        if key in visited:
+            return visited[key]
+        visited[key] = False
+        step = steps[key]
+        if step['operation'] == PREPARE:
+            # Подготовка источника не делает клон выполненным или невыполненным
+            done = True
+        elif step['merged_into']:
+            done = visit(step['merged_into'])
+        else:
+            done = all(visit(dep) for dep in step['deps']) and step_satisfied(
+                step, journal.get(key), vm_lookup(step['vm']), vm_config_map.get(step['vm'], {}))
+        visited[key] = done
+        if done and step['operation'] != PREPARE:
+            completed.add(key)
+        return done
+
+    for key in steps:
+        visit(key)
+
+    # Подготовка источника нужна, только если остались невыполненные клоны
+    for key, step in steps.items():
+        if step['operation'] == PREPARE:
+            dependents = [other for other in steps.values() if key in other['deps']]
+            if all(other['key'] in completed for other in dependents):
+                completed.add(key)
+    return completed
+
+
+def print_plan(steps):
+    visible = [step for step in steps.values() if not step['merged_into']]
+    merged = [step for step in steps.values() if step['merged_into']]
+    print(f"[*] План операций: {len(visible)} шагов"
+          + (f", объединено {len(merged)}" if merged else ""))
+    for step in sorted(visible, key=lambda s: -s['priority']):
+        deps = f" после {', '.join(sorted(step['deps']))}" if step['deps'] else ""
+        print(f"  {step['key']}{deps}")
+    for step in merged:
+        print(f"  {step['key']} → выполняется в {step['merged_into']}")
+    print("=" * 70)
+
+
+class PlanExecutor:
+    """
+    Выполняет граф шагов: готовые шаги запускаются в порядке приоритета,
+    не превышая на каждом хосте OPERATION_LIMITS по видам операций и
+    max_parallel хоста, а всего — max_workers (по умолчанию PLAN_MAX_PARALLEL
+    на каждый хост пакета).
+    run_step(step) выполняет шаг (ошибка — исключение), on_update(step, status, error)
+    сообщает о смене статуса: 'active', 'success' или 'error'.
+    Шаги, зависящие от неудавшихся, не выполняются и получают статус 'error'.
+    completed — шаги, уже выполненные ранее (продолжение пакета по журналу).
+    """
+
+    def __init__(self, steps, run_step, on_update=None, max_workers=None, limits=None,
+                 completed=()):
+        endpoints = {step['endpoint'] for step in steps.values()} or {DEFAULT_ENDPOINT}
+        max_workers = max_workers or PLAN_MAX_PARALLEL * len(endpoints)
+        self.steps = steps
+        self.run_step = run_step
+        self.on_update = on_update
+        self.limits = OPERATION_LIMITS if limits is None else limits
+        self.endpoint_limits = {name: get_endpoint(name).max_parallel for name in endpoints}
+        self.pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="plan")
+        self.max_workers = max(1, max_workers)
+        self.cond = threading.Condition()
+        self.status = {key: 'success' if key in completed else 'waiting' for key in steps}
+        self.completed = set(completed)
+        self.running = {}  # {(хост, операция): число выполняющихся шагов}
+        self.cancelled = False
+        self.thread = None
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        # Шаги, выполненные до продолжения пакета, сразу отмечаются успешными
+        for key in self.completed:
+            if self.on_update:
+                self.on_update(self.steps[key], 'success', None)
+        self.thread = threading.Thread(target=self._loop, name="Планировщик операций", daemon=True)
+        self.thread.start()
+
+    def _update(self, step, status, error=None):
+        with self.cond:
+            self.status[step['key']] = status
+            self.cond.notify_all()
+        if self.on_update:
+            self.on_update(step, status, error)
+
+    def _ready_steps(self):
+        ready = []
+        for key, step in self.steps.items():
+            if self.status[key] != 'waiting' or step['merged_into']:
+                continue
+            dep_status = [self.status[dep] for dep in step['deps']]
+            if any(status == 'error' for status in dep_status):
+                ready.append((step, 'skip'))
+            elif all(status == 'success' for status in dep_status):
+                ready.append((step, 'run'))
+        ready.sort(key=lambda item: -item[0]['priority'])
+        return ready
+
+    def _has_capacity(self, step):
+        if sum(self.running.values()) >= self.max_workers:
+            return False
+        endpoint, operation = step['endpoint'], step['operation']
+        on_endpoint = sum(count for (host, _), count in self.running.items() if host == endpoint)
+        if on_endpoint >= self.endpoint_limits[endpoint]:
+            return False
+        limit = self.limits.get(operation)
+        return limit is None or self.running.get((endpoint, operation), 0) < limit
+
+    def _loop(self):
+        while True:
+            to_run, to_skip = [], []
+            with self.cond:
+                if self.cancelled:
+                    break
+                for step, action in self._ready_steps():
+                    if action == 'skip':
+                        to_skip.append(step)
+                    elif self._has_capacity(step):
+                        slot = (step['endpoint'], step['operation'])
+                        self.running[slot] = self.running.get(slot, 0) + 1
+                        self.status[step['key']] = 'active'
+                        to_run.append(step)
+                if not to_run and not to_skip:
+                    if not any(status in ('waiting', 'active') for key, status in self.status.items()
+                               if not self.steps[key]['merged_into']):
+                        break
+                    self.cond.wait()
+                    continue
+
+            for step in to_skip:
+                failed = [dep for dep in step['deps'] if self.status[dep] == 'error']
+                self._finish(step, Exception(f"пропущено: не выполнен шаг {', '.join(failed)}"))
+            for step in to_run:
+                self._update(step, 'active')
+                self.pool.submit(self._run, step)
+
+        self.pool.shutdown(wait=True)
+
+    def _run(self, step):
+        error = None
+        try:
+            self.run_step(step)
+        except Exception as e:
+            error = e
+        with self.cond:
+            self.running[(step['endpoint'], step['operation'])] -= 1
+        self._finish(step, error)
+
+    def _finish(self, step, error):
+        status = 'error' if error else 'success'
+        self._update(step, status, error)
+        # Объединённые шаги получают результат шага, который их выполнил
+        for merged in self.steps.values():
+            if merged['merged_into'] == step['key']:
+                self._update(merged, status, error)
+
+    def done(self):
+        return self.thread is None or not self.thread.is_alive()
+
+    def wait(self):
+        if self.thread:
+            self.thread.join()
+        print(f"[+] План операций выполнен за {time.time() - (self.start_time or time.time()):.0f} сек")
+        print("=" * 70)
+
+    def cancel(self):
+        """Новые шаги не запускаются; уже запущенные доработают"""
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
@@ -0,0 +1,110 @@
+import os
+import json
+import threading
+from pyVmomi import vim
+from vm_watch import PropertyWatcher
+
+# Ожидание смены состояния питания по уведомлениям PropertyCollector
+# и таймауты graceful shutdown, подобранные по истории выключений.
+# История хранится по типу ОС в json-файле рядом с exe.
+
+SHUTDOWN_TIMEOUT_DEFAULT = float(os.getenv("SHUTDOWN_TIMEOUT", "60"))
+SHUTDOWN_TIMEOUT_MIN = float(os.getenv("SHUTDOWN_TIMEOUT_MIN", "20"))
+SHUTDOWN_TIMEOUT_MAX = float(os.getenv("SHUTDOWN_TIMEOUT_MAX", "300"))
+SHUTDOWN_HISTORY_SIZE = 20
+
+POWER_STATE_PROPERTIES = ['runtime.powerState', 'guest.toolsRunningStatus']
+
+_history_lock = threading.Lock()
+_history = {}
+_history_path = None
+
+
+def init_shutdown_history(history_path):
+    """Загружает историю длительности выключений из json-файла (рядом с exe)"""
+    global _history_path, _history
+    _history_path = history_path
+
+    if not os.path.exists(history_path):
+        return
+
+    try:
+        with open(history_path, mode='r', encoding='utf-8') as file:
+            _history = json.load(file)
+        print(f"[+] Загружена история выключений ВМ: {sum(len(v) for v in _history.values())} записей")
+    except Exception as e:
+        print(f"[!] Не удалось загрузить историю выключений {history_path}: {e}")
+        _history = {}
+
+
+def _save_history():
+    if not _history_path:
+        return
+    try:
+        with open(_history_path, mode='w', encoding='utf-8') as file:
+            json.dump(_history, file, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"[!] Не удалось сохранить историю выключений: {e}")
+
+
+def record_shutdown(os_type, seconds):
+    """
+    Запоминает, за сколько выключилась ВМ с данным типом ОС.
+    Если ВМ не успела выключиться и выключена принудительно, передаётся
+    таймаут — выключение заняло бы не меньше.
+    """
+    with _history_lock:
+        durations = _history.setdefault(os_type, [])
+        durations.append(round(seconds, 1))
+        del durations[:-SHUTDOWN_HISTORY_SIZE]
+        _save_history()
+
+
+def shutdown_timeout_for(os_type):
+    """
+    Таймаут graceful shutdown для типа ОС: 90-й перцентиль последних
+    выключений (но не меньше последнего) с запасом в полтора раза,
+    в пределах SHUTDOWN_TIMEOUT_MIN..MAX. Последнее выключение учитывается
+    отдельно, чтобы после принудительного выключения таймаут сразу вырос,
+    а не ждал, пока долгие выключения наберут 10% истории.
+    Пока истории мало, используется SHUTDOWN_TIMEOUT.
+    """
+    with _history_lock:
+        durations = list(_history.get(os_type, []))
+    if len(durations) < 3:
+        if not durations:
+            return SHUTDOWN_TIMEOUT_DEFAULT
+        return min(max(SHUTDOWN_TIMEOUT_DEFAULT, durations[-1] * 1.5 + 5), max(SHUTDOWN_TIMEOUT_MAX, SHUTDOWN_TIMEOUT_DEFAULT))
+    p90 = sorted(durations)[int(0.9 * (len(durations) - 1))]
+    return min(max(max(p90, durations[-1]) * 1.5 + 5, SHUTDOWN_TIMEOUT_MIN), SHUTDOWN_TIMEOUT_MAX)
+
+
+def service_instance_of(vm):
+    """ServiceInstance того же подключения, через которое получен объект ВМ"""
+    return vim.ServiceInstance('ServiceInstance', vm._stub)
+
+
+def power_state_watcher(si):
+    return PropertyWatcher(si, POWER_STATE_PROPERTIES, name="Состояние питания ВМ")
+
+
+def is_powered_off(values):
+    return values.get('runtime.powerState') == vim.VirtualMachinePowerState.poweredOff
+
+
+def wait_for_power_off(vm, timeout, watcher=None):
+    """
+    Ждёт выключения ВМ по уведомлению об изменении runtime.powerState.
+    Возвращает True, если ВМ выключилась за timeout секунд.
+    Без переданного watcher создаётся временный наблюдатель на одну ВМ.
+    """
+    own_watcher = watcher is None
+    if own_watcher:
+        watcher = power_state_watcher(service_instance_of(vm))
+    try:
+        return watcher.wait_until(vm, is_powered_off, timeout)
+    finally:
+        if own_watcher:
+            watcher.close()
+        else:
+            watcher.unwatch(vm)
@@ -0,0 +1,88 @@
+from pyVmomi import vim
+from vm_hardware import hardware_diff, hardware_from_config
+from vm_snapshot import get_snapshot_index
+from vm_watch import guest_ip_address
+
+# Режим «привести лабораторию к CSV»: каждая строка CSV сравнивается с текущим
+# inventory и вычисляется минимальный набор операций, после которого ВМ
+# соответствует описанию. Сравнение только читает состояние ВМ.
+
+
+def _guest_differs(vm, vm_config):
+    """
+    Отличаются ли hostname и IP гостевой ОС от CSV. Проверить можно только
+    у работающей ВМ с VMware Tools; иначе считаем, что настройка уже выполнена.
+    """
+    guest = vm.guest
+    if vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn or not guest \
+            or guest.toolsRunningStatus != 'guestToolsRunning':
+        return []
+
+    reasons = []
+    hostname = vm_config.get('TARGET_VM_HOSTNAME')
+    if hostname and guest.hostName and guest.hostName.split('.')[0].lower() != hostname.split('.')[0].lower():
+        reasons.append(f"hostname {guest.hostName} → {hostname}")
+    static_ip = vm_config.get('STATIC_IP')
+    current_ip = guest_ip_address({'guest.net': guest.net, 'guest.ipAddress': guest.ipAddress})
+    if static_ip and current_ip and current_ip != static_ip:
+        reasons.append(f"IP {current_ip} → {static_ip}")
+    return reasons
+
+
+def reconcile_vm(vm, vm_config):
+    """
+    Операции, нужные, чтобы ВМ соответствовала строке CSV.
+    vm — текущая ВМ или None, если её нет. Возвращает (операции, причины).
+    """
+    if vm is None:
+        if not vm_config.get('SOURCE_VM_NAME'):
+            return [], ["ВМ отсутствует, а исходная ВМ в CSV не указана"]
+        operations = ['clone', 'customize']
+        if vm_config.get('TARGET_SNAPSHOT_NAME'):
+            operations.append('snapshot')
+        return operations, ["ВМ отсутствует"]
+
+    operations, reasons = [], []
+
+    diff = hardware_diff(vm, hardware_from_config(vm_config))
+    if any(diff.values()):
+        operations.append('hardware')
+        reasons += [f"{key}: {value}" for key, value in diff.items() if value]
+
+    guest_reasons = _guest_differs(vm, vm_config)
+    if guest_reasons:
+        operations.append('customize')
+        reasons += guest_reasons
+
+    snapshot_name = vm_config.get('TARGET_SNAPSHOT_NAME')
+    if snapshot_name and snapshot_name not in get_snapshot_index(vm, refresh=True).by_name:
+        operations.append('snapshot')
+        reasons.append(f"нет снапшота '{snapshot_name}'")
+
+    return operations, reasons
+
+
+def plan_reconcile(vms, vm_configs):
+    """
+    Сравнивает строки CSV с inventory. vms — {имя: ВМ} для существующих ВМ.
+    Возвращает (vm_operations в формате интерфейса, отчёт {имя ВМ: причины}).
+    """
+    vm_operations = []
+    report = {}
+    for vm_config in vm_configs:
+        vm_name = vm_config['TARGET_VM_NAME']
+        try:
+            operations, reasons = reconcile_vm(vms.get(vm_name), vm_config)
+        except Exception as e:
+            operations, reasons = [], [f"ошибка сравнения: {e}"]
+        if reasons:
+            report[vm_name] = reasons
+        if operations:
+            vm_operations.append({'vm': vm_name, 'operations': operations})
+
+    print(f"[*] Сравнение с CSV: {len(vm_configs)} ВМ, требуют изменений: {len(vm_operations)}")
+    for vm_data in vm_operations:
+        print(f"  {vm_data['vm']}: {', '.join(vm_data['operations'])} "
+              f"({'; '.join(report.get(vm_data['vm'], []))})")
+    print("=" * 70)
+    return vm_operations, report
@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from vm_operations import run_task
+from vm_snapshot import get_snapshot_index, invalidate_snapshot_index
+
+# Политика хранения снапшотов: какие снапшоты удалять, чтобы цепочки
+# дельта-дисков не росли. Правила задаются в json-файле рядом с exe:
+# {"default": {...}, "groups": {"<группа CSV>": {...}}}, поля правила:
+#   keep_last    — сколько последних автоматических снапшотов оставлять
+#   max_age_days — автоматические снапшоты старше удаляются (0 — без ограничения)
+#   keep_named   — не трогать снапшоты с «ручными» именами
+#   keep         — имена, которые не удаляются никогда
+
+RETENTION_MAX_PARALLEL = int(os.getenv("RETENTION_MAX_PARALLEL", "4"))
+
+DEFAULT_POLICY = {
+    'keep_last': 5,
+    'max_age_days': 0,
+    'keep_named': True,
+    'keep': []
+}
+
+# Имена, которые create_snapshot даёт по умолчанию
+_AUTO_SNAPSHOT_RE = re.compile(r'^snapshot_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$')
+
+_policies = {'default': dict(DEFAULT_POLICY), 'groups': {}}
+_policies_lock = threading.Lock()
+
+
+def init_retention_policies(path):
+    """Загружает правила хранения снапшотов из json-файла (если он есть)"""
+    global _policies
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, mode='r', encoding='utf-8') as file:
+            data = json.load(file)
+        with _policies_lock:
+            _policies = {
+                'default': {**DEFAULT_POLICY, **data.get('default', {})},
+                'groups': data.get('groups', {})
+            }
+        print(f"[+] Загружены правила хранения снапшотов: {len(_policies['groups'])} групп")
+    except Exception as e:
+        print(f"[!] Не удалось загрузить правила хранения снапшотов {path}: {e}")
+
+
+def policy_for_group(group_name, overrides=None):
+    with _policies_lock:
+        policy = {**_policies['default'], **_policies['groups'].get(group_name, {})}
+    return {**policy, **(overrides or {})}
+
+
+def is_auto_snapshot(name):
+    return bool(_AUTO_SNAPSHOT_RE.match(name))
+
+
+def plan_retention(index, policy, protected_names=(), now=None):
+    """
+    Выбирает снапшоты к удалению по индексу дерева.
+    Текущий снапшот ВМ и protected_names (например, источники клонирования
+    из CSV) не удаляются никогда. Возвращает [(дерево снапшота, причина)].
+    """
+    now = now or datetime.now(timezone.utc)
+    keep = set(policy.get('keep') or []) | set(protected_names)
+    current = index.current._moId if index.current else None
+
+    auto = []
+    removals = []
+    for tree in index.by_moref.values():
+        if is_auto_snapshot(tree.name):
+            auto.append(tree)
+        elif tree.snapshot._moId != current and tree.name not in keep and not policy.get('keep_named', True):
+            removals.append((tree, "снапшот с ручным именем, keep_named выключен"))
+
+    # Текущий снапшот входит в последние N, но сам не удаляется
+    auto.sort(key=lambda tree: tree.createTime, reverse=True)
+    keep_last = int(policy.get('keep_last') or 0)
+    max_age_days = float(policy.get('max_age_days') or 0)
+    for position, tree in enumerate(auto):
+        if tree.snapshot._moId == current or tree.name in keep:
+            continue
+        if position >= keep_last:
+            removals.append((tree, f"не входит в последние {keep_last}"))
+        elif max_age_days and now - tree.createTime > timedelta(days=max_age_days):
+            removals.append((tree, f"старше {max_age_days:g} дн."))
+
+    return removals
+
+
+def chain_depth(index):
+    """Длина цепочки дельта-дисков текущего состояния ВМ (число снапшотов до корня)"""
+    depth = 0
+    tree = index.current_tree()
+    while tree is not None:
+        depth += 1
+        tree = index.parents.get(tree.snapshot._moId)
+    return depth
+
+
+def _committed_bytes(vm):
+    try:
+        vm.RefreshStorageInfo()
+    except Exception:
+        pass
+    return vm.summary.storage.committed if vm.summary.storage else 0
+
+
+def apply_retention(vm, policy, protected_names=(), dry_run=False):
+    """
+    Применяет политику к одной ВМ: удаляет лишние снапшоты по одному
+    с консолидацией дисков. Возвращает отчёт с глубиной цепочки и занятым
+    местом до и после.
+    """
+    index = get_snapshot_index(vm, refresh=True)
+    removals = plan_retention(index, policy, protected_names)
+    report = {
+        'snapshots_before': len(index),
+        'depth_before': chain_depth(index),
+        'planned': [{'path': index.path_of(tree), 'reason': reason} for tree, reason in removals],
+        'removed': [],
+        'errors': []
+    }
+
+    if dry_run or not removals:
+        report.update(snapshots_after=report['snapshots_before'], depth_after=report['depth_before'])
+        return report
+
+    committed_before = _committed_bytes(vm)
+    for tree, reason in removals:
+        path = index.path_of(tree)
+        print(f"[*] {vm.name}: удаляем снапшот '{path}' ({reason})...")
+        try:
+            run_task(lambda: tree.snapshot.RemoveSnapshot_Task(removeChildren=False, consolidate=True),
+                     f"Удаление снапшота '{path}'", idempotent=False)
+            report['removed'].append(path)
+        except Exception as e:
+            print(f"[X] {vm.name}: не удалось удалить снапшот '{path}': {e}")
+            report['errors'].append(f"{path}: {e}")
+    invalidate_snapshot_index(vm)
+
+    index = get_snapshot_index(vm, refresh=True)
+    report.update(
+        snapshots_after=len(index),
+        depth_after=chain_depth(index),
+        reclaimed_bytes=max(0, committed_before - _committed_bytes(vm))
+    )
+    return report
+
+
+def run_retention(vm_entries, dry_run=False, max_workers=RETENTION_MAX_PARALLEL):
+    """
+    Применяет политики хранения к набору ВМ параллельно (консолидация нагружает
+    datastore, поэтому по умолчанию не более RETENTION_MAX_PARALLEL ВМ сразу).
+    vm_entries — [(vm, policy, protected_names)]. Возвращает {имя ВМ: отчёт}.
+    """
+    results = {}
+
+    def run(entry):
+        vm, policy, protected_names = entry
+        vm_name = vm.name
+        try:
+            results[vm_name] = apply_retention(vm, policy, protected_names, dry_run)
+        except Exception as e:
+            print(f"[X] {vm_name}: ошибка применения политики хранения снапшотов: {e}")
+            results[vm_name] = {'errors': [str(e)], 'planned': [], 'removed': []}
+
+    start_time = time.time()
+    print(f"[*] Политика хранения снапшотов{' (проверка без удаления)' if dry_run else ''}: "
+          f"{len(vm_entries)} ВМ, до {max_workers} одновременно")
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="retention") as pool:
+        list(pool.map(run, vm_entries))
+
+    for vm_name, report in results.items():
+        if 'depth_before' not in report:
+            continue
+        action = "к удалению" if dry_run else "удалено"
+        count = len(report['planned']) if dry_run else len(report['removed'])
+        line = (f"  {vm_name}: {action} {count}, снапшотов {report['snapshots_before']} → {report['snapshots_after']}, "
+                f"глубина цепочки {report['depth_before']} → {report['depth_after']}")
+        if report.get('reclaimed_bytes'):
+            line += f", освобождено {report['reclaimed_bytes'] / 1024 ** 3:.1f} ГБ"
+        print(line)
+    print(f"[+] Политика хранения снапшотов применена за {time.time() - start_time:.0f} сек")
+    print("=" * 70)
+    return results
@@ -0,0 +1,127 @@
+import os
+import ssl
+import random
+import socket
+import http.client
+import paramiko
+from pyVmomi import vim, vmodl
+from vm_cancel import current_token
+
+# Классификация ошибок vSphere / SSH / guest operations и повтор вызовов
+# при временных сбоях: экспоненциальная задержка со случайным разбросом,
+# ограниченное число попыток. Неидемпотентные вызовы повторяются, только
+# если ошибка гарантирует, что вызов не был выполнен.
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+
+# Классы ошибок
+FAULT_TRANSIENT = 'transient'      # временный сбой, вызов можно повторить
+FAULT_CONNECTION = 'connection'    # потеряно подключение к ESXi/vCenter — пакет дальше не выполнить
+FAULT_PERMANENT = 'permanent'      # ошибка в данных или состоянии, повтор не поможет
+
+
+class ConnectionFault(Exception):
+    """Нет подключения к ESXi / vCenter"""
+
+
+class TaskFault(Exception):
+    """Задача vSphere завершилась ошибкой; исходная ошибка задачи — в fault"""
+
+    def __init__(self, message, fault=None):
+        super().__init__(message)
+        self.fault = fault
+
+
+# Сервер отклонил вызов, не начав его выполнять: повтор безопасен всегда
+_REJECTED_FAULTS = (
+    vim.fault.TaskInProgress,
+    vim.fault.ConcurrentAccess,
+    vim.fault.GuestOperationsUnavailable,
+    vmodl.fault.HostCommunication,
+    ConnectionRefusedError,
+)
+
+# Временные сбои, после которых неизвестно, выполнился ли вызов
+_TRANSIENT_FAULTS = _REJECTED_FAULTS + (
+    vim.fault.ToolsUnavailable,
+    socket.timeout,
+    TimeoutError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    http.client.RemoteDisconnected,
+    ssl.SSLEOFError,
+    paramiko.ssh_exception.NoValidConnectionsError,
+)
+
+# Потеря сессии или подключения к ESXi / vCenter (не к гостевой ОС)
+_CONNECTION_FAULTS = (
+    ConnectionFault,
+    vim.fault.NotAuthenticated,
+    vim.fault.InvalidLogin,
+    vim.fault.HostConnectFault,
+)
+
+
+def _fault_chain(exc):
+    """Сама ошибка, ошибка задачи vSphere и цепочка причин (raise ... from ...)"""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        yield exc
+        fault = getattr(exc, 'fault', None)
+        if isinstance(fault, BaseException):
+            yield fault
+        exc = exc.__cause__ or exc.__context__
+
+
+def _is_ssh_banner_timeout(exc):
+    return isinstance(exc, paramiko.ssh_exception.SSHException) and 'banner' in str(exc).lower()
+
+
+def classify_fault(exc):
+    """FAULT_CONNECTION, FAULT_TRANSIENT или FAULT_PERMANENT"""
+    chain = list(_fault_chain(exc))
+    if any(isinstance(fault, _CONNECTION_FAULTS) for fault in chain):
+        return FAULT_CONNECTION
+    if any(isinstance(fault, _TRANSIENT_FAULTS) or _is_ssh_banner_timeout(fault) for fault in chain):
+        return FAULT_TRANSIENT
+    return FAULT_PERMANENT
+
+
+def is_connection_fault(exc):
+    return classify_fault(exc) == FAULT_CONNECTION
+
+
+def _is_rejected(exc):
+    return any(isinstance(fault, _REJECTED_FAULTS) or _is_ssh_banner_timeout(fault)
+               for fault in _fault_chain(exc))
+
+
+def retry_delay(attempt, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """Экспоненциальная задержка с полным случайным разбросом (full jitter)"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def with_retry(call, description="Операция", idempotent=True, attempts=None):
+    """
+    Выполняет call() с повтором при временных сбоях.
+    idempotent=False — повтор только для ошибок, при которых вызов точно не выполнялся.
+    После отмены пакета (vm_cancel) новые попытки не начинаются.
+    """
+    token = current_token()
+    attempts = attempts or RETRY_MAX_ATTEMPTS
+    attempt = 1
+    while True:
+        token.check(description)
+        try:
+            return call()
+        except Exception as e:
+            if classify_fault(e) != FAULT_TRANSIENT or attempt >= attempts or (not idempotent and not _is_rejected(e)):
+                raise
+            delay = retry_delay(attempt)
+            print(f"[!] {description}: временная ошибка ({type(e).__name__}: {e}), "
+                  f"повтор {attempt + 1}/{attempts} через {delay:.1f} сек")
+            token.sleep(delay, description)
+            attempt += 1
@@ -1,38 +1,269 @@
 import time
+import threading
 from pyVmomi import vim
 from datetime import datetime
-from vm_operations import vm_power_on, vm_power_off, wait_for_task
-
-
-def find_snapshot(vm, snapshot_name):
-    """Рекурсивно ищет снапшот по имени в дереве снапшотов ВМ."""
-
-    def recurse(snapshot_list):
-        for snapshot in snapshot_list:
-            #print("Проверка снапшота:", snapshot.name)
-            if snapshot.name == snapshot_name:
-                # print("Найден снапшот:", snapshot.name)
-                return snapshot
-            if snapshot.childSnapshotList:
-                result = recurse(snapshot.childSnapshotList)
-                if result:
-                    return result
-        return None
+from vm_operations import vm_power_on, vm_power_off, wait_for_task, run_task
+from vm_retry import with_retry
+from esxi_connect import on_disconnect
+
+
+class SnapshotIndex:
+    """
+    Индекс дерева снапшотов ВМ. Дерево целиком приходит одним чтением свойства
+    vm.snapshot (вложенные VirtualMachineSnapshotTree — данные, а не ссылки),
+    дальше поиск по имени, пути ('base/clean/configured') и moref — по словарям.
+    """
+
+    def __init__(self, snapshot_info):
+        self.current = snapshot_info.currentSnapshot if snapshot_info else None
+        self.by_name = {}
+        self.by_path = {}
+        self.by_moref = {}
+        self.paths = {}
+        self.parents = {}
+
+        # Обход в глубину в порядке дерева, без рекурсии
+        stack = [(tree, None, tree.name) for tree in reversed(snapshot_info.rootSnapshotList if snapshot_info else [])]
+        while stack:
+            tree, parent, path = stack.pop()
+            moref = tree.snapshot._moId
+            self.by_name.setdefault(tree.name, []).append(tree)
+            self.by_path.setdefault(path, tree)
+            self.by_moref[moref] = tree
+            self.paths[moref] = path
+            self.parents[moref] = parent
+            for child in reversed(tree.childSnapshotList or []):
+                stack.append((child, tree, f"{path}/{child.name}"))
+
+    def __len__(self):
+        return len(self.by_moref)
+
+    def names(self):
+        """Имена всех снапшотов в порядке обхода дерева"""
+        return [tree.name for tree in self.by_moref.values()]
+
+    def duplicates(self):
+        """Имена, которые встречаются в дереве больше одного раза"""
+        return {name: [f"{self.paths[tree.snapshot._moId]} ({tree.snapshot._moId})" for tree in trees]
+                for name, trees in self.by_name.items() if len(trees) > 1}
+
+    def find(self, name_or_path):
+        """Снапшот по полному пути или по имени (при дублях — первый в порядке обхода)"""
+        if name_or_path in self.by_path:
+            return self.by_path[name_or_path]
+        trees = self.by_name.get(name_or_path)
+        return trees[0] if trees else None
+
+    def find_by_moref(self, snapshot):
+        return self.by_moref.get(snapshot._moId if hasattr(snapshot, '_moId') else snapshot)
+
+    def path_of(self, tree):
+        return self.paths.get(tree.snapshot._moId)
+
+    def current_tree(self):
+        return self.find_by_moref(self.current) if self.current else None
+
+
+# Индексы снапшотов по (подключение, moref ВМ): деревья содержат ссылки на
+# снапшоты, действующие только в сессии своего подключения, а moref ВМ на разных
+# хостах ESXi совпадают. Сбрасываются операциями со снапшотами и при отключении
+# от хоста; промах поиска перечитывает дерево один раз, а перед изменяющими
+# вызовами (откат, удаление, подготовка к клонированию) дерево перечитывается всегда.
+_snapshot_indexes = {}
+_snapshot_indexes_lock = threading.Lock()
+
+
+def _index_key(vm):
+    return (vm._stub, vm._moId)
+
+
+def _forget_connection(service_instance):
+    stub = service_instance._stub
+    with _snapshot_indexes_lock:
+        for key in [key for key in _snapshot_indexes if key[0] is stub]:
+            del _snapshot_indexes[key]
 
-    if not vm.snapshot:
+
+on_disconnect(_forget_connection)
+
+
+def get_snapshot_index(vm, refresh=False):
+    key = _index_key(vm)
+    if not refresh:
+        with _snapshot_indexes_lock:
+            index = _snapshot_indexes.get(key)
+        if index is not None:
+            return index
+
+    index = SnapshotIndex(vm.snapshot)
+    with _snapshot_indexes_lock:
+        _snapshot_indexes[key] = index
+    return index
+
+
+def invalidate_snapshot_index(vm):
+    with _snapshot_indexes_lock:
+        _snapshot_indexes.pop(_index_key(vm), None)
+
+
+def find_snapshot(vm, snapshot_name, refresh=False):
+    """
+    Ищет снапшот по имени или пути ('base/clean') в индексе дерева снапшотов ВМ.
+    refresh=True — перечитать дерево (перед операцией над найденным снапшотом).
+    """
+    index = get_snapshot_index(vm, refresh=refresh)
+    snapshot = index.find(snapshot_name)
+    if snapshot is None and not refresh:
+        # Снапшот мог появиться вне менеджера — перечитываем дерево
+        index = get_snapshot_index(vm, refresh=True)
+        snapshot = index.find(snapshot_name)
+
+    if not len(index):
         print("VM не содержит снапшотов")
         return None
 
-    return recurse(vm.snapshot.rootSnapshotList)
+    if snapshot is not None and len(index.by_name.get(snapshot_name, [])) > 1:
+        print(f"[!] У ВМ {vm.name} несколько снапшотов '{snapshot_name}': "
+              f"{', '.join(index.duplicates()[snapshot_name])}. Используется {index.path_of(snapshot)} "
+              f"({snapshot.snapshot._moId})")
+    return snapshot
+
+
+# Откаты, выполненные менеджером: instanceUuid ВМ → (moref снапшота, время
+# завершения задачи по часам сервера). С этого момента диски ВМ совпадают со
+# снапшотом. Ключ — UUID, а не moref: moref ВМ на разных хостах совпадают.
+_clean_points = {}
+_clean_points_lock = threading.Lock()
+
+# Счётчики откатов пакета обновляются из потоков плана и групповых операций
+_stats_lock = threading.Lock()
+
+
+def _count(stats, key):
+    if stats is not None:
+        with _stats_lock:
+            stats[key] = stats.get(key, 0) + 1
+
+
+# События, после которых диски или конфигурация ВМ могли измениться
+_CHANGE_EVENTS = ['VmStartingEvent', 'VmPoweredOnEvent', 'VmPoweredOffEvent',
+                  'VmGuestShutdownEvent', 'VmReconfiguredEvent']
+# События, по которым видно, включена ли ВМ: последнее из них до момента
+# создания снапшота показывает, была ли ВМ выключена
+_POWER_ON_EVENTS = ['VmStartingEvent', 'VmPoweredOnEvent']
+_POWER_OFF_EVENTS = ['VmPoweredOffEvent', 'VmRegisteredEvent', 'VmCreatedEvent']
+
+
+def _event_manager(vm):
+    return vim.ServiceInstance('ServiceInstance', vm._stub).content.eventManager
+
 
+def _query_events(event_manager, vm, event_types, begin=None, end=None):
+    return event_manager.QueryEvents(vim.event.EventFilterSpec(
+        entity=vim.event.EventFilterSpec.ByEntity(entity=vm, recursion='self'),
+        time=vim.event.EventFilterSpec.ByTime(beginTime=begin, endTime=end),
+        eventTypeId=event_types
+    )) or []
 
 
-def revert_to_snapshot(vm, snapshot_name):
-    """Откатывает ВМ к указанному снапшоту, если это необходимо"""
-    snapshot = find_snapshot(vm, snapshot_name)
+def _was_powered_off_at(event_manager, vm, moment):
+    """
+    Была ли ВМ выключена в момент moment: последнее событие питания до него —
+    выключение (или регистрация/создание ВМ). Если таких событий не сохранилось,
+    состояние неизвестно и считается, что ВМ была включена.
+    """
+    events = _query_events(event_manager, vm, _POWER_ON_EVENTS + _POWER_OFF_EVENTS, end=moment)
+    if not events:
+        return False
+    latest = max(events, key=lambda event: event.createdTime)
+    return isinstance(latest, tuple(getattr(vim.event, name) for name in _POWER_OFF_EVENTS))
+
+
+def _clean_since(vm, snapshot_tree, event_manager):
+    """Момент, начиная с которого диски ВМ гарантированно совпадали со снапшотом"""
+    points = []
+    # Снапшот без памяти помечается poweredOff, даже если снят с работающей ВМ
+    # (live, quiesce): createTime годится, только если ВМ тогда была выключена
+    if (snapshot_tree.state == vim.VirtualMachinePowerState.poweredOff
+            and _was_powered_off_at(event_manager, vm, snapshot_tree.createTime)):
+        points.append(snapshot_tree.createTime)
+    with _clean_points_lock:
+        recorded = _clean_points.get(vm.config.instanceUuid)
+    if recorded and recorded[0] == snapshot_tree.snapshot._moId:
+        points.append(recorded[1])
+    return max(points) if points else None
+
+
+def _events_retained_since(event_manager, vm, since):
+    """
+    Хранит ли сервер историю событий ВМ начиная с since: сохранилось хотя бы
+    одно её событие не позже since. Старые события удаляются первыми, значит
+    все более поздние тоже на месте.
+    """
+    collector = event_manager.CreateCollectorForEvents(vim.event.EventFilterSpec(
+        entity=vim.event.EventFilterSpec.ByEntity(entity=vm, recursion='self'),
+        time=vim.event.EventFilterSpec.ByTime(endTime=since)
+    ))
+    try:
+        return bool(collector.latestPage)
+    finally:
+        collector.DestroyCollector()
+
+
+def _changed_since(vm, since, event_manager):
+    """
+    Могла ли ВМ измениться после момента since: включалась, выключалась
+    или перенастраивалась (по событиям EventManager).
+    На standalone ESXi история событий короткая: если она не покрывает since,
+    отсутствие событий ничего не доказывает и считается, что ВМ менялась.
+    """
+    if _query_events(event_manager, vm, _CHANGE_EVENTS, begin=since):
+        return True
+    if not _events_retained_since(event_manager, vm, since):
+        print(f"[*] {vm.name}: история событий не покрывает момент {since}, откат не пропускается")
+        return True
+    return False
+
+
+def is_unchanged_since_snapshot(vm, snapshot_name):
+    """
+    Находится ли выключенная ВМ в указанном снапшоте без изменений на дисках:
+    currentSnapshot совпадает с целевым, а после момента, когда диски совпадали
+    со снапшотом (создание снапшота выключенной ВМ или наш откат), ВМ не включалась,
+    не выключалась и не перенастраивалась.
+    """
+    if vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOff:
+        return False
+
+    index = get_snapshot_index(vm, refresh=True)
+    snapshot = index.find(snapshot_name)
+    if snapshot is None or index.current is None or index.current._moId != snapshot.snapshot._moId:
+        return False
+
+    try:
+        event_manager = _event_manager(vm)
+        since = _clean_since(vm, snapshot, event_manager)
+        return since is not None and not _changed_since(vm, since, event_manager)
+    except Exception as e:
+        print(f"[!] Не удалось проверить события ВМ {vm.name}: {e}")
+        return False
+
+
+def revert_to_snapshot(vm, snapshot_name, stats=None):
+    """
+    Откатывает ВМ к указанному снапшоту, если это необходимо.
+    stats — счётчики пакета {'performed': n, 'skipped': n}.
+    """
+    snapshot = find_snapshot(vm, snapshot_name, refresh=True)
     if not snapshot:
         raise Exception(f"Снапшот '{snapshot_name}' не найден")
 
+    if is_unchanged_since_snapshot(vm, snapshot_name):
+        print(f"[=] ВМ {vm.name} уже находится в снапшоте '{snapshot_name}' и не менялась после него, откат не требуется")
+        print("=" * 70)
+        _count(stats, 'skipped')
+        return
+
     # Получаем текущее состояние ВМ
     was_powered_on = vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
 
@@ -40,16 +271,18 @@ def revert_to_snapshot(vm, snapshot_name):
         vm_power_off(vm)
 
     try:
-        # current_snapshot = vm.snapshot.currentSnapshot if vm.snapshot else None
-        #
-        # if current_snapshot and current_snapshot._moId == snapshot.snapshot._moId:
-        #     print(f"[=] ВМ {vm.name} уже находится в снапшоте '{snapshot_name}', откат не требуется")
-        #     print("=" * 70)
-        #     return
-
         print(f"[*] Откатываем ВМ {vm.name} к снапшоту '{snapshot_name}'...")
-        task = snapshot.snapshot.RevertToSnapshot_Task()
-        wait_for_task(task, "Откат к снапшоту")
+        def revert():
+            task = snapshot.snapshot.RevertToSnapshot_Task()
+            wait_for_task(task, "Откат к снапшоту")
+            return task
+
+        # Откат идемпотентен: повтор после временного сбоя безопасен
+        task = with_retry(revert, f"Откат ВМ {vm.name} к снапшоту '{snapshot_name}'")
+        invalidate_snapshot_index(vm)
+        with _clean_points_lock:
+            _clean_points[vm.config.instanceUuid] = (snapshot.snapshot._moId, task.info.completeTime)
+        _count(stats, 'performed')
         print("[+] Снапшот успешно восстановлен")
 
         print("=" * 70)
@@ -59,6 +292,7 @@ def revert_to_snapshot(vm, snapshot_name):
             vm_power_on(vm)
 
     except Exception as e:
+        invalidate_snapshot_index(vm)
         print(f"[-] Ошибка при создании снапшота: {str(e)}")
         print("=" * 70)
         if was_powered_on:
@@ -70,23 +304,13 @@ def revert_to_snapshot(vm, snapshot_name):
 
 def list_all_snapshots_names(vm):
     """Возвращает список всех снапшотов ВМ (только имена, без путей)."""
-
-    def recurse(snapshot_list):
-        snapshots = []
-        for snapshot in snapshot_list:
-            snapshots.append(snapshot.name)
-            if snapshot.childSnapshotList:
-                snapshots.extend(recurse(snapshot.childSnapshotList))
-        return snapshots
-
-    if not vm.snapshot:
+    index = get_snapshot_index(vm, refresh=True)
+    if not len(index):
         print("У ВМ нет снапшотов")
-        return []
-
-    return recurse(vm.snapshot.rootSnapshotList)
+    return index.names()
 
 
-def create_snapshot(vm, vm_config, memory=False, quiesce=False):
+def create_snapshot(vm, vm_config, memory=False, quiesce=False, description=None):
     """
     Создаёт снапшот ВМ с указанным именем и описанием.
 
@@ -94,6 +318,10 @@ def create_snapshot(vm, vm_config, memory=False, quiesce=False):
     :param vm_config: Конфиг ВМ
     :param memory: Сохранять память ВМ (по умолчанию False)
     :param quiesce: Применять quiescing (по умолчанию False)
+    :param description: Описание снапшота (по умолчанию — из CSV, если имя не задано в браузере)
+
+    Снапшот с памятью или с quiescing делается на работающей ВМ,
+    без выключения и повторного включения.
     """
 
     snapshot_name = (
@@ -104,7 +332,9 @@ def create_snapshot(vm, vm_config, memory=False, quiesce=False):
     # snapshot_name = vm_config.get('TARGET_SNAPSHOT_NAME') or datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
     # Определяем description
-    if vm_config.get('snapshot_name'):  # Если имя задано в браузере
+    if description is not None:  # Явно передано (групповые операции)
+        pass
+    elif vm_config.get('snapshot_name'):  # Если имя задано в браузере
         description = ""
     else:  # Если имя из CSV или по умолчанию
         description = vm_config.get('TARGET_SNAPSHOT_DESCRIPTION', "")
@@ -114,30 +344,52 @@ def create_snapshot(vm, vm_config, memory=False, quiesce=False):
     # Получаем текущее состояние ВМ
     was_powered_on = vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
 
-    if was_powered_on:
-        vm_power_off(vm)
+    live = was_powered_on and (memory or quiesce)
+    power_cycle = was_powered_on and not live
 
-    task = vm.CreateSnapshot_Task(
-        name=snapshot_name,
-        description=description,
-        memory=memory,
-        quiesce=quiesce
-    )
+    if power_cycle:
+        vm_power_off(vm)
+    elif live:
+        print(f"[*] Снапшот работающей ВМ {vm.name}: " + ("с памятью" if memory else "с quiescing"))
 
     try:
-        wait_for_task(task, description=f"Создание снапшота '{snapshot_name}'")
+        run_task(lambda: vm.CreateSnapshot_Task(
+            name=snapshot_name,
+            description=description,
+            memory=memory,
+            quiesce=quiesce
+        ), f"Создание снапшота '{snapshot_name}'", idempotent=False)
+        invalidate_snapshot_index(vm)
         print(f"[+] Снапшот '{snapshot_name}' успешно создан")
         time.sleep(1)
         print("=" * 70)
 
-        if was_powered_on:
+        if power_cycle:
             print("[*] Включаем ВМ так как изначально она была включена...")
             vm_power_on(vm)
 
     except Exception as e:
+        invalidate_snapshot_index(vm)
         print(f"[-] Ошибка при создании снапшота: {str(e)}")
         print("=" * 70)
-        if was_powered_on:
+        if power_cycle:
             print("[*] Включаем ВМ так как изначально она была включена...")
             vm_power_on(vm)
         raise
+
+
+def remove_snapshot(vm, snapshot_name, remove_children=False, consolidate=True):
+    """Удаляет снапшот ВМ (по имени или пути). Выключение ВМ не требуется."""
+    snapshot = find_snapshot(vm, snapshot_name, refresh=True)
+    if not snapshot:
+        raise Exception(f"Снапшот '{snapshot_name}' не найден")
+
+    print(f"[*] Удаляем снапшот '{snapshot_name}' ВМ {vm.name}" +
+          (" вместе с дочерними..." if remove_children else "..."))
+    try:
+        run_task(lambda: snapshot.snapshot.RemoveSnapshot_Task(removeChildren=remove_children, consolidate=consolidate),
+                 f"Удаление снапшота '{snapshot_name}'", idempotent=False)
+    finally:
+        invalidate_snapshot_index(vm)
+    print(f"[+] Снапшот '{snapshot_name}' ВМ {vm.name} удалён")
+    print("=" * 70)
@@ -0,0 +1,204 @@
+import threading
+import time
+from pyVmomi import vim, vmodl
+from vm_retry import TaskFault
+from vm_cancel import current_token, cancel_vsphere_task, OperationCancelled
+
+
+class PropertyWatcher:
+    """
+    Следит за свойствами набора объектов через отдельный PropertyCollector.
+    Изменения приходят через WaitForUpdatesEx в фоновом потоке, а ожидающие
+    потоки просыпаются сразу после уведомления — без периодического опроса.
+    Один наблюдатель обслуживает сколько угодно объектов и ожидающих.
+    """
+
+    def __init__(self, si, properties, obj_type=vim.VirtualMachine, name="Наблюдатель"):
+        self.si = si
+        self.properties = list(properties)
+        self.obj_type = obj_type
+        self.name = name
+        self.collector = si.content.propertyCollector.CreatePropertyCollector()
+        self.cond = threading.Condition()
+        self.filters = {}
+        self.values = {}
+        self.error = None
+        self.stopped = False
+        self.thread = None
+
+    def watch(self, obj):
+        """Добавляет объект под наблюдение (повторный вызов ничего не делает)"""
+        key = obj._moId
+        with self.cond:
+            if key in self.filters:
+                return
+            self.values.setdefault(key, {})
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False)],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=self.obj_type, pathSet=self.properties)]
+        )
+        # Без partialUpdates изменение вложенных данных (guest.net[...]) приходит
+        # целым значением свойства из pathSet, и values[свойство] не устаревает
+        property_filter = self.collector.CreateFilter(filter_spec, partialUpdates=False)
+
+        with self.cond:
+            self.filters[key] = property_filter
+            if not self.thread:
+                self.thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self.thread.start()
+
+    def unwatch(self, obj):
+        with self.cond:
+            property_filter = self.filters.pop(obj._moId, None)
+            self.values.pop(obj._moId, None)
+        if property_filter:
+            try:
+                property_filter.Destroy()
+            except Exception:
+                pass
+
+    def get(self, obj):
+        with self.cond:
+            return dict(self.values.get(obj._moId, {}))
+
+    def wait_until(self, obj, predicate, timeout):
+        """
+        Ждёт, пока predicate(значения свойств объекта) не вернёт истину.
+        Возвращает True, если условие выполнилось, False — по таймауту.
+        При отмене пакета (vm_cancel) выбрасывает OperationCancelled.
+        """
+        self.watch(obj)
+        deadline = time.time() + timeout
+        token = current_token()
+
+        def wake():
+            with self.cond:
+                self.cond.notify_all()
+
+        with token.on_cancel(wake), self.cond:
+            while True:
+                if token.cancelled:
+                    raise OperationCancelled(f"{self.name}: ожидание прервано пользователем")
+                if self.error:
+                    raise Exception(f"{self.name}: ошибка получения обновлений: {self.error}")
+                if predicate(self.values.get(obj._moId, {})):
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+
+    def _loop(self):
+        version = ''
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=1)
+        while not self.stopped:
+            try:
+                update_set = self.collector.WaitForUpdatesEx(version, options)
+            except Exception as e:
+                if self.stopped:
+                    break
+                with self.cond:
+                    self.error = str(e)
+                    self.cond.notify_all()
+                break
+
+            if not update_set:
+                continue
+            version = update_set.version
+
+            with self.cond:
+                for filter_update in update_set.filterSet or []:
+                    for object_update in filter_update.objectSet or []:
+                        values = self.values.setdefault(object_update.obj._moId, {})
+                        for change in object_update.changeSet or []:
+                            if change.op in ('remove', 'indirectRemove'):
+                                values.pop(change.name, None)
+                            else:
+                                values[change.name] = change.val
+                self.cond.notify_all()
+
+    def close(self):
+        self.stopped = True
+        try:
+            self.collector.Destroy()
+        except Exception:
+            pass
+        with self.cond:
+            self.filters.clear()
+            self.cond.notify_all()
+
+
+GUEST_READINESS_PROPERTIES = [
+    'runtime.powerState',
+    'guest.toolsRunningStatus',
+    'guest.guestOperationsReady',
+    'guest.ipAddress',
+    'guest.net',
+]
+
+
+def guest_ip_address(values):
+    """IPv4-адрес гостевой ОС из guest.net (preferred) или guest.ipAddress"""
+    for nic in values.get('guest.net') or []:
+        if nic.ipConfig:
+            for ip in nic.ipConfig.ipAddress:
+                if ip.state == 'preferred' and ':' not in ip.ipAddress:
+                    return ip.ipAddress
+        else:
+            # fallback для старых версий ESXi
+            for ip in nic.ipAddress or []:
+                if ':' not in ip:
+                    return ip
+    ip = values.get('guest.ipAddress')
+    if ip and ':' not in ip:
+        return ip
+    return None
+
+
+class GuestReadinessWatcher(PropertyWatcher):
+    """Наблюдатель за состоянием гостевых ОС (Tools, guest operations, IP)"""
+
+    def __init__(self, si):
+        super().__init__(si, GUEST_READINESS_PROPERTIES, name="Готовность гостевых ОС")
+
+    @staticmethod
+    def tools_running(values):
+        return values.get('guest.toolsRunningStatus') == 'guestToolsRunning'
+
+    @staticmethod
+    def guest_ops_ready(values):
+        return bool(values.get('guest.guestOperationsReady'))
+
+
+class TaskWatcher(PropertyWatcher):
+    """
+    Наблюдатель за задачами vSphere: о завершении задачи сообщает
+    уведомление PropertyCollector, без опроса task.info.
+    """
+
+    def __init__(self, si):
+        super().__init__(si, ['info.state'], obj_type=vim.Task, name="Задачи vSphere")
+
+    @staticmethod
+    def finished(values):
+        return values.get('info.state') in (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+
+    def wait(self, task, description="Операция", timeout=3600):
+        """
+        Ждёт завершения задачи и возвращает её результат (ошибка — исключение).
+        При отмене пакета задача отменяется через CancelTask.
+        """
+        try:
+            with current_token().on_cancel(lambda: cancel_vsphere_task(task)):
+                finished = self.wait_until(task, self.finished, timeout)
+            if not finished:
+                raise Exception(f"{description} не завершилась за {timeout} сек")
+        finally:
+            self.unwatch(task)
+
+        info = task.info
+        if info.state == vim.TaskInfo.State.success:
+            return info.result
+        msg = getattr(info.error, 'localizedMessage', None) or str(info.error)
+        raise TaskFault(f"{description} завершилась с ошибкой: {msg}", info.error)
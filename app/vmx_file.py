@@ -0,0 +1,142 @@
+import re
+
+# Разбор и запись .vmx на стороне менеджера.
+# Строки, которые не менялись, записываются обратно байт в байт,
+# поэтому комментарии, порядок, форматирование и переводы строк (LF или CRLF)
+# исходного файла сохраняются.
+
+_LINE_RE = re.compile(r'^\s*([^=#\s][^=]*?)\s*=\s*(.*?)\s*$')
+_ESCAPE_RE = re.compile(r'\|([0-9A-Fa-f]{2})')
+
+
+def _decode_value(raw):
+    if len(raw) >= 2 and raw[0] == '"' and raw[-1] == '"':
+        raw = raw[1:-1]
+    # В .vmx спецсимволы кодируются как |XX (шестнадцатеричный код)
+    return _ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), raw)
+
+
+def _encode_value(value):
+    encoded = []
+    for ch in str(value):
+        if ch in '|"' or ord(ch) < 0x20:
+            encoded.append(f"|{ord(ch):02X}")
+        else:
+            encoded.append(ch)
+    return '"' + ''.join(encoded) + '"'
+
+
+class VmxFile:
+    """Содержимое .vmx файла. Ключи сравниваются без учёта регистра, как в ESXi."""
+
+    def __init__(self, lines=None, newline='\n', final_newline=True):
+        # Элемент: [raw_line, key или None, value или None]
+        self.lines = lines or []
+        self.newline = newline
+        self.final_newline = final_newline
+
+    @classmethod
+    def parse(cls, text):
+        newline = '\r\n' if '\r\n' in text else '\n'
+        final_newline = text.endswith(newline)
+        body = text[:-len(newline)] if final_newline else text
+        lines = []
+        for raw in body.split(newline) if text else []:
+            match = _LINE_RE.match(raw)
+            if match:
+                lines.append([raw, match.group(1), _decode_value(match.group(2))])
+            else:
+                lines.append([raw, None, None])
+        return cls(lines, newline, final_newline)
+
+    def serialize(self):
+        text = self.newline.join(line[0] for line in self.lines)
+        return text + self.newline if self.final_newline else text
+
+    def _find(self, key):
+        key = key.lower()
+        for line in self.lines:
+            if line[1] is not None and line[1].lower() == key:
+                return line
+        return None
+
+    def get(self, key, default=None):
+        line = self._find(key)
+        return line[2] if line else default
+
+    def set(self, key, value):
+        value = str(value)
+        line = self._find(key)
+        if line:
+            if line[2] != value:
+                line[0] = f"{line[1]} = {_encode_value(value)}"
+                line[2] = value
+        else:
+            self.lines.append([f"{key} = {_encode_value(value)}", key, value])
+
+    def remove(self, key):
+        key = key.lower()
+        self.lines = [line for line in self.lines if line[1] is None or line[1].lower() != key]
+
+    def keys(self):
+        return [line[1] for line in self.lines if line[1] is not None]
+
+    def items(self, prefix=''):
+        prefix = prefix.lower()
+        return [(line[1], line[2]) for line in self.lines
+                if line[1] is not None and line[1].lower().startswith(prefix)]
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+
+def read_vmx(sftp, path):
+    with sftp.open(path, 'r') as file:
+        return VmxFile.parse(file.read().decode('utf-8'))
+
+
+def write_vmx(sftp, path, vmx):
+    with sftp.open(path, 'w') as file:
+        file.write(vmx.serialize().encode('utf-8'))
+
+
+def ethernet_ids(vmx):
+    """Идентификаторы сетевых адаптеров: ethernet0, ethernet1, ..."""
+    ids = []
+    for key, value in vmx.items('ethernet'):
+        match = re.match(r'^(ethernet\d+)\.present$', key, re.IGNORECASE)
+        if match and value.lower() == 'true':
+            ids.append(match.group(1))
+    return ids
+
+
+def apply_clone_edits(vmx, target_vm_name, disk_files=None):
+    """
+    Правки .vmx для клона:
+    имя ВМ, файлы дисков, nvram, новый UUID, сброс сгенерированных MAC.
+    disk_files — {"scsi0:0": "target.vmdk", ...}
+    """
+    vmx.set('displayName', target_vm_name)
+    vmx.set('nvram', f"{target_vm_name}.nvram")
+    if 'extendedConfigFile' in vmx:
+        vmx.set('extendedConfigFile', f"{target_vm_name}.vmxf")
+
+    for disk_id, file_name in (disk_files or {}).items():
+        vmx.set(f"{disk_id}.fileName", file_name)
+
+    # Новый UUID и отвязка от исходной ВМ
+    vmx.set('uuid.action', 'create')
+    for key in ('uuid.bios', 'uuid.location', 'vc.uuid', 'sched.swap.derivedName', 'migrate.hostLog'):
+        vmx.remove(key)
+
+    # Сгенерированные MAC-адреса ESXi создаст заново при регистрации
+    for eth in ethernet_ids(vmx):
+        address_type = (vmx.get(f"{eth}.addressType") or 'generated').lower()
+        if address_type in ('generated', 'vpx'):
+            vmx.remove(f"{eth}.generatedAddress")
+            vmx.remove(f"{eth}.generatedAddressOffset")
+        else:
+            print(f"[!] У адаптера {eth} статический MAC {vmx.get(f'{eth}.address')}, он будет совпадать с исходной ВМ")
+
+    return vmx
+
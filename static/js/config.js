@@ -6,6 +6,7 @@ export const COLUMN_COUNT = OPERATIONS.length + 2; // +2 для group-col и vm-
 export const SELECTORS = {
     vmTableBody: '#vm-table-body',
     executeBtn: '#execute-btn',
+    reconcileBtn: '#reconcile-btn',
     cancelBtn: '#cancel-btn',
     clearFilterBtn: '#clear-filter',
     clearGroupsBtn: '#clear-groups',
@@ -10,6 +10,7 @@ export class OperationsManager {
         this.initOpenCsvButton();
         this.initRefreshCsvButton();
         this.initEsxiStatus();
+        this.checkUnfinishedBatch();
     }
 
     resetOperationStatus() {
@@ -46,6 +47,7 @@ export class OperationsManager {
 
     initEventListeners() {
         document.querySelector(SELECTORS.executeBtn).addEventListener('click', () => this.executeOperations());
+        document.querySelector(SELECTORS.reconcileBtn).addEventListener('click', () => this.reconcileWithCsv());
         document.querySelector(SELECTORS.cancelBtn).addEventListener('click', () => this.cancelOperations());
         document.querySelector(SELECTORS.clearFilterBtn).addEventListener('click', () => this.clearSelection());
 
@@ -173,13 +175,42 @@ export class OperationsManager {
             return;
         }
 
+        await this.runBatch(async (session, signal) => {
+            // 1. Начинаем сессию операций
+            const startResponse = await fetch('/api/start-operations', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ vmOperations }),
+                signal
+            });
+
+            if (!startResponse.ok) throw new Error('Ошибка начала операций');
+
+            const startData = await startResponse.json();
+            session.id = startData.session_id;
+            session.vmOperations = vmOperations;
+
+            // 2. Запускаем план: порядок операций и их параллельность выбирает сервер
+            const planResponse = await fetch('/api/execute-plan', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ session_id: session.id }),
+                signal
+            });
+            if (!planResponse.ok) throw new Error('Ошибка запуска плана операций');
+        });
+    }
+
+    async runBatch(startPlan) {
         const executeBtn = document.querySelector(SELECTORS.executeBtn);
+        const reconcileBtn = document.querySelector(SELECTORS.reconcileBtn);
         const cancelBtn = document.querySelector(SELECTORS.cancelBtn);
         const clearFilterBtn = document.querySelector(SELECTORS.clearFilterBtn);
         const selectBox = document.querySelector(SELECTORS.selectBox);
         const refreshBtn = document.querySelector(SELECTORS.refreshCsvBtn);
 
         executeBtn.disabled = true;
+        reconcileBtn.disabled = true;
         clearFilterBtn.disabled = true;
         selectBox.disabled = true;
         cancelBtn.disabled = false;
@@ -189,83 +220,40 @@ export class OperationsManager {
         // Блокируем чекбоксы перед началом операций
         this.lockCheckboxes();
 
-        let sessionId = null;
+        const session = { id: null, vmOperations: [] };
 
         try {
-            // 1. Начинаем сессию операций
-            const startResponse = await fetch('/api/start-operations', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({ vmOperations }),
-                signal: this.abortController.signal
-            });
-
-            if (!startResponse.ok) throw new Error('Ошибка начала операций');
+            // startPlan возвращает false, если выполнять нечего
+            if (await startPlan(session, this.abortController.signal) === false) return;
 
-            const startData = await startResponse.json();
-            sessionId = startData.session_id;
-
-            // 2. Выполняем операции последовательно
-            for (const vm of vmOperations) {
-                if (this.abortController.signal.aborted) break;
-
-                for (const op of vm.operations) {
-                    if (this.abortController.signal.aborted) break;
-
-                    // Подсвечиваем текущую операцию
-                    this.updateOperationStatus(vm.vm, op, 'active');
-                    this.currentOperation = { vmName: vm.vm, operation: op };
-
-                    try {
-                        const opResponse = await fetch('/api/execute-operation', {
-                            method: 'POST',
-                            headers: {'Content-Type': 'application/json'},
-                            body: JSON.stringify({
-                                session_id: sessionId,
-                                vm_name: vm.vm,
-                                operation: op,
-                                snapshot_name: vm.snapshot_name,
-                                revert_name: vm.revert_name
-                            }),
-                            signal: this.abortController.signal
-                        });
-
-                    const opData = await opResponse.json();
-
-                    // Правильно определяем статус операции
-                    const opStatus = opData.status === "error" ? 'error' : 'success';
-                    this.updateOperationStatus(vm.vm, op, opStatus);
-
-                    if (opData.status === "critical_error") {
-                        throw new Error(opData.message);
-                    }
-
-                    if (opStatus === 'error') {
-                        console.error(opData.message);
-                    }
+            // Следим за ходом выполнения, пока план не завершится
+            while (!this.abortController.signal.aborted) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
 
-                } catch (error) {
-                    this.updateOperationStatus(vm.vm, op, 'error');
-
-                    if (error.message.toLowerCase().includes("подключ") ||
-                        error.message.toLowerCase().includes("connect")) {
-                        throw error;
-                    }
-
-                    console.error(error.message);
-                    continue;
+                const statusResponse = await fetch('/api/operation-status', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({ session_id: session.id }),
+                    signal: this.abortController.signal
+                });
+                if (!statusResponse.ok) throw new Error('Ошибка получения статуса операций');
+                const statusData = await statusResponse.json();
 
-                    } finally {
-                        this.currentOperation = null;
+                for (const vm of session.vmOperations) {
+                    for (const op of vm.operations) {
+                        const status = statusData.operationResults[`${vm.vm}_${op}`];
+                        if (status) this.updateOperationStatus(vm.vm, op, status);
                     }
                 }
+
+                if (statusData.finished) break;
             }
 
-            // 3. Завершаем сессию и получаем итоговый отчет
+            // Завершаем сессию и получаем итоговый отчет
             const finishResponse = await fetch('/api/finish-operations', {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({ session_id: sessionId })
+                body: JSON.stringify({ session_id: session.id })
             });
 
             if (!finishResponse.ok) throw new Error('Ошибка завершения операций');
@@ -278,12 +266,12 @@ export class OperationsManager {
             this.showMessage(message, finishData.status === "error");
 
         } catch (error) {
-            if (sessionId) {
+            if (session.id) {
                 // При ошибке отменяем сессию
                 await fetch('/api/cancel-operations', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({ session_id: sessionId })
+                    body: JSON.stringify({ session_id: session.id })
                 });
             }
 
@@ -295,6 +283,7 @@ export class OperationsManager {
             }
         } finally {
             executeBtn.disabled = false;
+            reconcileBtn.disabled = false;
             clearFilterBtn.disabled = false;
             selectBox.disabled = false;
             cancelBtn.disabled = true;
@@ -306,6 +295,74 @@ export class OperationsManager {
         }
     }
 
+    async reconcileWithCsv() {
+        const vmNames = Array.from(document.querySelectorAll('tr[data-vm]')).map(row => row.dataset.vm);
+        if (vmNames.length === 0) {
+            this.showMessage('В таблице нет ВМ', true);
+            return;
+        }
+        if (!confirm(`Привести ${vmNames.length} ВМ к описанию в CSV? ` +
+                     'Отсутствующие ВМ будут созданы, отличающиеся — изменены.')) {
+            return;
+        }
+
+        this.resetOperationStatus();
+        await this.runBatch(async (session, signal) => {
+            const response = await fetch('/api/reconcile', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ vms: vmNames }),
+                signal
+            });
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.message || 'Ошибка приведения ВМ к CSV');
+
+            // Всё уже соответствует CSV — сессия не создавалась
+            if (!data.session_id) {
+                this.showMessage(data.message, false);
+                return false;
+            }
+            session.id = data.session_id;
+            session.vmOperations = data.vmOperations;
+        });
+    }
+
+    async checkUnfinishedBatch() {
+        // Пакет, прерванный падением приложения или обрывом связи, можно продолжить
+        try {
+            const response = await fetch('/api/journal');
+            const batches = await response.json();
+            if (!batches.length) return;
+
+            const batch = batches[0];
+            const started = batch.started ? new Date(batch.started).toLocaleString() : '—';
+            if (!confirm(`Найден незавершённый пакет операций от ${started} ` +
+                         `(ВМ: ${batch.vm_count}, выполнено ${batch.done} из ${batch.operations}). Продолжить?`)) {
+                await fetch('/api/journal/discard', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({ batch_id: batch.batch })
+                });
+                return;
+            }
+
+            await this.runBatch(async (session, signal) => {
+                const resumeResponse = await fetch('/api/resume-batch', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({ batch_id: batch.batch }),
+                    signal
+                });
+                const resumeData = await resumeResponse.json();
+                if (!resumeResponse.ok) throw new Error(resumeData.message || 'Ошибка продолжения пакета операций');
+                session.id = resumeData.session_id;
+                session.vmOperations = resumeData.vmOperations;
+            });
+        } catch (error) {
+            console.error('Ошибка проверки журнала пакетов:', error);
+        }
+    }
+
     cancelOperations() {
         if (this.abortController) {
             this.abortController.abort();
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+
+vim = pytest.importorskip('pyVmomi').vim
+for module in ('paramiko', 'dotenv', 'tqdm'):
+    pytest.importorskip(module)
+
+# esxi_connect проверяет параметры подключения при импорте
+for name in ('ESXI_HOST', 'ESXI_USER', 'ESXI_PASSWORD', 'SSH_HOST', 'SSH_USER', 'SSH_PASSWORD'):
+    os.environ.setdefault(name, 'test')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from vm_operations import apply_snapshot_config_to_vmx
+from vmx_file import VmxFile
+
+CURRENT_VMX = '\n'.join([
+    'numvcpus = "4"',
+    'memSize = "8192"',
+    'guestOS = "ubuntu-64"',
+    'scsi0.present = "TRUE"',
+    'scsi0:0.present = "TRUE"',
+    'scsi0:0.fileName = "source.vmdk"',
+    'scsi0:1.present = "TRUE"',
+    'scsi0:1.fileName = "source_1.vmdk"',
+    'ide1:0.present = "TRUE"',
+    'ide1:0.fileName = "ubuntu.iso"',
+    'ide1:0.deviceType = "cdrom-image"',
+    'ethernet0.present = "TRUE"',
+    'ethernet0.networkName = "VM Network"',
+]) + '\n'
+
+
+def snapshot_config(disk_units=(0,), nics=1):
+    controller = vim.vm.device.ParaVirtualSCSIController(key=1000, busNumber=0)
+    devices = [controller]
+    devices += [vim.vm.device.VirtualDisk(key=2000 + unit, controllerKey=1000, unitNumber=unit)
+                for unit in disk_units]
+    devices += [vim.vm.device.VirtualVmxnet3(key=4000 + index) for index in range(nics)]
+    hardware = vim.vm.VirtualHardware(numCPU=2, numCoresPerSocket=1, memoryMB=4096, device=devices)
+    return vim.vm.ConfigInfo(hardware=hardware, guestId='ubuntu64Guest')
+
+
+def test_vmx_follows_snapshot_hardware_and_drops_later_disks():
+    vmx = VmxFile.parse(CURRENT_VMX)
+    apply_snapshot_config_to_vmx(vmx, snapshot_config())
+
+    assert vmx.get('numvcpus') == '2'
+    assert vmx.get('memSize') == '4096'
+    assert vmx.get('guestOS') == 'ubuntu64Guest'
+    assert vmx.get('scsi0:0.fileName') == 'source.vmdk'
+    assert not vmx.items('scsi0:1.')
+    assert vmx.get('ide1:0.fileName') == 'ubuntu.iso'
+
+
+def test_disk_removed_after_snapshot_fails():
+    vmx = VmxFile.parse(CURRENT_VMX)
+    with pytest.raises(Exception, match='scsi0:2'):
+        apply_snapshot_config_to_vmx(vmx, snapshot_config(disk_units=(0, 1, 2)))
+
+
+def test_nic_change_after_snapshot_fails():
+    vmx = VmxFile.parse(CURRENT_VMX)
+    with pytest.raises(Exception, match='Сетевые адаптеры'):
+        apply_snapshot_config_to_vmx(vmx, snapshot_config(nics=2))
@@ -0,0 +1,97 @@
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+
+vim = pytest.importorskip('pyVmomi').vim
+for module in ('paramiko', 'dotenv', 'tqdm'):
+    pytest.importorskip(module)
+
+# esxi_connect проверяет параметры подключения при импорте
+for name in ('ESXI_HOST', 'ESXI_USER', 'ESXI_PASSWORD', 'SSH_HOST', 'SSH_USER', 'SSH_PASSWORD'):
+    os.environ.setdefault(name, 'test')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+import vm_snapshot
+from vm_snapshot import SnapshotIndex, is_unchanged_since_snapshot
+
+CREATED = datetime(2026, 1, 10, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeEventManager:
+    """EventManager с заданным списком событий ВМ: [(тип события, время)]"""
+
+    def __init__(self, events):
+        self.events = [(name, getattr(vim.event, name)(createdTime=created)) for name, created in events]
+
+    def _select(self, spec):
+        begin, end = spec.time.beginTime, spec.time.endTime
+        return [event for name, event in self.events
+                if (not spec.eventTypeId or name in spec.eventTypeId)
+                and (begin is None or event.createdTime >= begin)
+                and (end is None or event.createdTime <= end)]
+
+    def QueryEvents(self, spec):
+        return self._select(spec)
+
+    def CreateCollectorForEvents(self, spec):
+        collector = MagicMock()
+        collector.latestPage = self._select(spec)
+        return collector
+
+
+@pytest.fixture
+def vm(monkeypatch):
+    vm = MagicMock(spec=vim.VirtualMachine)
+    vm.name = 'test-vm-01'
+    vm.runtime.powerState = vim.VirtualMachinePowerState.poweredOff
+    vm.config.instanceUuid = 'uuid-test-vm-01'
+
+    # Снапшот без памяти: vSphere помечает его poweredOff, даже если ВМ работала
+    tree = vim.vm.SnapshotTree(name='base', createTime=CREATED, snapshot=vim.vm.Snapshot('snapshot-1'),
+                               state=vim.VirtualMachinePowerState.poweredOff, childSnapshotList=[])
+    index = SnapshotIndex(vim.vm.SnapshotInfo(rootSnapshotList=[tree], currentSnapshot=tree.snapshot))
+    monkeypatch.setattr(vm_snapshot, 'get_snapshot_index', lambda vm, refresh=False: index)
+    return vm
+
+
+def use_events(monkeypatch, events):
+    manager = FakeEventManager(events)
+    monkeypatch.setattr(vm_snapshot, '_event_manager', lambda vm: manager)
+
+
+def test_snapshot_of_powered_off_vm_without_changes_is_unchanged(vm, monkeypatch):
+    use_events(monkeypatch, [('VmPoweredOffEvent', CREATED - timedelta(hours=1))])
+    assert is_unchanged_since_snapshot(vm, 'base')
+
+
+def test_live_snapshot_of_running_vm_is_not_a_clean_point(vm, monkeypatch):
+    # ВМ работала во время снапшота, писала на диск и потом была выключена гостем
+    use_events(monkeypatch, [
+        ('VmPoweredOnEvent', CREATED - timedelta(hours=1)),
+        ('VmGuestShutdownEvent', CREATED + timedelta(hours=1)),
+        ('VmPoweredOffEvent', CREATED + timedelta(hours=1, minutes=1)),
+    ])
+    assert not is_unchanged_since_snapshot(vm, 'base')
+
+
+def test_live_snapshot_without_later_events_is_not_a_clean_point(vm, monkeypatch):
+    use_events(monkeypatch, [('VmPoweredOnEvent', CREATED - timedelta(hours=1))])
+    assert not is_unchanged_since_snapshot(vm, 'base')
+
+
+def test_reconfigure_after_snapshot_requires_revert(vm, monkeypatch):
+    use_events(monkeypatch, [
+        ('VmPoweredOffEvent', CREATED - timedelta(hours=1)),
+        ('VmReconfiguredEvent', CREATED + timedelta(hours=1)),
+    ])
+    assert not is_unchanged_since_snapshot(vm, 'base')
+
+
+def test_unknown_power_state_at_snapshot_requires_revert(vm, monkeypatch):
+    # История событий не сохранила ничего до снапшота
+    use_events(monkeypatch, [])
+    assert not is_unchanged_since_snapshot(vm, 'base')
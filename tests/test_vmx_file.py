@@ -0,0 +1,110 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from vmx_file import VmxFile, apply_clone_edits, ethernet_ids
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), mode='rb') as file:
+        return file.read().decode('utf-8')
+
+
+@pytest.mark.parametrize('name', ['source.vmx', 'windows-crlf.vmx'])
+def test_round_trip_without_changes_is_byte_for_byte(name):
+    text = read_fixture(name)
+    assert VmxFile.parse(text).serialize() == text
+
+
+def test_round_trip_without_final_newline():
+    text = 'displayName = "vm"\nnumvcpus = "2"'
+    assert VmxFile.parse(text).serialize() == text
+
+
+def test_crlf_is_kept_for_changed_and_added_lines():
+    vmx = VmxFile.parse(read_fixture('windows-crlf.vmx'))
+    vmx.set('numvcpus', 4)
+    vmx.set('memSize', 4096)
+    text = vmx.serialize()
+
+    assert text.count('\r\n') == text.count('\n')
+    assert 'numvcpus = "4"\r\n' in text
+    assert text.endswith('memSize = "4096"\r\n')
+
+
+def test_keys_are_case_insensitive():
+    vmx = VmxFile.parse(read_fixture('source.vmx'))
+    assert vmx.get('DISPLAYNAME') == 'source-vm-name'
+    assert 'MemSize' in vmx
+
+
+def test_quoting_and_escapes():
+    vmx = VmxFile.parse(read_fixture('source.vmx'))
+    assert vmx.get('annotation') == 'line1\nline2 "quoted" | pipe'
+
+    vmx.set('annotation', 'a|b "c"\nd')
+    reparsed = VmxFile.parse(vmx.serialize())
+    assert 'annotation = "a|7Cb |22c|22|0Ad"' in vmx.serialize()
+    assert reparsed.get('annotation') == 'a|b "c"\nd'
+
+
+def test_unquoted_and_compact_values():
+    vmx = VmxFile.parse(read_fixture('windows-crlf.vmx'))
+    assert vmx.get('unquoted') == 'TRUE'
+    assert vmx.get('numvcpus') == '2'
+
+
+def test_comments_are_preserved_and_not_parsed_as_keys():
+    text = read_fixture('windows-crlf.vmx')
+    vmx = VmxFile.parse(text)
+    vmx.set('guestOS', 'windows2019srv-64')
+
+    assert '   # комментарий с отступом\r\n' in vmx.serialize()
+    assert all(not key.strip().startswith('#') for key in vmx.keys())
+
+
+def test_duplicate_keys_first_wins_and_remove_drops_all():
+    vmx = VmxFile.parse(read_fixture('windows-crlf.vmx'))
+    assert vmx.get('tools.syncTime') == 'FALSE'
+
+    vmx.set('tools.syncTime', 'TRUE')
+    assert [value for key, value in vmx.items('tools.syncTime')] == ['TRUE', 'TRUE']
+
+    vmx.remove('tools.syncTime')
+    assert 'tools.syncTime' not in vmx
+
+
+def test_unchanged_value_keeps_original_line():
+    text = read_fixture('windows-crlf.vmx')
+    vmx = VmxFile.parse(text)
+    vmx.set('numvcpus', '2')
+    assert vmx.serialize() == text
+
+
+def test_apply_clone_edits():
+    vmx = VmxFile.parse(read_fixture('source.vmx'))
+    apply_clone_edits(vmx, 'test-vm-01', {'scsi0:0': 'test-vm-01.vmdk'})
+    reparsed = VmxFile.parse(vmx.serialize())
+
+    assert reparsed.serialize() == vmx.serialize()
+    assert reparsed.get('displayName') == 'test-vm-01'
+    assert reparsed.get('scsi0:0.fileName') == 'test-vm-01.vmdk'
+    assert reparsed.get('nvram') == 'test-vm-01.nvram'
+    assert reparsed.get('uuid.action') == 'create'
+    assert 'uuid.bios' not in reparsed
+    assert 'ethernet0.generatedAddress' not in reparsed
+    assert reparsed.get('ethernet0.networkName') == 'VM Network'
+    assert reparsed.get('memsize') == '2048'
+    assert '# комментарий' in reparsed.serialize()
+
+
+def test_apply_clone_edits_keeps_static_mac():
+    vmx = VmxFile.parse(read_fixture('windows-crlf.vmx'))
+    apply_clone_edits(vmx, 'win-01')
+    assert ethernet_ids(vmx) == ['ethernet0']
+    assert vmx.get('ethernet0.address') == '00:50:56:00:00:01'